@@ -0,0 +1,153 @@
+#################################################################
+#Purpose
+#-----------
+# Cohort attrition funnel for the `define_population` criteria in
+# dataset_definition_rheum.py: how many patients each criterion drops,
+# both in sequence and on its own.
+
+#High-level logic
+#----------------
+#- Every criterion is a vectorised predicate over the criterion-level
+  # extract (dataset_definition_attrition.py). In a single chunked pass each
+  # patient gets a bitmask with bit i set when criterion i FAILS, and the
+  # pass accumulates a histogram of the 2^k mask values (k = 5 -> 32 bins).
+  # Evaluation time is recorded per criterion.
+#- Every count is read off that histogram, with no second pass:
+  #   failing      - patients failing criterion i (any other bits)
+  #   marginal     - patients failing ONLY criterion i (dropped by it alone)
+  #   sequential   - patients first dropped at step i in the given order
+  #   remaining    - patients left after step i
+  # Another order (--order) reuses the same histogram.
+
+#Inputs / Outputs
+#----------------
+#- output/dataset_attrition.csv.gz (generate_dataset_attrition)
+#- output/processed/attrition.csv        : one row per criterion
+#- output/processed/attrition_masks.csv  : patients per failure pattern
+#- Both are released: counts go through disclosure.disclose (1-7
+  # suppressed, rest rounded to 5), as does the printed summary.
+#################################################################
+
+import argparse
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from disclosure import disclose, round_counts
+from output_manager import write_csv
+
+ATTRITION_PATH = "output/dataset_attrition.csv.gz"
+
+# patient counts in the released funnel
+COUNT_COLUMNS = ["failing", "marginal_excluded", "sequential_excluded", "remaining"]
+
+
+@dataclass(frozen=True)
+class Criterion:
+    name: str
+    description: str
+    passes: Callable
+
+
+# same order as define_population in dataset_definition_rheum.py
+CRITERIA = [
+    Criterion("age_18_plus", "age at first OPA >= 18",
+              lambda df: df["age_opa"].to_numpy(np.float64) >= 18),
+    Criterion("has_any_diagnosis", "IA diagnosis in primary or secondary care (ever)",
+              lambda df: df["has_any_diagnosis"].to_numpy() == "T"),
+    Criterion("alive_after_first_opa", "no death date, or died after first OPA",
+              lambda df: (df["date_of_death"].isna() | (df["date_of_death"] > df["first_opa_date"])).to_numpy()),
+    Criterion("registered_at_first_opa", "registered with a practice on first OPA date",
+              lambda df: df["registered_at_first_opa"].to_numpy() == "T"),
+    Criterion("first_opa_present", "any OPA since 2018-01-01",
+              lambda df: df["first_opa_date"].notna().to_numpy()),
+]
+
+
+# =========================================================
+# Single pass: failure bitmask histogram
+# =========================================================
+def mask_histogram(path, criteria=CRITERIA, chunksize=1_000_000):
+    """Histogram of failure bitmasks over all patients, plus seconds per criterion."""
+    histogram = np.zeros(1 << len(criteria), dtype=np.int64)
+    seconds = np.zeros(len(criteria))
+    chunks = pd.read_csv(
+        path,
+        dtype={"has_any_diagnosis": str, "registered_at_first_opa": str},
+        parse_dates=["date_of_death", "first_opa_date"],
+        chunksize=chunksize,
+    )
+    for chunk in chunks:
+        mask = np.zeros(len(chunk), dtype=np.int64)
+        for bit, criterion in enumerate(criteria):
+            start = time.perf_counter()
+            fails = ~criterion.passes(chunk)
+            seconds[bit] += time.perf_counter() - start
+            mask |= fails.astype(np.int64) << bit
+        histogram += np.bincount(mask, minlength=histogram.size)
+    return histogram, seconds
+
+
+def funnel(histogram, criteria=CRITERIA, order=None, seconds=None):
+    """Failing / marginal / sequential / remaining counts from a mask histogram."""
+    masks = np.arange(histogram.size)
+    order = list(range(len(criteria))) if order is None else order
+    rows, dropped_bits = [], 0
+    remaining = int(histogram.sum())
+    for bit in order:
+        fails = (masks >> bit) & 1 == 1
+        first_dropped_here = fails & (masks & dropped_bits == 0)
+        sequential = int(histogram[first_dropped_here].sum())
+        remaining -= sequential
+        dropped_bits |= 1 << bit
+        rows.append({
+            "criterion": criteria[bit].name,
+            "description": criteria[bit].description,
+            "failing": int(histogram[fails].sum()),
+            "marginal_excluded": int(histogram[1 << bit]),
+            "sequential_excluded": sequential,
+            "remaining": remaining,
+            "eval_seconds": float(seconds[bit]) if seconds is not None else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+
+def mask_table(histogram, criteria=CRITERIA):
+    """Patients per failure pattern (non-empty patterns only)."""
+    masks = np.flatnonzero(histogram)
+    failed = [
+        "+".join(c.name for bit, c in enumerate(criteria) if m >> bit & 1) or "(included)"
+        for m in masks
+    ]
+    return pd.DataFrame({"mask": masks, "failed_criteria": failed, "patients": histogram[masks]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="One-pass attrition funnel for the rheum cohort criteria")
+    parser.add_argument("--dataset", default=ATTRITION_PATH)
+    parser.add_argument("--order", nargs="*", choices=[c.name for c in CRITERIA],
+                        help="sequential order (default: define_population order)")
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    histogram, seconds = mask_histogram(args.dataset)
+    names = [c.name for c in CRITERIA]
+    order = [names.index(n) for n in args.order] if args.order else None
+    report = funnel(histogram, order=order, seconds=seconds)
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    report = disclose(report, COUNT_COLUMNS)
+    write_csv(report, outdir / "attrition.csv", index=False)
+    write_csv(disclose(mask_table(histogram), ["patients"]), outdir / "attrition_masks.csv", index=False)
+    universe, cohort = round_counts([histogram.sum(), histogram[0]])
+    print(f"{universe:.0f} patients in universe, {cohort:.0f} in cohort (rounded)")
+    print(report.drop(columns="description").to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
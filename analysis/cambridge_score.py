@@ -0,0 +1,266 @@
+#################################################################
+#Purpose
+#-----------
+# Cambridge multimorbidity score (Payne et al. 2020,
+# https://www.cmaj.ca/content/192/5/E107) for the rheum cohort, scored
+# locally from the multimorbidity event extract rather than as one ehrQL
+# variable per condition.
+
+#High-level logic
+#----------------
+#- analysis/cambridge_criteria.csv lists the criteria, one row each:
+  # criterion name, source table, codelist CSV and code column, look-back
+  # in days before first_opa_date (blank = ever) and minimum number of
+  # events in that window (blank = 1).
+#- analysis/cambridge_multimorbidity.csv gives each condition a rule over
+  # criterion names with & (and), | (or), ~ (not) and parentheses, plus its
+  # weight. The Payne et al. definitions map directly, e.g. a condition
+  # defined by >= 4 prescriptions in 12 months unless a diagnosis code is
+  # recorded becomes `rx_4_in_12m & ~diagnosis_ever`. Conditions with an
+  # empty rule are skipped.
+#- Events are mapped to criteria with one sparse product (events x codes)
+  # @ (codes x criteria). Look-back windows are then applied to the non-zeros
+  # and the survivors are summed into a sparse (patients x criteria) count
+  # matrix. Each rule is evaluated on the met-criterion columns.
+#- Score = (patients x conditions) indicator matrix @ weight vector.
+
+#Notes
+#-----
+#- The config ships with the 37 Cambridge conditions but NO criteria,
+  # rules or weights, so load_config exits until they are filled in from the
+  # published definitions and Payne et al. (the weighting used, e.g. general
+  # outcome, must match the analysis). Conditions without a weight are
+  # reported but not scored.
+#- generate_multimorbidity / cambridge_score are therefore not registered
+  # in project.yaml yet; add them once the configuration is complete:
+  #   generate_multimorbidity: ehrql:v1 generate-dataset
+  #     analysis/dataset_definition_multimorbidity.py
+  #     --output output/multimorbidity:csv.gz   (highly_sensitive)
+  #   cambridge_score: python:v2 python analysis/cambridge_score.py
+  #     needs [generate_multimorbidity]; cambridge_score.csv.gz highly,
+  #     cambridge_conditions.csv moderately sensitive
+#- Value-based criteria (e.g. latest eGFR < 60 for CKD) need a numeric
+  # value column in the extract and are not supported yet.
+#- cambridge_conditions.csv patient counts go through disclosure.disclose.
+
+#Inputs / Outputs
+#----------------
+#- output/multimorbidity/*.csv.gz (generate_multimorbidity)
+#- output/processed/cambridge_score.csv.gz  : patient_id, n_conditions, cms_score
+#- output/processed/cambridge_conditions.csv : patients per condition, weight
+#################################################################
+
+import argparse
+import ast
+import keyword
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from disclosure import disclose, round_counts
+from output_manager import write_csv
+
+CONDITIONS = "analysis/cambridge_multimorbidity.csv"
+CRITERIA = "analysis/cambridge_criteria.csv"
+EXTRACT_DIR = "output/multimorbidity"
+SOURCES = ["clinical_events", "medications"]
+
+
+def _days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]").astype(np.int64)
+
+
+# =========================================================
+# Rules
+# =========================================================
+RULE_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.BitAnd, ast.BitOr, ast.Invert)
+
+
+def parse_rule(rule):
+    """Parsed rule and the criterion names it uses; ValueError for anything but & | ~ ( )."""
+    try:
+        tree = ast.parse(rule.strip(), mode="eval")
+    except SyntaxError as exc:
+        raise ValueError(f"cannot parse rule {rule!r}") from exc
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, RULE_NODES):
+            raise ValueError(f"rule {rule!r} may only combine criterion names with &, |, ~ and parentheses")
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+    return tree, names
+
+
+def evaluate_rule(tree, column):
+    """Boolean patient vector for a parsed rule; column(name) gives a criterion's met vector."""
+    node = tree.body if isinstance(tree, ast.Expression) else tree
+    if isinstance(node, ast.Name):
+        return column(node.id)
+    if isinstance(node, ast.UnaryOp):
+        return ~evaluate_rule(node.operand, column)
+    left, right = evaluate_rule(node.left, column), evaluate_rule(node.right, column)
+    return left & right if isinstance(node.op, ast.BitAnd) else left | right
+
+
+# =========================================================
+# Configuration
+# =========================================================
+def load_config(conditions_path=CONDITIONS, criteria_path=CRITERIA):
+    """Criteria used by the configured rules and the condition table."""
+    table = pd.read_csv(conditions_path, dtype=str, keep_default_na=False)
+    conditions = table[table["rule"].str.strip() != ""].reset_index(drop=True)
+    if conditions.empty:
+        raise SystemExit(f"no condition rules configured in {conditions_path}")
+
+    criteria = pd.read_csv(criteria_path, dtype=str, keep_default_na=False)
+    invalid = [c for c in criteria["criterion"] if not c.isidentifier() or keyword.iskeyword(c)]
+    if invalid:
+        raise SystemExit(f"criterion names must be identifiers: {', '.join(invalid)}")
+    duplicated = criteria.loc[criteria["criterion"].duplicated(), "criterion"].tolist()
+    if duplicated:
+        raise SystemExit(f"duplicate criteria in {criteria_path}: {', '.join(duplicated)}")
+
+    used = set()
+    for condition, rule in zip(conditions["condition"], conditions["rule"]):
+        try:
+            used |= parse_rule(rule)[1]
+        except ValueError as exc:
+            raise SystemExit(f"{condition}: {exc}") from None
+    undefined = sorted(used - set(criteria["criterion"]))
+    if undefined:
+        raise SystemExit(f"rules use criteria not defined in {criteria_path}: {', '.join(undefined)}")
+
+    criteria = criteria[criteria["criterion"].isin(used)].reset_index(drop=True)
+    incomplete = criteria.loc[(criteria["codelist"] == "") | ~criteria["source"].isin(SOURCES), "criterion"]
+    if len(incomplete):
+        raise SystemExit(f"criteria need a codelist and a source in {SOURCES}: {', '.join(incomplete)}")
+    criteria["lookback_days"] = pd.to_numeric(criteria["lookback_days"].replace("", np.nan)).astype(float)
+    criteria["min_events"] = pd.to_numeric(criteria["min_events"].replace("", "1"))
+    conditions["weight"] = pd.to_numeric(conditions["weight"].replace("", np.nan))
+    return criteria, conditions
+
+
+def criterion_codes(criteria):
+    """(codes x criteria) sparse membership per source, with the code vocabulary."""
+    maps = {}
+    for source in SOURCES:
+        rows = criteria.index[criteria["source"] == source]
+        pairs = [
+            pd.DataFrame({"code": pd.read_csv(criteria.at[i, "codelist"], dtype=str)[criteria.at[i, "column"] or "code"],
+                          "criterion": i})
+            for i in rows
+        ]
+        if not pairs:
+            continue
+        pairs = pd.concat(pairs).drop_duplicates()
+        code_index, vocab = pd.factorize(pairs["code"])
+        membership = sparse.csr_matrix(
+            (np.ones(len(pairs)), (code_index, pairs["criterion"].to_numpy())), shape=(len(vocab), len(criteria))
+        )
+        maps[source] = (pd.Index(vocab), membership)
+    return maps
+
+
+# =========================================================
+# Scoring
+# =========================================================
+def criterion_counts(events, anchor_day, criteria, maps, n_patients):
+    """Sparse (patients x criteria) event counts inside each criterion's look-back."""
+    lookback = criteria["lookback_days"].to_numpy()
+    patient_parts, criterion_parts = [], []
+    for source, (vocab, membership) in maps.items():
+        ev = events.get(source)
+        if ev is None or ev.empty:
+            continue
+        code = vocab.get_indexer(ev["code"])
+        keep = code >= 0
+        patient, day, code = ev["patient"].to_numpy()[keep], _days(ev["date"])[keep], code[keep]
+        hits = membership[code].tocoo()                       # (events x criteria)
+        anchor = anchor_day[patient[hits.row]]
+        delta = anchor - day[hits.row]
+        window = np.isnan(lookback[hits.col]) | (delta <= lookback[hits.col])
+        in_window = (anchor != np.iinfo(np.int64).min) & (delta >= 0) & window
+        patient_parts.append(patient[hits.row[in_window]])
+        criterion_parts.append(hits.col[in_window])
+    patient = np.concatenate(patient_parts) if patient_parts else np.zeros(0, np.int64)
+    criterion = np.concatenate(criterion_parts) if criterion_parts else np.zeros(0, np.int64)
+    return sparse.csr_matrix(
+        (np.ones(len(patient)), (patient, criterion)), shape=(n_patients, len(criteria))
+    )
+
+
+def condition_matrix(counts, criteria, conditions):
+    """(patients x conditions) 0/1 indicators: each condition's rule over met criteria."""
+    met = counts.tocoo()
+    ok = met.data >= criteria["min_events"].to_numpy()[met.col]
+    met = sparse.csc_matrix((np.ones(ok.sum(), bool), (met.row[ok], met.col[ok])), shape=counts.shape)
+    column_of = {name: j for j, name in enumerate(criteria["criterion"])}
+
+    def column(name):
+        return met[:, column_of[name]].toarray().ravel()
+
+    rows, cols = [], []
+    for j, rule in enumerate(conditions["rule"]):
+        patients = np.flatnonzero(evaluate_rule(parse_rule(rule)[0], column))
+        rows.append(patients)
+        cols.append(np.full(len(patients), j))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(counts.shape[0], len(conditions)))
+
+
+def score(indicators, conditions):
+    """Weighted score over conditions with a weight (NaN if none are weighted)."""
+    weights = conditions["weight"].to_numpy(np.float64)
+    weighted = ~np.isnan(weights)
+    if not weighted.any():
+        return np.full(indicators.shape[0], np.nan)
+    return indicators @ np.where(weighted, weights, 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cambridge multimorbidity score from the event extract")
+    parser.add_argument("--conditions", default=CONDITIONS)
+    parser.add_argument("--criteria", default=CRITERIA)
+    parser.add_argument("--extract-dir", default=EXTRACT_DIR)
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    criteria, conditions = load_config(args.conditions, args.criteria)
+    unweighted = conditions.loc[conditions["weight"].isna(), "condition"].tolist()
+    if unweighted:
+        print(f"no weight configured, not scored: {', '.join(unweighted)}")
+
+    extract = Path(args.extract_dir)
+    cohort = pd.read_csv(extract / "dataset.csv.gz").sort_values("patient_id").reset_index(drop=True)
+    index = pd.Index(cohort["patient_id"])
+    events = {}
+    for source in SOURCES:
+        path = extract / f"{source}.csv.gz"
+        if path.exists():
+            ev = pd.read_csv(path, dtype={"code": str})
+            events[source] = ev.assign(patient=index.get_indexer(ev["patient_id"]))
+            events[source] = events[source][events[source]["patient"] >= 0]
+
+    maps = criterion_codes(criteria)
+    counts = criterion_counts(events, _days(cohort["first_opa_date"]), criteria, maps, len(cohort))
+    indicators = condition_matrix(counts, criteria, conditions)
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    scores = pd.DataFrame({
+        "patient_id": cohort["patient_id"],
+        "n_conditions": np.asarray(indicators.sum(axis=1)).ravel().astype(np.int64),
+        "cms_score": score(indicators, conditions),
+    })
+    prevalence = conditions.assign(patients=np.asarray(indicators.sum(axis=0)).ravel().astype(np.int64))
+    write_csv(scores, outdir / "cambridge_score.csv.gz", index=False)
+    write_csv(disclose(prevalence[["condition", "weight", "patients"]], ["patients"]),
+              outdir / "cambridge_conditions.csv", index=False)
+    (n_patients,) = round_counts([len(cohort)])
+    print(f"{n_patients:.0f} patients (rounded) scored on {len(conditions)} configured condition(s)")
+
+
+if __name__ == "__main__":
+    main()
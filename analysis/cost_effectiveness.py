@@ -0,0 +1,365 @@
+#################################################################
+#Purpose
+#-----------
+# Cost-effectiveness model for rheumatology patient-initiated follow-up (PIFU)
+# versus traditional clinician-led follow-up, with probabilistic sensitivity
+# analysis (PSA).
+
+#High-level logic
+#----------------
+#- Estimate visit rates and the PIFU "return" hazard from the rheum OPA
+  #  event table of the PFU cohort (generate_opa_events):
+  #  - PIFU visit rate      <- rheum OPAs in the year after first PFU
+  #  - traditional rate     <- rheum OPAs in the year before first PFU
+  #  - return-to-clinic     <- days from first PFU to the next rheum OPA,
+  #                            censored at 1 year or the data cut
+  #  Exposure is truncated at the study start (events are extracted from
+  #  2018-01-01) and at the data cut (latest appointment in the extract).
+#- Draw PSA parameter sets (Gamma for rates/costs, Beta for utilities).
+#- Run a monthly Markov model with states on_pathway / returned / dead.
+  #  The cohort version is vectorised across draws; the microsimulation
+  #  version simulates patients as NumPy arrays (draws x patients) and is
+  #  split across worker processes by draw chunks.
+#- Report incremental costs/QALYs, the ICER and the cost-effectiveness
+  #  acceptability curve (CEAC). When the base case has no QALY difference
+  #  (the default: `pifu_utility_shift` = 0) the ICER is undefined and the
+  #  summary is a cost-minimisation analysis: incremental cost and the
+  #  probability that PIFU saves money.
+
+#Configurable (to be changed)
+#----------------------------
+#- `DEFAULTS` holds unit cost, utilities, mortality, discounting and horizon.
+  #  The unit cost and utilities are placeholders: replace them with the
+  #  National Cost Collection and published EQ-5D values before reporting.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (generate_opa_events)
+#- output/processed/cea_summary.csv : mean costs, QALYs, increments, ICER
+  #                                    (or cost-minimisation, see above)
+#- output/processed/cea_ceac.csv    : probability PIFU is cost-effective by WTP
+#################################################################
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START
+from output_manager import write_csv
+
+# Markov states
+ON_PATHWAY, RETURNED, DEAD = 0, 1, 2
+N_STATES = 3
+
+ARMS = ("traditional", "pifu")
+
+DEFAULTS = {
+    "horizon_months": 60,
+    "discount_rate": 0.035,           # NICE reference case, per year
+    "opa_unit_cost": 150.0,           # placeholder cost per outpatient visit (GBP)
+    "opa_unit_cost_se": 15.0,
+    "utility": 0.70,                  # placeholder utility for stable IA on follow-up
+    "utility_se": 0.02,
+    "pifu_utility_shift": 0.0,        # utility difference while on PIFU (mean, se)
+    "pifu_utility_shift_se": 0.01,
+    "monthly_mortality": 0.001,
+    "window_days": 365,               # before / after first PFU, and return censoring
+}
+
+RHEUM = "410"
+DAYS_PER_YEAR = 365.25
+QALY_TOLERANCE = 1e-9
+
+# Willingness-to-pay grid for the CEAC (GBP per QALY)
+WTP_GRID = np.arange(0, 50001, 1000)
+
+
+# =========================================================
+# Parameter estimation from the extracted cohort
+# =========================================================
+def _days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]").astype(np.int64)
+
+
+def estimate_parameters(pfu_day, patient, day, study_start, data_end, defaults=DEFAULTS):
+    """Sufficient statistics (events, exposure) for the rate parameters.
+
+    pfu_day: first PFU per PIFU patient (days since 1970-01-01); patient /
+    day: that patient's index and date for every rheum OPA.
+    """
+    window = defaults["window_days"]
+    rel = day - pfu_day[patient]
+    after = (rel > 0) & (rel <= window)
+    before = (rel < 0) & (rel >= -window)
+
+    # first rheum OPA after the PFU visit, censored at the window or data cut
+    next_visit = np.full(len(pfu_day), np.inf)
+    np.minimum.at(next_visit, patient[rel > 0], rel[rel > 0])
+    censor = np.clip(np.minimum(window, data_end - pfu_day), 0, None).astype(float)
+    returned = next_visit <= censor
+    exposure_days = np.where(returned, next_visit, censor)
+
+    return {
+        "n_pifu": len(pfu_day),
+        # visits per person-year observed on each side of the first PFU
+        "pifu_visits": float(after.sum()),
+        "pifu_person_years": censor.sum() / DAYS_PER_YEAR,
+        "trad_visits": float(before.sum()),
+        "trad_person_years": np.clip(np.minimum(window, pfu_day - study_start), 0, None).sum() / DAYS_PER_YEAR,
+        # return-to-clinic events per person-month on PIFU
+        "return_events": float(returned.sum()),
+        "return_exposure_months": exposure_days.sum() / 30.4375,
+    }
+
+
+def _beta_from_moments(rng, mean, se, size):
+    common = mean * (1 - mean) / se**2 - 1
+    return rng.beta(mean * common, (1 - mean) * common, size)
+
+
+def _gamma_from_moments(rng, mean, se, size):
+    shape = (mean / se) ** 2
+    return rng.gamma(shape, mean / shape, size)
+
+
+def draw_parameters(stats, n_draws, rng, defaults=DEFAULTS):
+    """PSA draws, one array of length n_draws per parameter.
+
+    Rates use a Gamma(events, exposure) posterior; n_draws=0 is not allowed,
+    use `point_parameters` for the deterministic base case.
+    """
+    eps = 0.5  # Jeffreys-style correction so empty cohorts stay defined
+    return {
+        "pifu_rate": rng.gamma(stats["pifu_visits"] + eps, 1 / (stats["pifu_person_years"] + eps), n_draws) / 12,
+        "trad_rate": rng.gamma(stats["trad_visits"] + eps, 1 / (stats["trad_person_years"] + eps), n_draws) / 12,
+        "return_hazard": rng.gamma(stats["return_events"] + eps, 1 / (stats["return_exposure_months"] + eps), n_draws),
+        "unit_cost": _gamma_from_moments(rng, defaults["opa_unit_cost"], defaults["opa_unit_cost_se"], n_draws),
+        "utility": _beta_from_moments(rng, defaults["utility"], defaults["utility_se"], n_draws),
+        "pifu_utility_shift": rng.normal(defaults["pifu_utility_shift"], defaults["pifu_utility_shift_se"], n_draws),
+        "mortality": np.full(n_draws, defaults["monthly_mortality"]),
+    }
+
+
+def point_parameters(stats, defaults=DEFAULTS):
+    """Deterministic base case: posterior means, as length-1 arrays."""
+    eps = 0.5
+    return {
+        "pifu_rate": np.array([(stats["pifu_visits"] + eps) / (stats["pifu_person_years"] + eps) / 12]),
+        "trad_rate": np.array([(stats["trad_visits"] + eps) / (stats["trad_person_years"] + eps) / 12]),
+        "return_hazard": np.array([(stats["return_events"] + eps) / (stats["return_exposure_months"] + eps)]),
+        "unit_cost": np.array([defaults["opa_unit_cost"]]),
+        "utility": np.array([defaults["utility"]]),
+        "pifu_utility_shift": np.array([defaults["pifu_utility_shift"]]),
+        "mortality": np.array([defaults["monthly_mortality"]]),
+    }
+
+
+# =========================================================
+# Model structure (all arrays are per draw)
+# =========================================================
+def transition_matrices(params, arm):
+    """(draws, 3, 3) monthly transition matrices for one arm."""
+    n = len(params["mortality"])
+    death = params["mortality"]
+    if arm == "pifu":
+        p_return = 1 - np.exp(-params["return_hazard"])
+    else:
+        p_return = np.zeros(n)
+
+    P = np.zeros((n, N_STATES, N_STATES))
+    P[:, ON_PATHWAY, RETURNED] = p_return * (1 - death)
+    P[:, ON_PATHWAY, DEAD] = death
+    P[:, ON_PATHWAY, ON_PATHWAY] = 1 - P[:, ON_PATHWAY, RETURNED] - death
+    P[:, RETURNED, DEAD] = death
+    P[:, RETURNED, RETURNED] = 1 - death
+    P[:, DEAD, DEAD] = 1
+    return P
+
+
+def state_rewards(params, arm):
+    """Per-cycle visit rate and utility for each state, shape (draws, 3)."""
+    n = len(params["mortality"])
+    visits = np.zeros((n, N_STATES))
+    utility = np.zeros((n, N_STATES))
+
+    visits[:, RETURNED] = params["trad_rate"]
+    utility[:, RETURNED] = params["utility"]
+    if arm == "pifu":
+        visits[:, ON_PATHWAY] = params["pifu_rate"]
+        utility[:, ON_PATHWAY] = params["utility"] + params["pifu_utility_shift"]
+    else:
+        visits[:, ON_PATHWAY] = params["trad_rate"]
+        utility[:, ON_PATHWAY] = params["utility"]
+    return visits, utility
+
+
+def discount_factors(horizon_months, rate):
+    return (1 + rate) ** (-np.arange(horizon_months) / 12)
+
+
+def run_cohort(params, arm, defaults=DEFAULTS):
+    """Markov cohort trace vectorised across draws; returns (costs, qalys)."""
+    P = transition_matrices(params, arm)
+    visits, utility = state_rewards(params, arm)
+    disc = discount_factors(defaults["horizon_months"], defaults["discount_rate"])
+
+    n = P.shape[0]
+    occupancy = np.zeros((n, N_STATES))
+    occupancy[:, ON_PATHWAY] = 1.0
+    costs = np.zeros(n)
+    qalys = np.zeros(n)
+    for t in range(defaults["horizon_months"]):
+        costs += disc[t] * (occupancy * visits).sum(axis=1) * params["unit_cost"]
+        qalys += disc[t] * (occupancy * utility).sum(axis=1) / 12
+        occupancy = np.einsum("ds,dst->dt", occupancy, P)
+    return costs, qalys
+
+
+def run_microsimulation(params, arm, n_patients, seed, defaults=DEFAULTS):
+    """Patient-level simulation held in (draws, patients) arrays.
+
+    Visits are Poisson given the state rate, so the output carries first-order
+    (patient) as well as second-order (parameter) uncertainty.
+    """
+    rng = np.random.default_rng(seed)
+    P = transition_matrices(params, arm)
+    visits, utility = state_rewards(params, arm)
+    disc = discount_factors(defaults["horizon_months"], defaults["discount_rate"])
+
+    n = P.shape[0]
+    draw_idx = np.arange(n)[:, None]
+    cum_P = np.cumsum(P, axis=2)
+    # a row sum a rounding error below 1 would let u fall past the last state
+    cum_P[..., -1] = 1.0
+    state = np.full((n, n_patients), ON_PATHWAY, dtype=np.int8)
+    costs = np.zeros(n)
+    qalys = np.zeros(n)
+    for t in range(defaults["horizon_months"]):
+        n_visits = rng.poisson(visits[draw_idx, state])
+        costs += disc[t] * n_visits.sum(axis=1) * params["unit_cost"] / n_patients
+        qalys += disc[t] * utility[draw_idx, state].mean(axis=1) / 12
+
+        # next state: first cumulative probability exceeding a uniform draw
+        u = rng.random((n, n_patients, 1))
+        state = (u > cum_P[draw_idx, state]).sum(axis=2).astype(np.int8)
+    return costs, qalys
+
+
+def _run_chunk(args):
+    params, n_patients, seeds, defaults = args
+    out = {}
+    for arm, seed in zip(ARMS, seeds):
+        if n_patients:
+            out[arm] = run_microsimulation(params, arm, n_patients, seed, defaults)
+        else:
+            out[arm] = run_cohort(params, arm, defaults)
+    return out
+
+
+def run_psa(stats, n_draws=5000, n_patients=0, n_jobs=1, seed=2025, chunk_size=500, defaults=DEFAULTS):
+    """Run the PSA; n_patients=0 uses the cohort model, >0 the microsimulation.
+
+    Draws are split into chunks that run in separate processes. Each chunk
+    gets its own child seed so results do not depend on n_jobs.
+    """
+    root = np.random.SeedSequence(seed)
+    params = draw_parameters(stats, n_draws, np.random.default_rng(root.spawn(1)[0]), defaults)
+
+    bounds = list(range(0, n_draws, chunk_size)) + [n_draws]
+    chunk_seeds = root.spawn(len(bounds) - 1)
+    tasks = []
+    for (lo, hi), ss in zip(zip(bounds[:-1], bounds[1:]), chunk_seeds):
+        chunk = {k: v[lo:hi] for k, v in params.items()}
+        tasks.append((chunk, n_patients, ss.spawn(len(ARMS)), defaults))
+
+    if n_jobs == 1:
+        results = [_run_chunk(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_run_chunk, tasks))
+
+    draws = pd.DataFrame({k: v for k, v in params.items()})
+    for arm in ARMS:
+        draws[f"cost_{arm}"] = np.concatenate([r[arm][0] for r in results])
+        draws[f"qaly_{arm}"] = np.concatenate([r[arm][1] for r in results])
+    draws["delta_cost"] = draws["cost_pifu"] - draws["cost_traditional"]
+    draws["delta_qaly"] = draws["qaly_pifu"] - draws["qaly_traditional"]
+    return draws
+
+
+# =========================================================
+# Summaries
+# =========================================================
+def icer(delta_cost, delta_qaly):
+    """Ratio of mean increments; NaN when the QALY difference is (numerically) zero."""
+    dc, dq = np.mean(delta_cost), np.mean(delta_qaly)
+    return dc / dq if abs(dq) > QALY_TOLERANCE else np.nan
+
+
+def ceac(delta_cost, delta_qaly, wtp=WTP_GRID):
+    """P(net monetary benefit of PIFU > 0) for each WTP, vectorised."""
+    nmb = np.outer(delta_qaly, wtp) - np.asarray(delta_cost)[:, None]
+    return pd.DataFrame({"wtp": wtp, "prob_pifu_cost_effective": (nmb > 0).mean(axis=0)})
+
+
+def summarise(draws):
+    row = {}
+    for arm in ARMS:
+        row[f"mean_cost_{arm}"] = draws[f"cost_{arm}"].mean()
+        row[f"mean_qaly_{arm}"] = draws[f"qaly_{arm}"].mean()
+    row["delta_cost"] = draws["delta_cost"].mean()
+    row["delta_qaly"] = draws["delta_qaly"].mean()
+    row["delta_cost_lci"], row["delta_cost_uci"] = np.percentile(draws["delta_cost"], [2.5, 97.5])
+    row["delta_qaly_lci"], row["delta_qaly_uci"] = np.percentile(draws["delta_qaly"], [2.5, 97.5])
+    row["icer"] = icer(draws["delta_cost"], draws["delta_qaly"])
+    row["prob_pifu_cost_saving"] = (draws["delta_cost"] < 0).mean()
+    row["n_draws"] = len(draws)
+    return pd.DataFrame([row])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PIFU cost-effectiveness PSA")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--draws", type=int, default=5000)
+    parser.add_argument("--patients", type=int, default=0, help="0 = cohort model")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=2025)
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    cohort = pd.read_csv(args.cohort, usecols=["patient_id", "first_rheum_pfu_date"])
+    cohort = cohort[cohort["first_rheum_pfu_date"].notna()]
+    events = pd.read_csv(args.events, usecols=["patient_id", "appointment_date", "treatment_function_code"],
+                         dtype={"treatment_function_code": str})
+    events = events[events["appointment_date"].notna()]
+    data_end = _days(events["appointment_date"]).max()
+    rheum = events[events["treatment_function_code"].str.strip() == RHEUM]
+    patient = pd.Index(cohort["patient_id"]).get_indexer(rheum["patient_id"])
+    stats = estimate_parameters(
+        _days(cohort["first_rheum_pfu_date"]), patient[patient >= 0], _days(rheum["appointment_date"])[patient >= 0],
+        _days([STUDY_START])[0], data_end,
+    )
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+    draws = run_psa(stats, n_draws=args.draws, n_patients=args.patients, n_jobs=args.jobs, seed=args.seed)
+
+    # deterministic base case at the point estimates
+    base = point_parameters(stats)
+    (c_trad, q_trad), (c_pifu, q_pifu) = (run_cohort(base, arm) for arm in ARMS)
+    summary = summarise(draws)
+    summary["icer_base_case"] = icer(c_pifu - c_trad, q_pifu - q_trad)
+    cost_minimisation = abs((q_pifu - q_trad)[0]) <= QALY_TOLERANCE
+    summary["analysis"] = "cost_minimisation" if cost_minimisation else "cost_utility"
+    if cost_minimisation:
+        summary["icer"] = np.nan
+        print("no QALY difference in the base case: reporting cost-minimisation (ICER undefined)")
+
+    write_csv(summary, f"{args.outdir}/cea_summary.csv", index=False)
+    write_csv(ceac(draws["delta_cost"], draws["delta_qaly"]), f"{args.outdir}/cea_ceac.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+####################################################################
+#Purpose
+#-------
+#Criterion-level extract for the cohort attrition report (attrition.py).
+#One row per patient in a broad universe with the inputs of every
+#`define_population` criterion in dataset_definition_rheum.py, so the
+#funnel can be computed locally without re-running the extraction once per
+#criterion.
+
+#Notes
+#-----
+#- Universe: anyone with any OPA record or any IA diagnosis (ever). Patients
+  # outside it fail both the diagnosis and the first-OPA criteria, so they
+  # never change a marginal (single-criterion) exclusion count.
+#- Criteria inputs come from the same feature factories (analysis/features)
+  # as the main dataset definition, so both stay in step.
+####################################################################
+
+from ehrql import create_dataset
+from ehrql.tables.tpp import opa as opa_table, patients
+
+from features import demographics, diagnosis, opa
+
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=2000)
+
+dataset.define_population(opa_table.exists_for_patient() | diagnosis.has_any_diagnosis())
+
+dataset.age_opa = demographics.age_opa()
+dataset.has_any_diagnosis = diagnosis.has_any_diagnosis()
+dataset.date_of_death = patients.date_of_death
+dataset.first_opa_date = opa.first_opa_date()
+dataset.registered_at_first_opa = demographics.registration_at_first_opa().exists_for_patient()
@@ -0,0 +1,124 @@
+####################################################################
+#Purpose
+#-------
+#Event-level increment for incremental_aggregates.py: the OPA, csDMARD /
+#steroid, GP diagnosis and APCS diagnosis rows behind the mergeable
+#variables of dataset_definition_rheum.py (counts, first/last dates and
+#latest-with-payload), restricted to event dates in (since, until].
+
+#Notes
+#-----
+#- Bounds are ehrQL parameters; without them every dated row is extracted
+  # (a full rebuild):
+  # generate-dataset analysis/dataset_definition_increment.py \
+  #     --output output/increment:csv.gz -- --since 2025-06-30 --until 2025-09-30
+#- Rows without an event date cannot be placed against the high-water mark
+  # and are not extracted.
+#- Diagnosis categories and the APCS code are derived per row with the
+  # same rules as features/diagnosis.py, so the latest row carries them.
+####################################################################
+
+from ehrql import case, create_dataset, get_parameter, when
+from ehrql.tables.tpp import apcs, clinical_events, medications, opa
+
+from codelists import (
+    DMARD_codelist,
+    axialspa_icd10_codelist,
+    eia_icd10_codelist,
+    eia_snomed_categories,
+    eia_snomed_codelist,
+    psa_icd10_codelist,
+    rheumatoid_icd10_codelist,
+    steroid_codelist,
+)
+
+since = get_parameter("since", default=None)
+until = get_parameter("until", default=None)
+
+
+def in_increment(frame, date):
+    """Rows dated after the high-water mark and on or before `until`."""
+    frame = frame.where(date.is_not_null())
+    if since is not None:
+        frame = frame.where(date.is_after(since))
+    if until is not None:
+        frame = frame.where(date.is_on_or_before(until))
+    return frame
+
+
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=2000)
+
+# every OPA: the since-2018 and rheum / non-rheum filters are applied locally
+new_opa = in_increment(opa, opa.appointment_date)
+
+new_prescriptions = in_increment(
+    medications.where(
+        medications.dmd_code.is_in(DMARD_codelist) | medications.dmd_code.is_in(steroid_codelist)
+    ),
+    medications.date,
+)
+
+new_gp_diagnoses = in_increment(
+    clinical_events.where(clinical_events.snomedct_code.is_in(eia_snomed_codelist)),
+    clinical_events.date,
+)
+
+new_apcs_diagnoses = in_increment(
+    apcs.where(
+        apcs.primary_diagnosis.is_in(eia_icd10_codelist)
+        | apcs.secondary_diagnosis.is_in(eia_icd10_codelist)
+        | apcs.all_diagnoses.contains_any_of(eia_icd10_codelist)
+    ),
+    apcs.admission_date,
+)
+
+dataset.define_population(
+    new_opa.exists_for_patient()
+    | new_prescriptions.exists_for_patient()
+    | new_gp_diagnoses.exists_for_patient()
+    | new_apcs_diagnoses.exists_for_patient()
+)
+
+dataset.add_event_table(
+    "opa",
+    opa_ident=new_opa.opa_ident,
+    appointment_date=new_opa.appointment_date,
+    treatment_function_code=new_opa.treatment_function_code,
+    outcome_of_attendance=new_opa.outcome_of_attendance,
+)
+
+dataset.add_event_table(
+    "medications",
+    date=new_prescriptions.date,
+    dmd_code=new_prescriptions.dmd_code,
+    drug_class=case(
+        when(new_prescriptions.dmd_code.is_in(DMARD_codelist)).then("dmard"),
+        otherwise="steroid",
+    ),
+)
+
+gp_code_to_category = {code: cat for cat, codes in eia_snomed_categories.items() for code in codes}
+dataset.add_event_table(
+    "gp_diagnoses",
+    date=new_gp_diagnoses.date,
+    snomedct_code=new_gp_diagnoses.snomedct_code,
+    category=new_gp_diagnoses.snomedct_code.to_category(gp_code_to_category),
+)
+
+dataset.add_event_table(
+    "apcs_diagnoses",
+    admission_date=new_apcs_diagnoses.admission_date,
+    code=case(
+        when(new_apcs_diagnoses.primary_diagnosis.is_not_null()).then(new_apcs_diagnoses.primary_diagnosis),
+        when(new_apcs_diagnoses.secondary_diagnosis.is_not_null()).then(new_apcs_diagnoses.secondary_diagnosis),
+        otherwise=None,
+    ),
+    category=case(
+        when(new_apcs_diagnoses.all_diagnoses.contains_any_of(rheumatoid_icd10_codelist)).then("rheumatoid"),
+        when(new_apcs_diagnoses.all_diagnoses.contains_any_of(psa_icd10_codelist)).then("psa"),
+        when(new_apcs_diagnoses.all_diagnoses.contains_any_of(axialspa_icd10_codelist)).then("axialspa"),
+        otherwise=None,
+    ),
+    all_diagnoses=new_apcs_diagnoses.all_diagnoses,
+)
@@ -0,0 +1,66 @@
+####################################################################
+#Purpose
+#-------
+#Event-level extract for the Cambridge multimorbidity score
+#(cambridge_score.py): every GP event and prescription on or before the
+#first OPA whose code is in any configured condition codelist.
+
+#Notes
+#-----
+#- Criteria (source table, codelist, look-back window) are read from
+  # analysis/cambridge_criteria.csv; no ehrQL variable is built per
+  # condition. Condition rules are applied locally by cambridge_score.py.
+#- Not registered in project.yaml until the criteria are configured (see
+  # cambridge_score.py).
+#- Events are kept back to the longest configured look-back (all history
+  # if any criterion has none); per-condition windows are applied locally.
+#- Run with a directory output so all tables are written:
+  # generate-dataset ... --output output/multimorbidity:csv.gz
+####################################################################
+
+import csv
+from functools import reduce
+from operator import add
+
+from ehrql import codelist_from_csv, create_dataset, days
+from ehrql.tables.tpp import clinical_events, medications
+
+from features import opa
+
+CRITERIA = "analysis/cambridge_criteria.csv"
+
+with open(CRITERIA, newline="") as f:
+    criteria = [row for row in csv.DictReader(f) if row["codelist"]]
+
+
+def source_codelist(source):
+    """Union of the codelists configured for one source table."""
+    lists = [
+        codelist_from_csv(row["codelist"], column=row["column"] or "code")
+        for row in criteria if row["source"] == source
+    ]
+    return reduce(add, lists) if lists else []
+
+
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=2000)
+
+dataset.define_population(opa.all_rheum_opa().exists_for_patient())
+
+anchor = opa.first_opa_date()
+dataset.first_opa_date = anchor
+
+lookbacks = [row["lookback_days"] for row in criteria]
+earliest = anchor - days(max(int(d) for d in lookbacks)) if lookbacks and all(lookbacks) else None
+
+
+def window(frame):
+    frame = frame.where(frame.date.is_on_or_before(anchor))
+    return frame if earliest is None else frame.where(frame.date.is_on_or_after(earliest))
+
+
+gp_events = window(clinical_events.where(clinical_events.snomedct_code.is_in(source_codelist("clinical_events"))))
+dataset.add_event_table("clinical_events", date=gp_events.date, code=gp_events.snomedct_code)
+
+prescriptions = window(medications.where(medications.dmd_code.is_in(source_codelist("medications"))))
+dataset.add_event_table("medications", date=prescriptions.date, code=prescriptions.dmd_code)
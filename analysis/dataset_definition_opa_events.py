@@ -0,0 +1,52 @@
+####################################################################
+#Purpose
+#-------
+#Event-level extract of outpatient appointments (one row per OPA) for the
+#patient-level cohort, used by the local Python estimators that need the
+#visit stream rather than first/last/count summaries (event study, etc.).
+
+#Notes
+#-----
+#- Population mirrors the rheum cohort: anyone with a rheumatology OPA
+  # (treatment_function_code "410") since 2018-01-01.
+#- The patient-level table carries the PIFU anchor; the `opa` event table
+  # carries every OPA since 2018-01-01 (rheum and non-rheum).
+#- Run with a directory output so both tables are written:
+  # generate-dataset ... --output output/opa_events:csv.gz
+####################################################################
+
+from ehrql import create_dataset
+from ehrql.tables.tpp import opa, patients, practice_registrations
+
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=2000)
+
+all_opa = opa.where(opa.appointment_date.is_on_or_after("2018-01-01"))
+
+all_rheum_opa = all_opa.where(all_opa.treatment_function_code.is_in(["410"]))
+
+rheum_pfu = all_rheum_opa.where(all_rheum_opa.outcome_of_attendance.is_in(["4", "5"]))
+
+dataset.define_population(all_rheum_opa.exists_for_patient())
+
+dataset.first_rheum_pfu_date = (
+    rheum_pfu.sort_by(rheum_pfu.appointment_date).first_for_patient().appointment_date
+)
+dataset.sex = patients.sex
+
+# the TPP opa table carries no provider code; the STP of the practice the
+# patient is registered with at their first rheum OPA stands in for it
+dataset.first_rheum_date = (
+    all_rheum_opa.sort_by(all_rheum_opa.appointment_date).first_for_patient().appointment_date
+)
+dataset.practice_stp = practice_registrations.for_patient_on(dataset.first_rheum_date).practice_stp
+
+# one row per appointment
+dataset.add_event_table(
+    "opa",
+    opa_ident=all_opa.opa_ident,
+    appointment_date=all_opa.appointment_date,
+    treatment_function_code=all_opa.treatment_function_code,
+    outcome_of_attendance=all_opa.outcome_of_attendance,
+    attendance_status=all_opa.attendance_status,
+)
@@ -0,0 +1,45 @@
+####################################################################
+#Purpose
+#-------
+#Event-level extract of csDMARD and systemic steroid prescriptions (one row
+#per prescription) for the rheum OPA population, used by
+#treatment_episodes.py to build continuous treatment episodes locally.
+
+#Notes
+#-----
+#- Population mirrors dataset_definition_opa_events.py: anyone with a
+  # rheumatology OPA since 2018-01-01.
+#- The patient-level table carries the anchor dates exposure is evaluated at.
+#- Run with a directory output so both tables are written:
+  # generate-dataset ... --output output/prescriptions:csv.gz
+####################################################################
+
+from ehrql import case, create_dataset, when
+from ehrql.tables.tpp import medications
+
+from codelists import DMARD_codelist, steroid_codelist
+from features import opa
+
+dataset = create_dataset()
+dataset.configure_dummy_data(population_size=2000)
+
+dataset.define_population(opa.all_rheum_opa().exists_for_patient())
+
+dataset.first_opa_date = opa.first_opa_date()
+dataset.first_rheum_date = opa.first_rheum().appointment_date
+dataset.first_rheum_pfu_date = opa.first_rheum_pfu_date()
+
+prescriptions = medications.where(
+    medications.dmd_code.is_in(DMARD_codelist) | medications.dmd_code.is_in(steroid_codelist)
+)
+
+# one row per prescription
+dataset.add_event_table(
+    "prescriptions",
+    date=prescriptions.date,
+    dmd_code=prescriptions.dmd_code,
+    drug_class=case(
+        when(prescriptions.dmd_code.is_in(DMARD_codelist)).then("dmard"),
+        otherwise="steroid",
+    ),
+)
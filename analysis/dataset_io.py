@@ -0,0 +1,70 @@
+#################################################################
+#Purpose
+#-----------
+# Shared helpers for reading the extracted patient-level dataset
+# (output/dataset_definition_rheum.csv.gz) into typed columns for the
+# local Python analysis modules.
+
+#Notes
+#-----
+#- ehrQL writes booleans as "T"/"F" and dates as ISO strings; both are
+  # converted here so downstream code can work with NumPy arrays directly.
+#- Older extracts (output/dataset_rheum.csv) used `first_pfu_date` etc.
+  # instead of the rheum-specific names; `pick_column` resolves aliases.
+#################################################################
+
+import numpy as np
+import pandas as pd
+
+# Default extract written by the generate_dataset_definition_rheum action
+DATASET_PATH = "output/dataset_definition_rheum.csv.gz"
+
+# Monthly measures written by the generate_measures_rheum action
+MEASURES_PATH = "output/measures/measures.csv"
+
+# Start of the study window (features/opa.py applies the same date in ehrQL)
+STUDY_START = "2018-01-01"
+
+# Column aliases between the current definition and the older extract
+COLUMN_ALIASES = {
+    "first_rheum_pfu_date": ["first_pfu_date"],
+    "any_rheum_pfu": ["any_pfu"],
+    "age_opa_group": ["age_group"],
+}
+
+
+def read_dataset(path=DATASET_PATH, columns=None):
+    """Read an ehrQL extract, parsing *_date columns and T/F flags."""
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        for name in columns:
+            wanted.update(COLUMN_ALIASES.get(name, []))
+        usecols = [c for c in header if c in wanted]
+    df = pd.read_csv(path, usecols=usecols, low_memory=False)
+
+    for col in df.columns:
+        if col.endswith("_date") or col in ("dod", "tpp_dod", "ons_dod"):
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        elif df[col].dtype == object or isinstance(df[col].dtype, pd.StringDtype):
+            values = set(df[col].dropna().unique())
+            if values and values <= {"T", "F"}:
+                df[col] = df[col].map({"T": True, "F": False}).fillna(False).astype(bool)
+    return df
+
+
+def pick_column(df, name):
+    """Return the column `name` or its first alias present in df."""
+    for candidate in [name] + COLUMN_ALIASES.get(name, []):
+        if candidate in df.columns:
+            return df[candidate]
+    raise KeyError(f"column {name!r} (or aliases {COLUMN_ALIASES.get(name, [])}) not in dataset")
+
+
+def month_index(dates, start=STUDY_START):
+    """Whole calendar months since `start` (NaT -> -1), as an int array."""
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    start = pd.Timestamp(start)
+    months = (dates.year - start.year) * 12 + (dates.month - start.month)
+    return np.where(dates.isna(), -1, months).astype(np.int64)
@@ -0,0 +1,62 @@
+#################################################################
+#Purpose
+#-----------
+# Statistical disclosure control for the Python stages' moderately
+# sensitive outputs, the counterpart of the `round(count, 5)` step in
+# rheum_table3.do: small counts are suppressed and the rest rounded.
+
+#Notes
+#-----
+#- Counts of 1..REDACT_AT are suppressed (written as empty); 0 is kept.
+#- Remaining counts are rounded to the nearest ROUND_TO (halves up).
+#- Proportions released next to a count must be computed from the
+  # rounded values (see `share`), not from the exact ones.
+#- Step curves (KM, CIF, MCF) released at many time points are built from
+  # `round_cumulative` counts: the running total is rounded UP to a
+  # multiple of CUMULATIVE_STEP, so every released increment is 0 or at
+  # least CUMULATIVE_STEP and no small count can be read off consecutive
+  # rows (the approach of the OpenSAFELY Kaplan-Meier reusable action).
+#################################################################
+
+import numpy as np
+import pandas as pd
+
+REDACT_AT = 7
+ROUND_TO = 5
+# smallest multiple of ROUND_TO above REDACT_AT
+CUMULATIVE_STEP = ROUND_TO * (REDACT_AT // ROUND_TO + 1)
+
+
+def round_counts(counts, redact_at=REDACT_AT, round_to=ROUND_TO):
+    """Float array of rounded counts, NaN where suppressed."""
+    counts = np.asarray(counts, dtype=np.float64)
+    rounded = np.floor(counts / round_to + 0.5) * round_to
+    return np.where((counts > 0) & (counts <= redact_at), np.nan, rounded)
+
+
+def disclose(frame, columns, redact_at=REDACT_AT, round_to=ROUND_TO):
+    """Copy of `frame` with the count columns rounded / suppressed (nullable Int64)."""
+    out = frame.copy()
+    for column in columns:
+        out[column] = pd.array(round_counts(out[column], redact_at, round_to), dtype="Int64")
+    return out
+
+
+def round_cumulative(counts, first=None, step=CUMULATIVE_STEP):
+    """Per-row counts whose running total (restarting where `first`) is rounded up to a multiple of `step`."""
+    counts = np.asarray(counts, dtype=np.float64)
+    if first is None:
+        first = np.zeros(len(counts), bool)
+        first[:1] = True
+    total = np.cumsum(counts)
+    start = np.maximum.accumulate(np.where(first, np.arange(len(counts)), 0))
+    rounded = np.ceil((total - (total - counts)[start]) / step) * step
+    return rounded - np.where(first, 0.0, np.r_[0.0, rounded[:-1]])
+
+
+def share(numerator, denominator):
+    """Proportion of two disclosed counts (NaN if either is suppressed or zero)."""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
@@ -0,0 +1,201 @@
+#################################################################
+#Purpose
+#-----------
+# Two-way fixed-effects (TWFE) event-study regression of monthly OPA counts
+# around each patient's first rheumatology PIFU date. This formalises the
+# no-anticipation check that event_study_plot.do eyeballs from raw counts.
+
+#Model
+#-----
+#  y_it = a_i + g_t + sum_k b_k * 1[t - E_i = k] + e_it
+#- a_i: patient fixed effects, g_t: calendar-month fixed effects
+#- E_i: month of first rheum PIFU (never-PIFU patients have all dummies = 0)
+#- k runs over the event window with binned end points; k = -1 is the reference
+#- Standard errors are clustered by patient.
+
+#Implementation
+#--------------
+#- Fixed effects are absorbed by the within transformation using alternating
+  # projections (demean by patient, then by month, until convergence). Group
+  # means are bincount sums over integer codes, so no patient-dummy matrix
+  # (dense or sparse) is built.
+#- The event-time dummies are never materialised either: each row carries a
+  # single bin code, cross-products are bincounts, and a demeaned column is
+  # stored as its patient/month effects. Memory stays O(n), which is what
+  # lets tens of millions of person-months fit on one machine.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (dataset_definition_opa_events.py)
+#- output/processed/event_study_coefs.csv : event_time, coef, se, lci, uci
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START, month_index
+from output_manager import write_csv
+
+
+# =========================================================
+# Panel construction
+# =========================================================
+def build_person_month_panel(visit_patient, visit_month, patient_ids, treat_month, n_months):
+    """Balanced person-month panel of visit counts.
+
+    visit_patient/visit_month: one entry per visit; patient_ids: cohort ids;
+    treat_month: month index of first PIFU per cohort patient (-1 = never).
+    Returns a dict of flat arrays (patient code, month, y, rel_time).
+    """
+    codes = np.searchsorted(patient_ids, visit_patient)
+    keep = (codes < len(patient_ids)) & (visit_month >= 0) & (visit_month < n_months)
+    keep[keep] &= patient_ids[codes[keep]] == visit_patient[keep]
+
+    y = np.bincount(
+        codes[keep] * n_months + visit_month[keep],
+        minlength=len(patient_ids) * n_months,
+    ).astype(np.float64)
+
+    patient = np.repeat(np.arange(len(patient_ids)), n_months)
+    month = np.tile(np.arange(n_months), len(patient_ids))
+    treat = treat_month[patient]
+    rel_time = np.where(treat >= 0, month - treat, np.iinfo(np.int64).min)
+    return {"patient": patient, "month": month, "y": y, "rel_time": rel_time}
+
+
+def event_time_bins(rel_time, window=(-12, 12), reference=-1):
+    """Column index of each row's event-time dummy (-1 = reference/never).
+
+    End points are binned: rel_time <= lo maps to lo, >= hi maps to hi.
+    """
+    lo, hi = window
+    never = rel_time == np.iinfo(np.int64).min
+    event_times = np.array([k for k in range(lo, hi + 1) if k != reference])
+    lookup = np.full(hi - lo + 1, -1)
+    lookup[event_times - lo] = np.arange(len(event_times))
+    bin_code = lookup[np.clip(rel_time, lo, hi) - lo]
+    return np.where(never, -1, bin_code), event_times
+
+
+# =========================================================
+# Within transformation
+# =========================================================
+def demean(v, groups, tol=1e-8, max_iter=1000):
+    """Alternating projections: sweep out each FE until the update is < tol.
+
+    v is a 1-D array; groups is a list of (codes, n_groups) pairs. Returns the
+    demeaned vector and, for each FE, the accumulated effect per group, so
+    that v - demeaned == sum(effects[j][codes_j]).
+    """
+    v = v.astype(np.float64, copy=True)
+    counts = [np.maximum(np.bincount(codes, minlength=n), 1) for codes, n in groups]
+    effects = [np.zeros(n) for _, n in groups]
+    for _ in range(max_iter):
+        delta = 0.0
+        for (codes, n), c, eff in zip(groups, counts, effects):
+            means = np.bincount(codes, weights=v, minlength=n) / c
+            v -= means[codes]
+            eff += means
+            delta = max(delta, np.abs(means).max())
+        if delta < tol:
+            break
+    return v, effects
+
+
+# =========================================================
+# Estimation
+# =========================================================
+def fit_twfe(y, bin_code, n_bins, patient, month, tol=1e-8):
+    """OLS of y on event-time indicators absorbing patient and month FE.
+
+    bin_code gives each row's event-time column (-1 = none). Only O(n) work
+    arrays are held at once: X'X~ and X'y~ are built from the demeaned
+    columns with bincount, and each demeaned column is kept as its (patient,
+    month) effects so it can be rebuilt for the cluster scores.
+    Returns (beta, vcov) with patient-clustered covariance.
+    """
+    n = len(y)
+    groups = [(patient, patient.max() + 1), (month, month.max() + 1)]
+    n_patients, n_months = groups[0][1], groups[1][1]
+    in_window = bin_code >= 0
+
+    y_t, _ = demean(y, groups, tol)
+    Xty = np.bincount(bin_code[in_window], weights=y_t[in_window], minlength=n_bins)
+
+    XtX = np.zeros((n_bins, n_bins))
+    column_effects = []
+    for k in range(n_bins):
+        x_t, effects = demean((bin_code == k).astype(np.float64), groups, tol)
+        XtX[:, k] = np.bincount(bin_code[in_window], weights=x_t[in_window], minlength=n_bins)
+        column_effects.append(effects)
+    XtX = (XtX + XtX.T) / 2
+
+    bread = np.linalg.pinv(XtX)
+    beta = bread @ Xty
+
+    # residuals: demeaning is linear, so X~ beta = demean(X beta)
+    fitted = np.where(in_window, beta[np.maximum(bin_code, 0)], 0.0)
+    fitted_t, _ = demean(fitted, groups, tol)
+    resid = y_t - fitted_t
+
+    # cluster-robust sandwich; patient FE are nested within clusters so they
+    # are not counted in the degrees-of-freedom correction
+    scores = np.empty((n_patients, n_bins))
+    for k, (a_k, g_k) in enumerate(column_effects):
+        x_t = (bin_code == k) - a_k[patient] - g_k[month]
+        scores[:, k] = np.bincount(patient, weights=x_t * resid, minlength=n_patients)
+    meat = scores.T @ scores
+    dof = (n_patients / (n_patients - 1)) * ((n - 1) / (n - n_bins - (n_months - 1)))
+    vcov = dof * bread @ meat @ bread
+    return beta, vcov
+
+
+def fit_event_study(panel, window=(-12, 12), reference=-1, tol=1e-8):
+    bin_code, event_times = event_time_bins(panel["rel_time"], window, reference)
+    beta, vcov = fit_twfe(panel["y"], bin_code, len(event_times), panel["patient"], panel["month"], tol=tol)
+    se = np.sqrt(np.diag(vcov))
+    out = pd.DataFrame({"event_time": event_times, "coef": beta, "se": se})
+    out["lci"] = out["coef"] - 1.96 * out["se"]
+    out["uci"] = out["coef"] + 1.96 * out["se"]
+    # reference period row, fixed at zero
+    ref = pd.DataFrame({"event_time": [reference], "coef": [0.0], "se": [0.0], "lci": [0.0], "uci": [0.0]})
+    return pd.concat([out, ref]).sort_values("event_time").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TWFE event study of monthly OPAs around first rheum PIFU")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--outcome", choices=["all", "rheum", "nonrheum"], default="all")
+    parser.add_argument("--window", type=int, nargs=2, default=(-12, 12))
+    parser.add_argument("--output", default="output/processed/event_study_coefs.csv")
+    args = parser.parse_args()
+
+    cohort = pd.read_csv(args.cohort, parse_dates=["first_rheum_pfu_date"])
+    cohort = cohort.sort_values("patient_id")
+    events = pd.read_csv(args.events, parse_dates=["appointment_date"], dtype={"treatment_function_code": str})
+    if args.outcome == "rheum":
+        events = events[events["treatment_function_code"] == "410"]
+    elif args.outcome == "nonrheum":
+        events = events[events["treatment_function_code"] != "410"]
+
+    visit_month = month_index(events["appointment_date"], STUDY_START)
+    n_months = int(visit_month.max()) + 1
+    panel = build_person_month_panel(
+        events["patient_id"].to_numpy(),
+        visit_month,
+        cohort["patient_id"].to_numpy(),
+        month_index(cohort["first_rheum_pfu_date"], STUDY_START),
+        n_months,
+    )
+    coefs = fit_event_study(panel, window=tuple(args.window))
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(coefs, args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+#################################################################
+#Purpose
+#-----------
+# Side-effect-free ehrQL feature factories shared by the dataset and
+# measures definitions.
+#   diagnosis     - inflammatory arthritis diagnosis flags / latest category
+#   opa           - outpatient appointment frames and anchors (first OPA, PIFU)
+#   demographics  - sex, age, region, death, ethnicity, language, LD
+#   deprivation   - last address, IMD quintile, rural/urban
+#   medications   - csDMARD / steroid prescriptions
+
+#Notes
+#-----
+#- Every factory is a memoized function: nothing is built until a consumer
+  # calls it, and each series/frame is built once per process however many
+  # consumers use it. Importing a module never touches a Dataset or Measures
+  # object, so measures.py no longer executes the dataset definition.
+#- Submodules are not imported here; import the one you need, e.g.
+  # `from features import diagnosis`.
+#################################################################
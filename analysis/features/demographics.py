@@ -0,0 +1,123 @@
+####################################################################
+#Purpose
+#-------
+#Demographic features anchored at the first OPA (features.opa):
+#sex, age and age bands, practice registration / region, death dates,
+#ethnicity (primary care, falling back to SUS), preferred language and
+#learning disability.
+####################################################################
+
+from functools import cache
+
+from ehrql import case, minimum_of, when
+from ehrql.tables.tpp import clinical_events, ethnicity_from_sus, ons_deaths, patients, practice_registrations
+
+from codelists import ethnicity_codelist, language_codelist, learning_disability_codelist
+from features.opa import first_opa_date, first_rheum_pfu_date
+from variable_functions import AGE_BANDS, to_ehrql
+
+# end of follow-up when neither death nor deregistration is recorded
+FOLLOW_UP_END = "2026-12-31"
+
+
+def age_group(age):
+    """10-year age bands used for the OPA and PFU ages."""
+    return to_ehrql(AGE_BANDS, age)
+
+
+# -------------------------------------------------------------------------
+# Age, registration, death
+# -------------------------------------------------------------------------
+@cache
+def age_opa():
+    return patients.age_on(first_opa_date())
+
+
+@cache
+def age_opa_group():
+    return age_group(age_opa())
+
+
+@cache
+def age_rheum_pfu():
+    return patients.age_on(first_rheum_pfu_date())
+
+
+@cache
+def age_rheum_pfu_group():
+    return age_group(age_rheum_pfu())
+
+
+@cache
+def registration_at_first_opa():
+    return practice_registrations.for_patient_on(first_opa_date())
+
+
+@cache
+def region():
+    return registration_at_first_opa().practice_nuts1_region_name
+
+
+@cache
+def date_of_death():
+    """Earlier of the TPP and ONS death dates."""
+    return minimum_of(patients.date_of_death, ons_deaths.date)
+
+
+@cache
+def fu_days():
+    """Days from first rheum PIFU to death, deregistration or end of follow-up."""
+    end = minimum_of(date_of_death(), registration_at_first_opa().end_date, FOLLOW_UP_END)
+    return (end - first_rheum_pfu_date()).days
+
+
+# -------------------------------------------------------------------------
+# Ethnicity
+# -------------------------------------------------------------------------
+@cache
+def ethnicity():
+    """6-group ethnicity at the first OPA; SUS code if none in primary care."""
+    latest_code = (
+        clinical_events.where(clinical_events.snomedct_code.is_in(ethnicity_codelist))
+        .where(clinical_events.date.is_on_or_before(first_opa_date()))
+        .sort_by(clinical_events.date)
+        .last_for_patient().snomedct_code.to_category(ethnicity_codelist)
+    )
+    sus = ethnicity_from_sus.code
+    return case(
+        when((latest_code == "1") | (latest_code.is_null() & sus.is_in(["A", "B", "C"]))).then("White"),
+        when((latest_code == "2") | (latest_code.is_null() & sus.is_in(["D", "E", "F", "G"]))).then("Mixed"),
+        when((latest_code == "3") | (latest_code.is_null() & sus.is_in(["H", "J", "K", "L"]))).then("Asian or Asian British"),
+        when((latest_code == "4") | (latest_code.is_null() & sus.is_in(["M", "N", "P"]))).then("Black or Black British"),
+        when((latest_code == "5") | (latest_code.is_null() & sus.is_in(["R", "S"]))).then("Chinese or Other Ethnic Groups"),
+        otherwise="Unknown",
+    )
+
+
+# -------------------------------------------------------------------------
+# Preferred language, learning disability (records on/before first OPA)
+# -------------------------------------------------------------------------
+@cache
+def language_codes():
+    return clinical_events.where(
+        clinical_events.snomedct_code.is_in(language_codelist)
+        & clinical_events.date.is_on_or_before(first_opa_date())
+    )
+
+
+@cache
+def latest_language():
+    return language_codes().sort_by(clinical_events.date).last_for_patient()
+
+
+@cache
+def learning_disability_codes():
+    return clinical_events.where(
+        clinical_events.snomedct_code.is_in(learning_disability_codelist)
+        & clinical_events.date.is_on_or_before(first_opa_date())
+    )
+
+
+@cache
+def latest_learning_disability():
+    return learning_disability_codes().sort_by(clinical_events.date).last_for_patient()
@@ -0,0 +1,41 @@
+####################################################################
+#Purpose
+#-------
+#Socio-economic features from the last address on or before the first OPA:
+#IMD (rounded rank), IMD quintile and rural/urban classification.
+#Source: https://docs.opensafely.org/ehrql/reference/schemas/tpp/
+####################################################################
+
+from functools import cache
+
+from ehrql.tables.tpp import addresses
+
+from features.opa import first_opa_date
+from variable_functions import IMD_QUINTILES, to_ehrql
+
+
+@cache
+def last_address():
+    """Built once and shared by IMD and rural/urban."""
+    return (
+        addresses
+        .where(addresses.start_date.is_on_or_before(first_opa_date()))
+        .sort_by(addresses.start_date)
+        .last_for_patient()
+    )
+
+
+@cache
+def imd_rounded():
+    return last_address().imd_rounded
+
+
+@cache
+def imd_quintile():
+    """Fixed cutpoints on N_LSOA (variable_functions.IMD_QUINTILES)."""
+    return to_ehrql(IMD_QUINTILES, imd_rounded())
+
+
+@cache
+def rural_urban_classification():
+    return last_address().rural_urban_classification
@@ -0,0 +1,144 @@
+####################################################################
+#Purpose
+#-------
+#Inflammatory arthritis (IA) diagnosis features.
+#- SNOMED codes from primary care (clinical_events)
+#- ICD-10 codes from secondary care (apcs); admission_date is used as the
+  # diagnosis date for APCS events
+#- The latest diagnosis is the later of the latest GP and APCS records;
+  # its source and category are derived from whichever was chosen.
+####################################################################
+
+from functools import cache
+
+from ehrql import case, when
+from ehrql.tables.tpp import apcs, clinical_events
+
+from codelists import (
+    axialspa_icd10_codelist,
+    eia_icd10_codelist,
+    eia_snomed_categories,
+    eia_snomed_codelist,
+    psa_icd10_codelist,
+    rheumatoid_icd10_codelist,
+)
+
+
+# -------------------------------------------------------------------------
+# Ever diagnosed
+# -------------------------------------------------------------------------
+@cache
+def has_gp_diagnosis():
+    return clinical_events.where(
+        clinical_events.snomedct_code.is_in(eia_snomed_codelist)
+    ).exists_for_patient()
+
+
+@cache
+def has_apcs_diagnosis():
+    # primary, secondary and all_diagnoses slots
+    # https://docs.opensafely.org/ehrql/reference/schemas/tpp/#apcs
+    return (
+        apcs.where(apcs.primary_diagnosis.is_in(eia_icd10_codelist)).exists_for_patient()
+        | apcs.where(apcs.secondary_diagnosis.is_in(eia_icd10_codelist)).exists_for_patient()
+        | apcs.where(apcs.all_diagnoses.contains_any_of(eia_icd10_codelist)).exists_for_patient()
+    )
+
+
+@cache
+def has_any_diagnosis():
+    """Diagnosis in either primary OR secondary care (ever)."""
+    return has_gp_diagnosis() | has_apcs_diagnosis()
+
+
+# -------------------------------------------------------------------------
+# Latest diagnosis
+# -------------------------------------------------------------------------
+@cache
+def latest_gp_diag():
+    return (
+        clinical_events
+        .where(clinical_events.snomedct_code.is_in(eia_snomed_codelist))
+        .sort_by(clinical_events.date)
+        .last_for_patient()
+    )
+
+
+@cache
+def latest_gp_diag_cat():
+    # eia_snomed_categories is {"rheumatoid": [code1, code2], ...}
+    code_to_category = {
+        code: cat
+        for cat, codes in eia_snomed_categories.items()
+        for code in codes
+    }
+    return latest_gp_diag().snomedct_code.to_category(code_to_category)
+
+
+@cache
+def latest_apc_diag():
+    return (
+        apcs
+        .where(
+            apcs.primary_diagnosis.is_in(eia_icd10_codelist)
+            | apcs.secondary_diagnosis.is_in(eia_icd10_codelist)
+            | apcs.all_diagnoses.contains_any_of(eia_icd10_codelist)
+        )
+        .sort_by(apcs.admission_date)
+        .last_for_patient()
+    )
+
+
+@cache
+def latest_apc_diag_code():
+    # prefer primary diagnosis if present, otherwise secondary
+    diag = latest_apc_diag()
+    return case(
+        when(diag.primary_diagnosis.is_not_null()).then(diag.primary_diagnosis),
+        when(diag.secondary_diagnosis.is_not_null()).then(diag.secondary_diagnosis),
+        otherwise=None,
+    )
+
+
+@cache
+def latest_apc_diag_cat():
+    # heuristic ICD-10 categorisation by searching `all_diagnoses`
+    all_diagnoses = latest_apc_diag().all_diagnoses
+    return case(
+        when(all_diagnoses.contains_any_of(rheumatoid_icd10_codelist)).then("rheumatoid"),
+        when(all_diagnoses.contains_any_of(psa_icd10_codelist)).then("psa"),
+        when(all_diagnoses.contains_any_of(axialspa_icd10_codelist)).then("axialspa"),
+        otherwise=None,
+    )
+
+
+@cache
+def latest_diag_date():
+    gp_date = latest_gp_diag().date
+    apc_date = latest_apc_diag().admission_date
+    return case(
+        # both present -> choose later date
+        when(gp_date.is_not_null() & apc_date.is_not_null() & (gp_date >= apc_date)).then(gp_date),
+        when(gp_date.is_not_null() & apc_date.is_not_null() & (apc_date > gp_date)).then(apc_date),
+        when(gp_date.is_not_null()).then(gp_date),
+        when(apc_date.is_not_null()).then(apc_date),
+        otherwise=None,
+    )
+
+
+@cache
+def latest_diag_source():
+    return case(
+        when(latest_diag_date() == latest_gp_diag().date).then("primary_care"),
+        when(latest_diag_date() == latest_apc_diag().admission_date).then("secondary_care"),
+        otherwise=None,
+    )
+
+
+@cache
+def latest_diag_category():
+    return case(
+        when(latest_diag_source() == "primary_care").then(latest_gp_diag_cat()),
+        when(latest_diag_source() == "secondary_care").then(latest_apc_diag_cat()),
+        otherwise=None,
+    )
@@ -0,0 +1,32 @@
+####################################################################
+#Purpose
+#-------
+#csDMARD and steroid prescription features (medications table, any date).
+####################################################################
+
+from functools import cache
+
+from ehrql.tables.tpp import medications
+
+from codelists import DMARD_codelist, steroid_codelist
+
+
+@cache
+def dmard_records():
+    return medications.where(medications.dmd_code.is_in(DMARD_codelist))
+
+
+@cache
+def dmard_by_date():
+    """Sorted once, shared by the first and last prescription."""
+    return dmard_records().sort_by(medications.date)
+
+
+@cache
+def steroid_records():
+    return medications.where(medications.dmd_code.is_in(steroid_codelist))
+
+
+@cache
+def steroid_by_date():
+    return steroid_records().sort_by(medications.date)
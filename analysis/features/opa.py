@@ -0,0 +1,74 @@
+####################################################################
+#Purpose
+#-------
+#Outpatient appointment (OPA) frames and the patient-level anchors derived
+#from them: first OPA since 2018-01-01, first rheumatology OPA, first
+#rheumatology personalised follow-up (PFU/PIFU) and non-rheum visits.
+####################################################################
+
+from functools import cache
+
+from ehrql.tables.tpp import opa
+
+# treatment_function_code that identifies a rheumatology appointment
+RHEUM_TRT_CODES = ["410"]
+# outcome_of_attendance codes 4/5 - moved / discharged to personalised follow-up
+PIFU_OUTCOME_CODES = ["4", "5"]
+STUDY_START = "2018-01-01"
+
+
+@cache
+def all_opa():
+    """Every OPA since 2018-01-01 (attended or not)."""
+    return opa.where(
+        opa.appointment_date.is_on_or_after(STUDY_START)
+        # & opa.attendance_status.is_in(["5","6"]) # re-enable to restrict to attended only
+    )
+
+
+@cache
+def first_opa():
+    return all_opa().sort_by(opa.appointment_date).first_for_patient()
+
+
+@cache
+def first_opa_date():
+    """Anchor for age, region, registration and the demographic lookbacks."""
+    return first_opa().appointment_date
+
+
+@cache
+def all_rheum_opa():
+    return all_opa().where(opa.treatment_function_code.is_in(RHEUM_TRT_CODES))
+
+
+@cache
+def first_rheum():
+    return all_rheum_opa().sort_by(opa.appointment_date).first_for_patient()
+
+
+@cache
+def rheum_pfu():
+    return all_rheum_opa().where(opa.outcome_of_attendance.is_in(PIFU_OUTCOME_CODES))
+
+
+@cache
+def first_rheum_pfu_date():
+    return rheum_pfu().sort_by(opa.appointment_date).first_for_patient().appointment_date
+
+
+@cache
+def all_non_rheum_opa():
+    """Non-rheum OPAs (any date); missing/blank treatment codes count as non-rheum."""
+    return opa.where(
+        opa.treatment_function_code.is_null()
+        | (opa.treatment_function_code == "")
+        | (opa.treatment_function_code == " ")
+        | (~opa.treatment_function_code.is_in(RHEUM_TRT_CODES))
+    )
+
+
+@cache
+def non_rheum_opa_by_date():
+    """Sorted once, shared by the first and last non-rheum visit dates."""
+    return all_non_rheum_opa().sort_by(opa.appointment_date)
@@ -0,0 +1,166 @@
+#################################################################
+#Purpose
+#-----------
+# Segmented-regression interrupted time series (ITS) for every monthly
+# series in measures.csv (each measure x stratum), fitted in one batch.
+
+#Model (per series)
+#------------------
+#  y_t = b0 + b1 * t + sum_k [ level_k * 1(t >= T_k) + slope_k * (t - T_k) * 1(t >= T_k) ] + e_t
+#- t counts months from the first interval; T_k are the breakpoints.
+#- Default breakpoints follow the `covid_phase` cuts in dataset_definition_rheum.py
+  # (peri: 2020-01-01, post: 2022-01-01); add a PIFU rollout date with --breakpoint.
+#- Newey-West (HAC) standard errors with Bartlett weights.
+
+#Implementation
+#--------------
+#- Series are read from the measures cache (measures_cache.py) and stacked
+  # into one (months x series) matrix Y with a validity mask W. The design
+  # X (months x p) is shared, so X'WX, X'Wy, residuals and
+  # the HAC meat are computed for every series at once with einsum and a
+  # single batched np.linalg.solve; there is no per-series loop.
+
+#Inputs / Outputs
+#----------------
+#- output/measures/measures.csv (generate_measures_rheum), via the measures cache
+#- output/processed/its_coefficients.csv : one row per series x term
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from dataset_io import MEASURES_PATH
+from measures_cache import CACHE_DIR, ensure_cache, read_measures
+from output_manager import write_csv
+
+DEFAULT_BREAKPOINTS = {
+    "covid_peri": "2020-01-01",
+    "covid_post": "2022-01-01",
+}
+
+
+# =========================================================
+# Data
+# =========================================================
+def series_matrix(partitions, value="mean_per_patient"):
+    """Stack cached partitions to (months x series); returns Y, mask, periods, keys."""
+    blocks, keys = [], []
+    for name, part in partitions.items():
+        blocks.append(getattr(part, value))
+        labels = pd.DataFrame(part.group_labels, columns=part.group_columns)
+        labels.insert(0, "measure", name)
+        keys.append(labels)
+    Y = np.hstack(blocks)
+    mask = ~np.isnan(Y)
+    keys = pd.concat(keys, ignore_index=True)
+    periods = next(iter(partitions.values())).periods
+    return np.where(mask, Y, 0.0), mask, periods, keys
+
+
+def segmented_design(periods, breakpoints):
+    """Shared design matrix (months x p) and its term names."""
+    periods = pd.DatetimeIndex(periods)
+    t = np.arange(len(periods), dtype=np.float64)
+    columns, names = [np.ones_like(t), t], ["intercept", "trend"]
+    for name, date in breakpoints.items():
+        after = periods >= pd.Timestamp(date)
+        if not after.any() or after.all():
+            continue
+        t0 = t[after.argmax()]
+        columns += [after.astype(np.float64), np.where(after, t - t0, 0.0)]
+        names += [f"level_{name}", f"slope_{name}"]
+    return np.column_stack(columns), names
+
+
+# =========================================================
+# Batched least squares with Newey-West SEs
+# =========================================================
+def newey_west_lag(n_periods):
+    return int(np.floor(4 * (n_periods / 100) ** (2 / 9)))
+
+
+def fit_batch(X, Y, mask, lag=None):
+    """Fit every column of Y on X at once; returns coef, se, dof (series-first).
+
+    Missing months (mask False) are dropped from both the fit and the HAC
+    sums. Series whose valid months do not identify every parameter (too
+    few months, or none on one side of a breakpoint) get NaN.
+    """
+    n, p = X.shape
+    W = mask.astype(np.float64)
+    if lag is None:
+        lag = newey_west_lag(n)
+
+    XtWX = np.einsum("tp,ts,tq->spq", X, W, X)
+    XtWy = np.einsum("tp,ts->sp", X, W * Y)
+    n_valid = W.sum(axis=0)
+    ok = n_valid > p
+    ok[ok] = np.linalg.matrix_rank(XtWX[ok]) == p
+
+    bread = np.zeros_like(XtWX)
+    bread[ok] = np.linalg.inv(XtWX[ok])
+    coef = np.einsum("spq,sq->sp", bread, XtWy)
+    resid = (Y - X @ coef.T) * W
+
+    # HAC meat: sum over lags of Bartlett-weighted score autocovariances
+    U = X[:, None, :] * resid[:, :, None]              # (months, series, p)
+    meat = np.einsum("tsp,tsq->spq", U, U)
+    for ell in range(1, lag + 1):
+        w = 1 - ell / (lag + 1)
+        gamma = np.einsum("tsp,tsq->spq", U[ell:], U[:-ell])
+        meat += w * (gamma + gamma.transpose(0, 2, 1))
+
+    vcov = bread @ meat @ bread
+    se = np.sqrt(np.clip(np.einsum("spp->sp", vcov), 0, None))
+    coef[~ok] = np.nan
+    se[~ok] = np.nan
+    return coef, se, n_valid - p
+
+
+def fit_its(partitions, breakpoints=DEFAULT_BREAKPOINTS, value="mean_per_patient", lag=None):
+    """Tidy ITS results for every measure x stratum series in the partitions."""
+    Y, mask, periods, keys = series_matrix(partitions, value)
+    X, terms = segmented_design(periods, breakpoints)
+    coef, se, dof = fit_batch(X, Y, mask, lag)
+
+    n_series, p = coef.shape
+    out = keys.loc[np.repeat(np.arange(n_series), p)].reset_index(drop=True)
+    out["term"] = np.tile(terms, n_series)
+    out["coef"] = coef.ravel()
+    out["se"] = se.ravel()
+    out["t"] = out["coef"] / out["se"]
+    out["p_value"] = 2 * stats.t.sf(np.abs(out["t"]), np.repeat(np.maximum(dof, 1), p))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched segmented-regression ITS over measures.csv")
+    parser.add_argument("--measures", default=MEASURES_PATH)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--value", choices=["mean_per_patient", "numerator"], default="mean_per_patient")
+    parser.add_argument("--breakpoint", action="append", default=[], metavar="NAME=YYYY-MM-DD",
+                        help="extra breakpoint, e.g. pifu_rollout=2022-06-01")
+    parser.add_argument("--no-default-breakpoints", action="store_true")
+    parser.add_argument("--lag", type=int, default=None, help="Newey-West lag (default: 4(T/100)^(2/9))")
+    parser.add_argument("--output", default="output/processed/its_coefficients.csv")
+    args = parser.parse_args()
+
+    breakpoints = {} if args.no_default_breakpoints else dict(DEFAULT_BREAKPOINTS)
+    for item in args.breakpoint:
+        name, date = item.split("=", 1)
+        breakpoints[name] = date
+
+    manifest = ensure_cache(args.measures, args.cache_dir)
+    partitions = read_measures(manifest["measures"], args.cache_dir)
+    results = fit_its(partitions, breakpoints, args.value, args.lag)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(results, args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
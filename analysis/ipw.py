@@ -0,0 +1,230 @@
+#################################################################
+#Purpose
+#-----------
+# Propensity scores and inverse-probability weights for PIFU
+# (`any_rheum_pfu`) vs non-PIFU comparisons, with covariate balance
+# diagnostics before and after weighting.
+
+#High-level logic
+#----------------
+#- Design: categorical covariates are one-hot coded straight into a sparse
+  # CSR matrix (one non-zero per patient per covariate, missing = its own
+  # level). Numeric covariates are standardised and missing values are
+  # imputed with the mean plus a missing indicator.
+#- Model: L2-penalised logistic regression fitted by L-BFGS. Loss and
+  # gradient need only the sparse products X b and X'(p - y), so millions of
+  # patients fit in seconds with no dense design.
+#- Weights: stabilised ATE weights P(T)/ps and (1 - P(T))/(1 - ps), or ATT
+  # weights (1 for PIFU patients, ps/(1 - ps) for controls). Weights are
+  # also truncated at the --trim / 1 - --trim quantiles; both are written.
+#- Balance: standardised mean differences for every design column at once,
+  # from weighted column sums X'w per group, unweighted and under each
+  # weight. All SMDs use the unweighted pooled SD.
+
+#Notes
+#-----
+#- `before_1yr`..`before_3yr` are NOT in the default model: in
+  # variable_functions.py they are anchored on the first PIFU date, so for
+  # controls they are 0 / missing by construction and separate the groups
+  # perfectly. Add them with --numeric once a comparable index date exists
+  # for controls (e.g. from matching.py).
+#- The balance table is released: for indicator columns (categorical
+  # levels, missing flags) the group counts are rounded / suppressed
+  # (disclosure.py), the means are taken from the rounded counts, and the
+  # SMDs of a level with a suppressed count are blanked.
+
+#Inputs / Outputs
+#----------------
+#- output/dataset_definition_rheum.csv.gz (generate_dataset_definition_rheum)
+#- output/processed/ipw_weights.csv.gz  : patient_id, ps, weight, weight_trimmed
+#- output/processed/ipw_balance.csv     : counts, means and SMD per covariate level, before / after
+#- output/processed/ipw_coefficients.csv : fitted log-odds per design column
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import optimize, sparse
+from scipy.special import expit
+
+from dataset_io import DATASET_PATH, pick_column, read_dataset
+from disclosure import round_counts, share
+from output_manager import write_csv
+
+TREATMENT = "any_rheum_pfu"
+CATEGORICAL = [
+    "sex", "ethnicity", "imd_quintile", "rural_urban_classification",
+    "latest_diag_category", "ever_on_DMARD", "ever_on_steroids",
+]
+NUMERIC = ["age_opa"]
+
+
+# =========================================================
+# Sparse design
+# =========================================================
+def design_matrix(df, categorical=CATEGORICAL, numeric=NUMERIC):
+    """Sparse CSR design (no intercept) and its column names."""
+    blocks, names = [], []
+    n = len(df)
+    for column in categorical:
+        codes, levels = pd.factorize(df[column].astype(object).fillna("missing"), sort=True)
+        blocks.append(sparse.csr_matrix((np.ones(n), (np.arange(n), codes)), shape=(n, len(levels))))
+        names += [f"{column}={level}" for level in levels]
+    for column in numeric:
+        values = pd.to_numeric(df[column], errors="coerce").to_numpy(np.float64)
+        missing = np.isnan(values)
+        mean = np.nanmean(values) if (~missing).any() else 0.0
+        sd = np.nanstd(values) if (~missing).any() else 0.0
+        values = (np.where(missing, mean, values) - mean) / (sd if sd > 0 else 1.0)
+        blocks.append(sparse.csr_matrix(values[:, None]))
+        names.append(column)
+        if missing.any():
+            blocks.append(sparse.csr_matrix(missing[:, None].astype(np.float64)))
+            names.append(f"{column}=missing")
+    return sparse.hstack(blocks, format="csr"), names
+
+
+# =========================================================
+# Model
+# =========================================================
+def fit_logistic(X, y, penalty=1.0):
+    """L2-penalised logistic regression (intercept unpenalised); returns (intercept, coefs)."""
+    n, p = X.shape
+    Xt = X.T.tocsr()
+
+    def loss(beta):
+        eta = beta[0] + X @ beta[1:]
+        # log(1 + e^eta) - y * eta, computed stably
+        nll = np.sum(np.logaddexp(0.0, eta) - y * eta) / n
+        resid = (expit(eta) - y) / n
+        grad = np.concatenate(([resid.sum()], Xt @ resid + penalty / n * beta[1:]))
+        return nll + 0.5 * penalty / n * beta[1:] @ beta[1:], grad
+
+    start = np.zeros(p + 1)
+    start[0] = np.log(y.mean() / (1 - y.mean()))
+    result = optimize.minimize(loss, start, jac=True, method="L-BFGS-B", options={"maxiter": 500})
+    if not result.success:
+        print(f"warning: propensity model did not converge ({result.message})")
+    return result.x[0], result.x[1:]
+
+
+def propensity(X, intercept, coefs):
+    return expit(intercept + X @ coefs)
+
+
+def ipw_weights(t, ps, estimand="ate"):
+    """Stabilised ATE weights, or ATT weights."""
+    if estimand == "att":
+        return np.where(t, 1.0, ps / (1 - ps))
+    p_treated = t.mean()
+    return np.where(t, p_treated / ps, (1 - p_treated) / (1 - ps))
+
+
+def trim_weights(w, trim=0.01):
+    """Truncate weights at the trim and 1 - trim quantiles."""
+    return np.clip(w, *np.quantile(w, [trim, 1 - trim])) if trim > 0 else w
+
+
+def effective_sample_size(w):
+    return w.sum() ** 2 / (w**2).sum()
+
+
+# =========================================================
+# Balance
+# =========================================================
+def _group_moments(X, w):
+    """Weighted mean and variance of every column."""
+    total = w.sum()
+    mean = np.asarray(X.T @ w).ravel() / total
+    second = np.asarray(X.multiply(X).T @ w).ravel() / total
+    return mean, np.maximum(second - mean**2, 0.0)
+
+
+def balance(X, names, t, weights):
+    """SMD per design column: unweighted, then one column per {name: weights}."""
+    treated, control = X[t], X[~t]
+    m1, v1 = _group_moments(treated, np.ones(treated.shape[0]))
+    m0, v0 = _group_moments(control, np.ones(control.shape[0]))
+    pooled = np.sqrt((v1 + v0) / 2)
+    pooled = np.where(pooled > 0, pooled, np.inf)   # constant columns -> SMD 0
+    report = pd.DataFrame({
+        "covariate": names,
+        "mean_pifu": m1, "mean_control": m0,
+        "smd_unweighted": (m1 - m0) / pooled,
+    })
+    for name, w in weights.items():
+        wm1, _ = _group_moments(treated, w[t])
+        wm0, _ = _group_moments(control, w[~t])
+        report[f"smd_{name}"] = (wm1 - wm0) / pooled
+    return report
+
+
+def disclose_balance(report, X, t):
+    """Balance table for release: rounded level counts, means from them, SMDs blanked if suppressed."""
+    report = report.copy()
+    indicator = report["covariate"].str.contains("=", regex=False).to_numpy()
+    counts = {
+        "pifu": round_counts(np.asarray(X[t].sum(axis=0)).ravel()),
+        "control": round_counts(np.asarray(X[~t].sum(axis=0)).ravel()),
+    }
+    totals = {"pifu": round_counts(t.sum()), "control": round_counts((~t).sum())}
+    for group, n in counts.items():
+        report.insert(report.columns.get_loc(f"mean_{group}"), f"n_{group}", np.where(indicator, n, np.nan))
+        report[f"mean_{group}"] = np.where(indicator, share(n, totals[group]), report[f"mean_{group}"])
+    suppressed = indicator & (np.isnan(counts["pifu"]) | np.isnan(counts["control"]))
+    smd = [c for c in report.columns if c.startswith("smd_")]
+    report.loc[suppressed, smd] = np.nan
+    report.loc[suppressed, ["mean_pifu", "mean_control"]] = np.nan
+    for group in counts:
+        report[f"n_{group}"] = pd.array(report[f"n_{group}"], dtype="Int64")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Propensity-score / IPW weights for PIFU vs non-PIFU")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--estimand", choices=["ate", "att"], default="ate")
+    parser.add_argument("--penalty", type=float, default=1.0, help="L2 penalty (ridge) on the coefficients")
+    parser.add_argument("--trim", type=float, default=0.01, help="truncate weights at this quantile and 1 - it")
+    parser.add_argument("--numeric", nargs="*", default=NUMERIC,
+                        help="numeric covariates (before_1yr.. only with a control index date)")
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    df = read_dataset(args.dataset, columns=["patient_id", TREATMENT] + CATEGORICAL + args.numeric)
+    categorical = [c for c in CATEGORICAL if c in df.columns]
+    numeric = [c for c in args.numeric if c in df.columns]
+    skipped = sorted(set(CATEGORICAL + args.numeric) - set(categorical + numeric))
+    if skipped:
+        print(f"not in extract, skipped: {', '.join(skipped)}")
+
+    t = pick_column(df, TREATMENT).astype(bool).to_numpy()
+    X, names = design_matrix(df, categorical, numeric)
+    intercept, coefs = fit_logistic(X, t.astype(np.float64), args.penalty)
+    ps = propensity(X, intercept, coefs)
+    w = ipw_weights(t, ps, args.estimand)
+    w_trimmed = trim_weights(w, args.trim)
+    report = balance(X, names, t, {"weighted": w, "trimmed": w_trimmed})
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    weights = pd.DataFrame({"patient_id": df["patient_id"], "ps": ps, "weight": w, "weight_trimmed": w_trimmed})
+    write_csv(
+        weights.round(6), outdir / "ipw_weights.csv.gz", index=False, compression={"method": "gzip", "compresslevel": 1}
+    )
+    write_csv(disclose_balance(report, X, t), outdir / "ipw_balance.csv", index=False)
+    write_csv(
+        pd.DataFrame({"term": ["(intercept)"] + names, "log_odds": np.r_[intercept, coefs]}),
+        outdir / "ipw_coefficients.csv", index=False,
+    )
+    n_pifu, n_control = round_counts([t.sum(), (~t).sum()])
+    print(f"{n_pifu:.0f} PIFU / {n_control:.0f} control patients (rounded), {X.shape[1]} design columns")
+    print(f"ESS: PIFU {effective_sample_size(w[t]):.0f}, control {effective_sample_size(w[~t]):.0f}")
+    print(f"max |SMD|: unweighted {report['smd_unweighted'].abs().max():.3f}, "
+          f"weighted {report['smd_weighted'].abs().max():.3f}, trimmed {report['smd_trimmed'].abs().max():.3f}")
+
+
+if __name__ == "__main__":
+    main()
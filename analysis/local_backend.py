@@ -0,0 +1,231 @@
+#################################################################
+#Purpose
+#-----------
+# Local, indexed stand-in backend for the TPP tables this project uses, so
+# dataset_definition_rheum.py and measures.py can be run at realistic
+# volumes without the network and without `configure_dummy_data` (which
+# in metadata/generate_dataset_rheum.log needed 60s for 3,762 patients and
+# still gave up).
+
+#High-level logic
+#----------------
+#- One SQLite file holds the tables, named as in ehrql.tables.tpp:
+  # patients, practice_registrations, clinical_events, apcs, opa,
+  # medications, addresses, ons_deaths, ethnicity_from_sus.
+#- Tables are bulk-loaded from <table>.csv[.gz] or <table>.parquet (same
+  # layout as ehrQL `--dummy-tables`, e.g. from `ehrql create-dummy-tables`)
+  # in chunks with journalling off. Indexes are built after the load.
+  # Indexes: (patient_id, <event date>) on every event table, the code
+  # columns the definitions filter on, and unique patient_id on the
+  # patient-level tables.
+#- Dates are stored as ISO text, booleans as 0/1 and empty CSV cells as
+  # NULL, matching how ehrQL's SQLite query engine reads them.
+#- Definitions then run against it with ehrQL's SQLite query engine, which
+  # hands the DSN to SQLAlchemy, so it is a sqlite:/// URL (see `dsn`):
+  #   ehrql generate-dataset analysis/dataset_definition_rheum.py \
+  #       --dsn sqlite:///output/local_backend.sqlite --query-engine sqlite --output ...
+  #   ehrql generate-measures analysis/measures.py \
+  #       --dsn sqlite:///output/local_backend.sqlite --query-engine sqlite --output ...
+
+#Usage
+#-----
+# python analysis/local_backend.py --source dummy_tables --db output/local_backend.sqlite
+# python analysis/local_backend.py --db output/local_backend.sqlite --info
+#################################################################
+
+import argparse
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DB_PATH = "output/local_backend.sqlite"
+
+# table -> (event date column or None for patient-level tables, indexed code columns)
+TABLES = {
+    "patients": (None, []),
+    "ons_deaths": (None, []),
+    "ethnicity_from_sus": (None, ["code"]),
+    "practice_registrations": ("start_date", []),
+    "clinical_events": ("date", ["snomedct_code"]),
+    "medications": ("date", ["dmd_code"]),
+    "apcs": ("admission_date", ["primary_diagnosis", "secondary_diagnosis"]),
+    "opa": ("appointment_date", ["treatment_function_code", "outcome_of_attendance"]),
+    "addresses": ("start_date", []),
+}
+
+INTEGER_COLUMNS = {
+    "patient_id", "opa_ident", "apcs_ident", "address_id", "practice_pseudo_id",
+    "imd_rounded", "rural_urban_classification",
+}
+REAL_COLUMNS = {"numeric_value"}
+BOOLEAN_COLUMNS = {"has_postcode", "care_home_is_potential_match", "care_home_requires_nursing",
+                   "care_home_does_not_require_nursing", "first_attendance"}
+TRUE_VALUES = {"T", "True", "true", "1"}
+
+
+def dsn(db_path):
+    """SQLAlchemy URL for ehrQL's --dsn (relative paths stay relative to the working directory)."""
+    return f"sqlite:///{Path(db_path).as_posix()}"
+
+
+def column_type(name):
+    if name in INTEGER_COLUMNS or name in BOOLEAN_COLUMNS:
+        return "INTEGER"
+    if name in REAL_COLUMNS:
+        return "REAL"
+    return "TEXT"
+
+
+def source_files(source_dir):
+    """{table: path} for the tables this project uses."""
+    files = {}
+    for path in sorted(Path(source_dir).iterdir()):
+        table = path.name.split(".", 1)[0]
+        if table in TABLES and path.name.endswith((".csv", ".csv.gz", ".parquet")):
+            files[table] = path
+    return files
+
+
+def read_chunks(path, chunksize):
+    if path.name.endswith(".parquet"):
+        # optional dependency, only needed for Parquet sources
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            frame = batch.to_pandas(date_as_object=False)
+            for column in frame.select_dtypes("datetime").columns:
+                frame[column] = frame[column].dt.strftime("%Y-%m-%d")
+            yield frame
+    else:
+        # numbers parsed by the C reader; everything else kept as the exact text
+        header = pd.read_csv(path, nrows=0).columns
+        dtypes = {c: "float64" if c in INTEGER_COLUMNS or c in REAL_COLUMNS else str for c in header}
+        numeric = {c: [""] for c in header if c in INTEGER_COLUMNS or c in REAL_COLUMNS}
+        yield from pd.read_csv(path, dtype=dtypes, keep_default_na=False, na_values=numeric, chunksize=chunksize)
+
+
+def to_rows(chunk):
+    """DataFrame chunk -> list of tuples in SQLite storage form."""
+    columns = []
+    for name in chunk.columns:
+        if name in INTEGER_COLUMNS or name in REAL_COLUMNS:
+            numbers = pd.to_numeric(chunk[name], errors="coerce")
+            missing = numbers.isna().to_numpy()
+            kind = np.int64 if name in INTEGER_COLUMNS else np.float64
+            values = numbers.fillna(0).to_numpy(kind).astype(object)
+        else:
+            values = chunk[name].to_numpy(dtype=object, copy=True)
+            missing = pd.isna(values) | (values == "")
+            if name in BOOLEAN_COLUMNS:
+                values = np.isin(values.astype(str), list(TRUE_VALUES)).astype(np.int64).astype(object)
+        values[missing] = None
+        columns.append(values.tolist())
+    return list(zip(*columns))
+
+
+# =========================================================
+# Load / index
+# =========================================================
+def connect(db_path, bulk=False):
+    con = sqlite3.connect(db_path)
+    if bulk:
+        con.execute("PRAGMA journal_mode=OFF")
+        con.execute("PRAGMA synchronous=OFF")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-1000000")
+    return con
+
+
+def load_table(con, table, path, chunksize=200_000):
+    """(Re)create one table and bulk-insert it; returns the row count."""
+    n_rows, columns = 0, None
+    con.execute(f'DROP TABLE IF EXISTS "{table}"')
+    for chunk in read_chunks(path, chunksize):
+        if columns is None:
+            columns = list(chunk.columns)
+            if "patient_id" not in columns:
+                raise ValueError(f"{path} has no patient_id column")
+            ddl = ", ".join(f'"{c}" {column_type(c)}' for c in columns)
+            con.execute(f'CREATE TABLE "{table}" ({ddl})')
+            insert = f'INSERT INTO "{table}" VALUES ({", ".join("?" * len(columns))})'
+        con.executemany(insert, to_rows(chunk[columns]))
+        n_rows += len(chunk)
+    con.commit()
+    return n_rows
+
+
+def create_indexes(con, table):
+    date_column, code_columns = TABLES[table]
+    existing = {row[1] for row in con.execute(f'PRAGMA table_info("{table}")')}
+    if date_column is None:
+        con.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "ix_{table}_patient" ON "{table}" (patient_id)')
+    elif date_column in existing:
+        con.execute(
+            f'CREATE INDEX IF NOT EXISTS "ix_{table}_patient_date" ON "{table}" (patient_id, "{date_column}")'
+        )
+    else:
+        con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_patient" ON "{table}" (patient_id)')
+    for column in code_columns:
+        if column in existing:
+            con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{column}" ON "{table}" ("{column}")')
+
+
+def build_backend(source_dir, db_path=DB_PATH, tables=None, chunksize=200_000):
+    """Load every available source table into db_path; returns {table: rows}."""
+    files = source_files(source_dir)
+    if tables:
+        files = {t: p for t, p in files.items() if t in tables}
+    missing = sorted(set(tables or TABLES) - set(files))
+    if missing:
+        print(f"no source file for: {', '.join(missing)}")
+
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    con = connect(db_path, bulk=True)
+    counts = {}
+    try:
+        for table, path in files.items():
+            start = time.perf_counter()
+            counts[table] = load_table(con, table, path, chunksize)
+            create_indexes(con, table)
+            print(f"{table}: {counts[table]} rows in {time.perf_counter() - start:.1f}s")
+        con.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+    return counts
+
+
+def describe(db_path=DB_PATH):
+    con = connect(db_path)
+    try:
+        for (table,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"):
+            if table.startswith("sqlite_"):
+                continue
+            n = con.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            indexes = [r[1] for r in con.execute(f'PRAGMA index_list("{table}")')]
+            print(f"{table}: {n} rows; indexes: {', '.join(indexes) or '-'}")
+    finally:
+        con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the local indexed SQLite backend for the TPP tables")
+    parser.add_argument("--source", help="directory of <table>.csv[.gz] / <table>.parquet files")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--tables", nargs="*", choices=sorted(TABLES), help="only (re)load these tables")
+    parser.add_argument("--chunksize", type=int, default=200_000)
+    parser.add_argument("--info", action="store_true", help="print row counts and indexes")
+    args = parser.parse_args()
+
+    if args.source:
+        build_backend(args.source, args.db, args.tables, args.chunksize)
+        print(f"run definitions with: --dsn {dsn(args.db)} --query-engine sqlite")
+    if args.info or not args.source:
+        describe(args.db)
+
+
+if __name__ == "__main__":
+    main()
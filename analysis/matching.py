@@ -0,0 +1,201 @@
+#################################################################
+#Purpose
+#-----------
+# Matched control selection for PIFU patients. Every case (a patient with
+# a rheum PIFU outcome) gets up to --ratio controls who match on age band,
+# sex, `latest_diag_category` and region, and who had a rheum OPA in the
+# same calendar month as the case's index OPA (or within --caliper-days).
+
+#High-level logic
+#----------------
+#- Index date of a case = `first_rheum_pfu_date`.
+#- Candidate control visits = rheum OPAs (from the opa_events extract, or
+  # `first_rheum_date` alone if no event table is given).
+#- Risk set (incidence density): a control must be at risk on the case's
+  # index date - not yet on PIFU, still alive and still registered. A
+  # control may become a case later.
+#- Index: visits are sorted by (exact-match key, day). A dict maps each
+  # exact key to its code; the window of every case is located with one
+  # vectorised searchsorted (bisect) on the sorted (key, day) array, so no
+  # case scans the control pool.
+#- Sampling: cases in index-date order (ties in random order). The visits
+  # in a case's window are reduced to distinct patients before drawing, so
+  # every eligible patient has the same chance whatever their number of
+  # visits. With --reuse-controls a patient may serve as a control for more
+  # than one case.
+
+#Inputs / Outputs
+#----------------
+#- output/dataset_definition_rheum.csv.gz (generate_dataset_definition_rheum)
+#- output/opa_events/opa.csv.gz (generate_opa_events), optional
+#- output/processed/matched_sets.csv.gz : one row per case / control
+#- output/processed/matching_summary.csv : cases by number of controls found
+  # (released: counts rounded / suppressed by disclosure.disclose)
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import DATASET_PATH, read_dataset
+from disclosure import disclose, round_counts
+from output_manager import write_csv
+
+RHEUM_TRT_CODE = "410"
+MATCH_ON = ["age_opa_group", "sex", "latest_diag_category", "region"]
+NO_DATE = np.iinfo(np.int64).max
+
+
+def _days(dates):
+    """Days since 1970-01-01 (NaT -> NO_DATE)."""
+    values = pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]")
+    return np.where(np.isnat(values), NO_DATE, values.astype(np.int64))
+
+
+# =========================================================
+# Control index
+# =========================================================
+def control_visits(cohort, events=None):
+    """(patient row, day) of every rheum OPA that can index a control."""
+    if events is None:
+        rows = np.arange(len(cohort))
+        days = _days(cohort["first_rheum_date"])
+    else:
+        rheum = events[events["treatment_function_code"] == RHEUM_TRT_CODE]
+        rows = pd.Index(cohort["patient_id"]).get_indexer(rheum["patient_id"])
+        keep = rows >= 0
+        rows, days = rows[keep], _days(rheum["appointment_date"])[keep]
+    dated = days < NO_DATE
+    return rows[dated], days[dated]
+
+
+def exit_days(cohort):
+    """First day each patient leaves the risk set: PIFU, death or deregistration."""
+    exit_day = np.full(len(cohort), NO_DATE)
+    for column in ("first_rheum_pfu_date", "dod", "deregister_date"):
+        if column in cohort.columns:
+            exit_day = np.minimum(exit_day, _days(cohort[column]))
+    return exit_day
+
+
+class ControlIndex:
+    """Control visits sorted by (exact key, day) with a key -> code hash map."""
+
+    def __init__(self, cohort, rows, days, match_on=MATCH_ON):
+        keys = pd.MultiIndex.from_frame(cohort[match_on].astype(str).fillna(""))
+        key_code, uniques = pd.factorize(keys)
+        self.codes = {key: code for code, key in enumerate(uniques)}
+        self.key_of_row = key_code
+
+        order = np.lexsort((days, key_code[rows]))
+        self.patient = rows[order]
+        self.day = days[order]
+        self._sort_key = key_code[rows][order] * (1 << 32) + self.day
+
+    def windows(self, keys, start, stop):
+        """[lo, hi) slices of visits with the given key and start <= day <= stop."""
+        code = np.array([self.codes.get(k, -1) for k in keys], dtype=np.int64)
+        lo = np.searchsorted(self._sort_key, code * (1 << 32) + start, side="left")
+        hi = np.searchsorted(self._sort_key, code * (1 << 32) + stop, side="right")
+        return np.where(code >= 0, lo, 0), np.where(code >= 0, hi, 0)
+
+
+# =========================================================
+# Sampling
+# =========================================================
+def _draw(lo, hi, k, case_day, exclude, used, exit_day, patient, rng):
+    """Up to k distinct patients from patient[lo:hi], at risk on case_day, at random."""
+    candidates = np.unique(patient[lo:hi])
+    eligible = (exit_day[candidates] > case_day) & ~used[candidates] & (candidates != exclude)
+    candidates = candidates[eligible]
+    if len(candidates) > k:
+        candidates = rng.choice(candidates, size=k, replace=False)
+    return [int(p) for p in candidates]
+
+
+def match(cohort, events=None, ratio=4, caliper_days=None, reuse_controls=False, seed=2018):
+    """Matched sets: one row per case and per selected control."""
+    rows, days = control_visits(cohort, events)
+    index = ControlIndex(cohort, rows, days)
+    exit_day = exit_days(cohort)
+
+    case_rows = np.flatnonzero(cohort["first_rheum_pfu_date"].notna().to_numpy())
+    case_day = _days(cohort["first_rheum_pfu_date"])[case_rows]
+    if caliper_days is None:
+        month = cohort["first_rheum_pfu_date"].iloc[case_rows].dt.to_period("M")
+        start = _days(month.dt.start_time)
+        stop = _days(month.dt.end_time.dt.normalize())
+    else:
+        start, stop = case_day - caliper_days, case_day + caliper_days
+
+    keys = list(pd.MultiIndex.from_frame(cohort[MATCH_ON].iloc[case_rows].astype(str).fillna("")))
+    lo, hi = index.windows(keys, start, stop)
+
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(case_rows)), case_day))
+    used = np.zeros(len(cohort), dtype=bool)
+    set_id, patient_row, is_case, index_day = [], [], [], []
+    for s, i in enumerate(order):
+        controls = _draw(lo[i], hi[i], ratio, case_day[i], case_rows[i], used, exit_day, index.patient, rng)
+        if not reuse_controls:
+            used[controls] = True
+        members = [int(case_rows[i])] + controls
+        set_id += [s] * len(members)
+        patient_row += members
+        is_case += [True] + [False] * len(controls)
+        index_day += [case_day[i]] * len(members)
+
+    patient_row = np.asarray(patient_row, dtype=np.int64)
+    sets = pd.DataFrame({
+        "set_id": set_id,
+        "patient_id": cohort["patient_id"].to_numpy()[patient_row],
+        "case": is_case,
+        "index_date": np.asarray(index_day, dtype="datetime64[D]"),
+    })
+    for column in MATCH_ON:
+        sets[column] = cohort[column].to_numpy()[patient_row]
+    return sets
+
+
+def summary(sets, ratio):
+    """Number of cases by number of controls found."""
+    found = sets.groupby("set_id")["case"].size() - 1
+    counts = found.value_counts().reindex(range(ratio + 1), fill_value=0)
+    return pd.DataFrame({"controls_found": counts.index, "cases": counts.to_numpy()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact / caliper matched controls for PIFU patients")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--events", help="opa event table (default: first rheum OPA only)")
+    parser.add_argument("--ratio", type=int, default=4, help="controls per case")
+    parser.add_argument("--caliper-days", type=int,
+                        help="match within +/- N days of the index date instead of the calendar month")
+    parser.add_argument("--reuse-controls", action="store_true")
+    parser.add_argument("--seed", type=int, default=2018)
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    columns = ["patient_id", "first_rheum_date", "first_rheum_pfu_date", "dod", "deregister_date"] + MATCH_ON
+    cohort = read_dataset(args.dataset, columns=columns)
+    events = None
+    if args.events:
+        events = pd.read_csv(args.events, usecols=["patient_id", "appointment_date", "treatment_function_code"],
+                             dtype={"treatment_function_code": str})
+    sets = match(cohort, events, args.ratio, args.caliper_days, args.reuse_controls, args.seed)
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    write_csv(sets, outdir / "matched_sets.csv.gz", index=False)
+    report = summary(sets, args.ratio)
+    report = disclose(report, ["cases"])
+    write_csv(report, outdir / "matching_summary.csv", index=False)
+    n_cases, n_controls = round_counts([sets["case"].sum(), (~sets["case"]).sum()])
+    print(f"{n_cases:.0f} cases, {n_controls:.0f} controls (rounded)")
+    print(report.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
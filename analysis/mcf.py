@@ -0,0 +1,231 @@
+#################################################################
+#Purpose
+#-----------
+# Mean cumulative function (MCF) of outpatient visits around the move to
+# rheumatology PIFU, split into rheum (treatment_function_code "410") and
+# non-rheum OPAs and compared across PIFU entry cohorts (calendar year of
+# `first_rheum_pfu_date`). This replaces the single-number before_1yr /
+# after_1yr summaries with the whole accumulation curve.
+
+#High-level logic
+#----------------
+#- Time is days relative to first_rheum_pfu_date, from -pre to +post. The
+  # PIFU appointment itself (day 0) is the index event and is not counted.
+#- A patient is observed from max(study start, PIFU - pre) to the end of
+  # follow-up (`fu_days` from the rheum extract if given, else the last
+  # date in the event table), capped at PIFU + post.
+#- Single sweep over a (series x day) grid, series = entry cohort x
+  # specialty: visits and entries/exits are placed on the grid with
+  # bincount, the number at risk is a cumulative sum of entries minus exits,
+  # and MCF(t) = cumsum(visits / at risk) (Nelson-Aalen type estimator).
+#- Bootstrap bands: patients are resampled with replacement (multinomial
+  # weights), which only reweights the same bincounts. Replicates run in
+  # worker processes that open the visit arrays memory-mapped.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (generate_opa_events)
+#- output/dataset_definition_rheum.csv.gz, optional, for fu_days
+#- output/processed/mcf.csv : cohort x specialty x day, with bootstrap band
+  # (released: built by `release_mcf` from disclosure.round_cumulative visit
+  # counts and rounded at-risk counts, only on days where the released
+  # visits change plus the first day and day 0)
+#################################################################
+
+import argparse
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START, read_dataset
+from disclosure import round_counts, round_cumulative
+from output_manager import write_csv
+
+RHEUM_TRT_CODE = "410"
+SPECIALTIES = ["rheum", "non_rheum"]
+
+# memory-mapped arrays, opened once per worker process
+_arrays = {}
+
+
+# =========================================================
+# Grid
+# =========================================================
+def build_arrays(cohort, events, follow_up_days=None, pre=365, post=730):
+    """Visit cells and patient entry/exit cells on the (series x day) grid."""
+    pfu = cohort["first_rheum_pfu_date"].to_numpy("datetime64[D]")
+    entry_cohort = cohort["first_rheum_pfu_date"].dt.year.to_numpy()
+    years = np.unique(entry_cohort)
+    n_days = pre + post + 1                       # day -pre .. +post
+
+    data_end = events["appointment_date"].max().to_datetime64().astype("datetime64[D]")
+    end = np.full(len(cohort), data_end)
+    if follow_up_days is not None:
+        known = ~np.isnan(follow_up_days)
+        end[known] = np.minimum(end[known], pfu[known] + follow_up_days[known].astype("timedelta64[D]"))
+    start_day = np.maximum(np.datetime64(STUDY_START, "D") - pfu, -pre).astype(np.int64)
+    exit_day = np.minimum((end - pfu).astype(np.int64), post)
+
+    code = pd.Index(cohort["patient_id"]).get_indexer(events["patient_id"])
+    rel = (events["appointment_date"].to_numpy("datetime64[D]") - pfu[np.maximum(code, 0)]).astype(np.int64)
+    keep = (code >= 0) & (rel != 0) & (rel >= start_day[np.maximum(code, 0)]) & (rel <= exit_day[np.maximum(code, 0)])
+    specialty = np.where(events["treatment_function_code"].to_numpy() == RHEUM_TRT_CODE, 0, 1)
+
+    patient_series = np.searchsorted(years, entry_cohort) * len(SPECIALTIES)
+    return {
+        "visit_patient": code[keep],
+        "visit_cell": (patient_series[code[keep]] + specialty[keep]) * n_days + rel[keep] + pre,
+        "patient_series": patient_series,
+        "entry": start_day + pre,
+        "exit": exit_day + pre,
+        "shape": np.array([len(years) * len(SPECIALTIES), n_days]),
+    }, years
+
+
+def mcf(arrays, weights=None):
+    """(series x day) MCF, visits and number at risk for one set of patient weights."""
+    n_series, n_days = (int(x) for x in arrays["shape"])
+    w = np.ones(len(arrays["entry"])) if weights is None else weights
+    observed = np.asarray(arrays["exit"]) >= np.asarray(arrays["entry"])
+    series = np.asarray(arrays["patient_series"])
+
+    visits = np.bincount(
+        arrays["visit_cell"], weights=w[arrays["visit_patient"]], minlength=n_series * n_days
+    ).reshape(n_series, n_days)
+    # at risk = running sum of entries minus exits; every patient is at risk
+    # in both specialty series of its cohort
+    size = n_series * (n_days + 1)
+    rows = series[observed] * (n_days + 1)
+    w_obs = w[observed]
+    change = (
+        np.bincount(rows + np.asarray(arrays["entry"])[observed], weights=w_obs, minlength=size)
+        - np.bincount(rows + np.asarray(arrays["exit"])[observed] + 1, weights=w_obs, minlength=size)
+    ).reshape(n_series, n_days + 1)[::len(SPECIALTIES)]
+    at_risk = np.repeat(np.cumsum(change, axis=1)[:, :n_days], len(SPECIALTIES), axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(at_risk > 0, visits / at_risk, 0.0)
+    return np.cumsum(rate, axis=1), visits, at_risk
+
+
+# =========================================================
+# Bootstrap
+# =========================================================
+def write_arrays(arrays, workdir):
+    for name, values in arrays.items():
+        np.save(Path(workdir) / f"{name}.npy", values)
+
+
+def _open_arrays(workdir):
+    for path in Path(workdir).glob("*.npy"):
+        _arrays[path.stem] = np.load(path, mmap_mode="r")
+
+
+def _replicate(seed):
+    rng = np.random.default_rng(seed)
+    n = len(_arrays["entry"])
+    weights = np.bincount(rng.integers(n, size=n), minlength=n).astype(np.float64)
+    return mcf(_arrays, weights)[0]
+
+
+def bootstrap(arrays, n_boot=200, n_jobs=1, seed=2018, level=0.95):
+    """Pointwise percentile band of the MCF over patient resamples."""
+    seeds = np.random.SeedSequence(seed).generate_state(n_boot)
+    with tempfile.TemporaryDirectory() as workdir:
+        write_arrays(arrays, workdir)
+        with Pool(n_jobs, initializer=_open_arrays, initargs=(workdir,)) as pool:
+            replicates = np.stack(pool.map(_replicate, seeds))
+    alpha = (1 - level) / 2
+    return np.quantile(replicates, [alpha, 1 - alpha], axis=0)
+
+
+def tidy(years, pre, curve, visits, at_risk, band=None):
+    n_series, n_days = curve.shape
+    series = np.repeat(np.arange(n_series), n_days)
+    out = pd.DataFrame({
+        "cohort": years[series // len(SPECIALTIES)],
+        "specialty": np.array(SPECIALTIES)[series % len(SPECIALTIES)],
+        "day": np.tile(np.arange(n_days) - pre, n_series),
+        "at_risk": at_risk.ravel().astype(np.int64),
+        "visits": visits.ravel().astype(np.int64),
+        "mcf": curve.ravel(),
+        # visits accumulated since PIFU (MCF(t) - MCF(0))
+        "mcf_post": (curve - curve[:, [pre]]).ravel(),
+    })
+    if band is not None:
+        out["mcf_lci"] = band[0].ravel()
+        out["mcf_uci"] = band[1].ravel()
+    return out
+
+
+def release_mcf(out):
+    """mcf.csv for release: the MCF recomputed from rounded counts.
+
+    Visits are rounded with disclosure.round_cumulative per series and the
+    number at risk with round_counts. After a visit on a day whose risk set
+    is suppressed the rest of that series is blank. The bootstrap band keeps
+    its width around the released MCF.
+    """
+    days = np.sort(out["day"].unique())
+    shape = (len(out) // len(days), len(days))
+    first = np.zeros(shape, bool)
+    first[:, 0] = True
+    visits = round_cumulative(out["visits"], first.ravel()).reshape(shape)
+    at_risk = round_counts(out["at_risk"]).reshape(shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curve = np.cumsum(np.where(visits > 0, visits / at_risk, 0.0), axis=1)
+    zero = np.searchsorted(days, 0)
+
+    released = out[["cohort", "specialty", "day"]].assign(
+        at_risk=pd.array(at_risk.ravel(), dtype="Int64"),
+        visits=visits.ravel().astype(np.int64),
+        mcf=curve.ravel(),
+        mcf_post=(curve - curve[:, [zero]]).ravel(),
+    )
+    if "mcf_lci" in out.columns:
+        released["mcf_lci"] = released["mcf"] - (out["mcf"] - out["mcf_lci"])
+        released["mcf_uci"] = released["mcf"] + (out["mcf_uci"] - out["mcf"])
+    keep = (visits.ravel() > 0) | first.ravel() | (out["day"].to_numpy() == 0)
+    return released[keep].reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mean cumulative function of OPAs around first rheum PIFU")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--dataset", help="rheum extract with fu_days, for censoring")
+    parser.add_argument("--pre", type=int, default=365, help="days before PIFU")
+    parser.add_argument("--post", type=int, default=730, help="days after PIFU")
+    parser.add_argument("--boot", type=int, default=200, help="bootstrap replicates (0 = none)")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=2018)
+    parser.add_argument("--output", default="output/processed/mcf.csv")
+    args = parser.parse_args()
+
+    cohort = pd.read_csv(args.cohort, usecols=["patient_id", "first_rheum_pfu_date"],
+                         parse_dates=["first_rheum_pfu_date"])
+    cohort = cohort[cohort["first_rheum_pfu_date"].notna()].reset_index(drop=True)
+    events = pd.read_csv(args.events, usecols=["patient_id", "appointment_date", "treatment_function_code"],
+                         dtype={"treatment_function_code": str}, parse_dates=["appointment_date"])
+    events = events[events["appointment_date"].notna()]
+
+    follow_up = None
+    if args.dataset:
+        fu = read_dataset(args.dataset, columns=["patient_id", "fu_days"]).set_index("patient_id")["fu_days"]
+        follow_up = cohort["patient_id"].map(fu).to_numpy(np.float64)
+
+    arrays, years = build_arrays(cohort, events, follow_up, args.pre, args.post)
+    curve, visits, at_risk = mcf(arrays)
+    band = bootstrap(arrays, args.boot, args.jobs, args.seed) if args.boot else None
+    out = tidy(years, args.pre, curve, visits, at_risk, band)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(release_mcf(out), args.output, index=False)
+    n_patients, n_visits = round_counts([len(cohort), len(arrays["visit_cell"])])
+    print(f"{n_patients:.0f} PIFU patients in {len(years)} entry cohort(s), {n_visits:.0f} visits (rounded)")
+
+
+if __name__ == "__main__":
+    main()
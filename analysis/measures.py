@@ -38,31 +38,13 @@ from ehrql.tables.tpp import (
     patients,
     practice_registrations,
     opa,
-    clinical_events,
-    apcs,
-    ethnicity_from_sus,
-    addresses,
-    ons_deaths,
 )
 
 
-#project-specific data definition:from analysis/datadefinition_rheum
-from dataset_definition_rheum import (
-latest_diag_category,
-ethnicity,
-region,
-imd_quintile,
-rural_urban_classification,
-)
-
-#Codelists used for diagnosis and demographic mappings 
-from codelists import (
-    ethnicity_codelist, language_codelist, learning_disability_codelist, bmi_codelist, 
-    rheumatoid_snomed_codelist, rheumatoid_icd10_codelist,
-    psa_snomed_codelist, psa_icd10_codelist,
-    axialspa_snomed_codelist, axialspa_icd10_codelist,
-    undiff_eia_codelist, eia_snomed_codelist, eia_icd10_codelist ,eia_snomed_categories
-)
+#Shared stratifiers and diagnosis flag: memoized feature factories (analysis/features).
+#Only the features used here are built; the dataset definition is not executed.
+from features import demographics, deprivation, diagnosis
+from variable_functions import MEASURES_AGE_BANDS, to_ehrql
 
 #======================================================
 #Constants & code-based definitions
@@ -99,22 +81,8 @@ has_rheum_appt_in_interval = opa.where(
 # -------------------------
 # Diagnosis definitions
 # -------------------------
-# Primary care (GP) diagnosis: any clinical event with a matching SNOMED code (ever)
-has_gp_diagnosis = clinical_events.where(
-    clinical_events.snomedct_code.is_in(eia_snomed_codelist)   
-).exists_for_patient()
-
-# Secondary care (APCS) diagnosis: check primary, secondary and all_diagnoses fields
-# This covers hospital-coded ICD-10 entries in any diagnosis slot
-#from here: https://docs.opensafely.org/ehrql/reference/schemas/tpp/#apcs
-has_apcs_diagnosis = (
-    apcs.where(apcs.primary_diagnosis.is_in(eia_icd10_codelist)).exists_for_patient()
-    | apcs.where(apcs.secondary_diagnosis.is_in(eia_icd10_codelist)).exists_for_patient()
-    | apcs.where(apcs.all_diagnoses.contains_any_of(eia_icd10_codelist)).exists_for_patient()
-)
-
 # Combined diagnosis: either primary care OR secondary care diagnosis (ever/any time in their history)
-has_any_diagnosis = has_gp_diagnosis | has_apcs_diagnosis
+has_any_diagnosis = diagnosis.has_any_diagnosis()
 
 
 
@@ -199,17 +167,7 @@ count_all_opa_post_pifu = post_pifu_all_opa.opa_ident.count_distinct_for_patient
 age = patients.age_on(INTERVAL.start_date)
 
 # Create age bands (strings) for grouping. Any patient under 18 will fall outside denominator.
-age_band = case(  
-    when((age >= 18) & (age <= 29)).then("age_18_29"),
-    when((age >= 30) & (age <= 39)).then("age_30_39"),
-    when((age >= 40) & (age <= 49)).then("age_40_49"),
-    when((age >= 50) & (age <= 59)).then("age_50_59"),
-    when((age >= 60) & (age <= 69)).then("age_60_69"),
-    when((age >= 70) & (age <= 79)).then("age_70_79"),
-    when((age >= 80) & (age <= 89)).then("age_80_89"),
-    when((age >= 90)).then("age_90+"),
-    otherwise="missing",
-)
+age_band = to_ehrql(MEASURES_AGE_BANDS, age)
 
 # Sex mapping: keep male/female labels, collapse NULL/other to "other"
 sex = case(
@@ -217,8 +175,11 @@ sex = case(
     when((patients.sex == "female")).then("female"),
     otherwise="other",
 )
-# Other demographic stratifiers — imported from dataset_definition_rheum:
-# latest_diag_category, ethnicity, imd_quintile, rural_urban_classification
+# Other demographic stratifiers (anchored at the first OPA) from the feature modules
+latest_diag_category = diagnosis.latest_diag_category()
+ethnicity = demographics.ethnicity()
+imd_quintile = deprivation.imd_quintile()
+rural_urban_classification = deprivation.rural_urban_classification()
 
 # ======================
 # Measures configuration
@@ -365,7 +326,7 @@ measures.define_measure(
 
 
 #----------------------------------------
-# Group by most recent diagnosis category (stratifier imported from dataset_definition_rheum)
+# Group by most recent diagnosis category
 #----------------------------------------
 
 
@@ -377,7 +338,7 @@ measures.define_measure(
 )
 
 
-# Group by ethnicity (imported stratifier) 
+# Group by ethnicity
 measures.define_measure(
     name="count_all_opa_by_ethnicity",
     numerator=count_all_opa,
@@ -387,7 +348,7 @@ measures.define_measure(
 
 
 #----------------------------------------
-# Group by IMD quintile (imported)
+# Group by IMD quintile
 #----------------------------------------
 
 measures.define_measure(
@@ -398,7 +359,7 @@ measures.define_measure(
 )
 
 #----------------------------------------
-# Group by rural / urban classification (imported)
+# Group by rural / urban classification
 #----------------------------------------
 
 measures.define_measure(
@@ -0,0 +1,189 @@
+#################################################################
+#Purpose
+#-----------
+# Parse output/measures/measures.csv ONCE into typed columns and write a
+# wide, measure-partitioned binary cache for the plotting / table consumers
+# (render_figures.py, interrupted_time_series.py, ...).
+# resource_use_graphs.do re-imports the CSV with stringcols(_all), runs real()
+# and then keep/collapse/reshape for every single plot; with the cache each
+# consumer loads only the measures it needs, already numeric and wide.
+
+#Cache layout
+#------------
+#- <cache_dir>/manifest.json : source hash, period axis, measure -> group columns
+#- <cache_dir>/<measure>.npz : one partition per measure, arrays
+  #   periods           (P,)    datetime64[D] interval_start (shared axis)
+  #   group_labels      (G, K)  str, one row per stratum (K group columns)
+  #   numerator         (P, G)  float64
+  #   denominator       (P, G)  float64
+  #   mean_per_patient  (P, G)  numerator / denominator (visits per patient)
+#- Unstratified measures have one stratum with K = 0.
+#- Partitions are plain .npz arrays (no pickle), so reading involves no text
+  # parsing at all.
+#################################################################
+
+import argparse
+import hashlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import MEASURES_PATH
+from output_manager import atomic_path, write_text
+
+CACHE_DIR = "output/measures/cache"
+MANIFEST = "manifest.json"
+
+# columns written by ehrQL Measures; anything else is a grouping column
+MEASURE_COLUMNS = ["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator"]
+
+
+@dataclass
+class MeasurePartition:
+    name: str
+    periods: pd.DatetimeIndex
+    group_columns: list
+    group_labels: np.ndarray
+    numerator: np.ndarray
+    denominator: np.ndarray
+    mean_per_patient: np.ndarray
+
+    def series_names(self):
+        if not self.group_columns:
+            return [self.name]
+        return [" / ".join(row) for row in self.group_labels]
+
+    def frame(self, field="numerator"):
+        """period x stratum DataFrame of one field."""
+        return pd.DataFrame(getattr(self, field), index=self.periods, columns=self.series_names())
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_measures(path=MEASURES_PATH):
+    """Single typed parse of measures.csv."""
+    header = pd.read_csv(path, nrows=0).columns
+    group_cols = [c for c in header if c not in MEASURE_COLUMNS]
+    dtypes = {"measure": "category", "numerator": np.float64, "denominator": np.float64}
+    dtypes.update({c: "string" for c in group_cols})
+    df = pd.read_csv(path, dtype=dtypes, usecols=lambda c: c not in ("interval_end", "ratio"),
+                     parse_dates=["interval_start"])
+    return df, group_cols
+
+
+def build_cache(path=MEASURES_PATH, cache_dir=CACHE_DIR):
+    """Write one .npz partition per measure plus the manifest."""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    df, group_cols = parse_measures(path)
+
+    periods = np.sort(df["interval_start"].unique())
+    period_code = np.searchsorted(periods, df["interval_start"].to_numpy())
+    manifest = {
+        "source": str(path),
+        "source_sha256": file_hash(path),
+        "periods": [str(p)[:10] for p in periods.astype("datetime64[D]")],
+        "measures": {},
+    }
+
+    for name, rows in df.groupby("measure", observed=True, sort=False):
+        idx = rows.index.to_numpy()
+        used = [c for c in group_cols if rows[c].notna().any()]
+        if used:
+            labels = rows[used].fillna("missing").astype(str)
+            group_code, uniques = pd.MultiIndex.from_frame(labels).factorize()
+            group_labels = np.array(list(uniques), dtype=str).reshape(len(uniques), len(used))
+        else:
+            group_code = np.zeros(len(rows), dtype=np.int64)
+            group_labels = np.empty((1, 0), dtype=str)
+
+        shape = (len(periods), len(group_labels))
+        numerator = np.full(shape, np.nan)
+        denominator = np.full(shape, np.nan)
+        # duplicate (period, stratum) rows are summed, as collapse (sum) does
+        cells = period_code[idx] * shape[1] + group_code
+        for target, column in ((numerator, "numerator"), (denominator, "denominator")):
+            values = rows[column].to_numpy()
+            present = ~np.isnan(values)
+            sums = np.bincount(cells[present], weights=values[present], minlength=target.size)
+            seen = np.bincount(cells[present], minlength=target.size) > 0
+            target.ravel()[seen] = sums[seen]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.where(denominator > 0, numerator / denominator, np.nan)
+
+        with atomic_path(cache_dir / f"{name}.npz") as tmp:
+            np.savez(
+                tmp,
+                periods=periods.astype("datetime64[D]"),
+                group_labels=group_labels,
+                numerator=numerator,
+                denominator=denominator,
+                mean_per_patient=mean,
+            )
+        manifest["measures"][name] = {"group_columns": used, "n_groups": len(group_labels)}
+
+    write_text(cache_dir / MANIFEST, json.dumps(manifest, indent=2))
+    return manifest
+
+
+def read_manifest(cache_dir=CACHE_DIR):
+    path = Path(cache_dir) / MANIFEST
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def ensure_cache(path=MEASURES_PATH, cache_dir=CACHE_DIR):
+    """Rebuild the cache only if it is missing or measures.csv changed."""
+    manifest = read_manifest(cache_dir)
+    if manifest is None or manifest["source_sha256"] != file_hash(path):
+        manifest = build_cache(path, cache_dir)
+    return manifest
+
+
+def read_measure(name, cache_dir=CACHE_DIR, manifest=None):
+    manifest = manifest or read_manifest(cache_dir)
+    if name not in manifest["measures"]:
+        raise KeyError(f"measure {name!r} not in cache {cache_dir}")
+    with np.load(Path(cache_dir) / f"{name}.npz") as npz:
+        return MeasurePartition(
+            name=name,
+            periods=pd.DatetimeIndex(npz["periods"]),
+            group_columns=manifest["measures"][name]["group_columns"],
+            group_labels=npz["group_labels"],
+            numerator=npz["numerator"],
+            denominator=npz["denominator"],
+            mean_per_patient=npz["mean_per_patient"],
+        )
+
+
+def read_measures(names, cache_dir=CACHE_DIR):
+    """Load only the requested partitions, as {name: MeasurePartition}."""
+    manifest = read_manifest(cache_dir)
+    return {name: read_measure(name, cache_dir, manifest) for name in names if name in manifest["measures"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the measure-partitioned measures.csv cache")
+    parser.add_argument("--measures", default=MEASURES_PATH)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    if args.force:
+        manifest = build_cache(args.measures, args.cache_dir)
+    else:
+        manifest = ensure_cache(args.measures, args.cache_dir)
+    print(f"{len(manifest['measures'])} measure partition(s) in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
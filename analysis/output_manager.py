@@ -0,0 +1,269 @@
+#################################################################
+#Purpose
+#-----------
+# One way for the Python stages to write outputs: every file is streamed
+# to a per-writer temp file next to its target and committed with an
+# atomic rename plus a content-hash manifest entry. Interrupted writers
+# leave only temp files behind (never a truncated output), and those are
+# swept the next time anything writes to the directory.
+
+#High-level logic
+#----------------
+#- atomic_path(target) yields `<stem>.<host>-<pid>-<rand>.tmp<suffixes>`
+  # in the target's directory (same filesystem, so the rename is atomic;
+  # the real suffixes are kept so pandas / NumPy / matplotlib infer the
+  # same format and compression). On success the temp is fsynced, hashed
+  # and os.replace()d onto the target; on error it is removed.
+#- The manifest is one JSON entry per output under output/.manifest/, so
+  # independent actions never write the same manifest file and nothing
+  # locks the output tree. Only the rename + entry of a single output is
+  # serialised (per-output lock file, where fcntl is available).
+#- The first write into a directory sweeps stale temps there: those of a
+  # dead process on this host, or any temp older than STALE_AFTER seconds
+  # (including legacy `<name>.<hex>.tmp` files from earlier writers).
+
+#Notes
+#-----
+#- Only declared outputs leave an OpenSAFELY job, so on the backend the
+  # manifest covers the writes of the current job; locally it accumulates.
+#- Scratch files in temporary directories do not go through here. Scratch
+  # files under output/ that are removed later (e.g. the shard tables of
+  # sharded_extract.py) are written with manifest=False: still renamed
+  # atomically, but not recorded, so --verify does not report them missing.
+
+#Usage
+#-----
+# from output_manager import atomic_path, write_csv
+# write_csv(frame, "output/processed/x.csv", index=False)
+# with atomic_path("output/processed/x.npz") as tmp:
+  #     np.savez(tmp, ...)
+# python analysis/output_manager.py --sweep output   # remove stale temps
+# python analysis/output_manager.py --verify         # re-hash against the manifest
+#################################################################
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import secrets
+import socket
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: renames stay atomic, same-output commits are not serialised
+    fcntl = None
+
+MANIFEST_DIR = "output/.manifest"
+STALE_AFTER = 12 * 3600
+
+HOST = re.sub(r"[^A-Za-z0-9]", "", socket.gethostname()) or "host"
+TEMP = re.compile(r"^(?P<stem>.+)\.(?P<host>[A-Za-z0-9]+)-(?P<pid>\d+)-[0-9a-f]{8}\.tmp(?P<suffixes>(\.[^.]+)*)$")
+LEGACY_TEMP = re.compile(r"(\.tmp|\.tmp\.[^.]+)$")
+
+_swept = set()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _key(path):
+    """Manifest key: the target path relative to the working directory."""
+    path = Path(os.path.abspath(path))
+    try:
+        return path.relative_to(Path.cwd()).as_posix()
+    except ValueError:
+        return path.as_posix()
+
+
+def _entry_path(key, manifest_dir=MANIFEST_DIR):
+    return Path(manifest_dir) / f"{hashlib.sha1(key.encode()).hexdigest()[:16]}.json"
+
+
+def temp_path(target):
+    target = Path(target)
+    suffixes = "".join(target.suffixes)
+    stem = target.name[: len(target.name) - len(suffixes)] if suffixes else target.name
+    return target.with_name(f"{stem}.{HOST}-{os.getpid()}-{secrets.token_hex(4)}.tmp{suffixes}")
+
+
+# =========================================================
+# Stale temp sweep
+# =========================================================
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def is_stale(path, now=None, max_age=STALE_AFTER):
+    """A temp whose writer is gone: dead process on this host, or too old."""
+    path = Path(path)
+    managed = TEMP.match(path.name)
+    if managed is None and not LEGACY_TEMP.search(path.name):
+        return False
+    try:
+        age = (now or time.time()) - path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    if managed and managed["host"] == HOST and int(managed["pid"]) != os.getpid():
+        return not _alive(int(managed["pid"])) or age > max_age
+    return age > max_age
+
+
+def sweep(directory, recursive=False, max_age=STALE_AFTER):
+    """Remove stale temp files under `directory`; returns the removed paths."""
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    now = time.time()
+    removed = []
+    for path in directory.rglob("*.tmp*") if recursive else directory.glob("*.tmp*"):
+        if path.is_file() and is_stale(path, now, max_age):
+            try:
+                path.unlink()
+                removed.append(path)
+            except FileNotFoundError:  # another writer swept it first
+                pass
+    return removed
+
+
+# =========================================================
+# Commit
+# =========================================================
+@contextmanager
+def _locked(key, manifest_dir=MANIFEST_DIR):
+    if fcntl is None:
+        yield
+        return
+    lock = _entry_path(key, manifest_dir).with_suffix(".lock")
+    with open(lock, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def commit(tmp, target, manifest_dir=MANIFEST_DIR, manifest=True):
+    """fsync, hash and rename `tmp` onto `target`; returns the manifest entry (None if unrecorded)."""
+    target = Path(target)
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    if not manifest:
+        os.replace(tmp, target)
+        return None
+    key = _key(target)
+    entry = {
+        "path": key,
+        "sha256": file_hash(tmp),
+        "bytes": os.path.getsize(tmp),
+        "committed_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "writer": f"{HOST}-{os.getpid()}",
+    }
+    Path(manifest_dir).mkdir(parents=True, exist_ok=True)
+    with _locked(key, manifest_dir):
+        os.replace(tmp, target)
+        entry_path = _entry_path(key, manifest_dir)
+        entry_tmp = temp_path(entry_path)
+        entry_tmp.write_text(json.dumps(entry, indent=2))
+        os.replace(entry_tmp, entry_path)
+    return entry
+
+
+@contextmanager
+def atomic_path(target, manifest_dir=MANIFEST_DIR, manifest=True):
+    """Yield a temp path to write `target` through; committed only on success."""
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    directory = os.path.abspath(target.parent)
+    if directory not in _swept:
+        _swept.add(directory)
+        sweep(target.parent)
+    tmp = temp_path(target)
+    try:
+        yield tmp
+        if not tmp.exists():
+            raise FileNotFoundError(f"nothing was written to {tmp} for {target}")
+        commit(tmp, target, manifest_dir, manifest)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def write_csv(frame, path, **kwargs):
+    with atomic_path(path) as tmp:
+        frame.to_csv(tmp, **kwargs)
+
+
+def write_text(path, text):
+    with atomic_path(path) as tmp:
+        tmp.write_text(text)
+
+
+def save_figure(fig, path, **kwargs):
+    with atomic_path(path) as tmp:
+        fig.savefig(tmp, **kwargs)
+
+
+# =========================================================
+# Manifest
+# =========================================================
+def read_manifest(manifest_dir=MANIFEST_DIR):
+    """{output path: entry} for every committed output."""
+    entries = {}
+    for path in sorted(Path(manifest_dir).glob("*.json")):
+        if TEMP.match(path.name):
+            continue
+        try:
+            entry = json.loads(path.read_text())
+        except (json.JSONDecodeError, OSError):
+            continue
+        entries[entry["path"]] = entry
+    return entries
+
+
+def verify(manifest_dir=MANIFEST_DIR):
+    """(path, problem) for outputs missing or changed since their commit."""
+    problems = []
+    for key, entry in read_manifest(manifest_dir).items():
+        if not Path(key).exists():
+            problems.append((key, "missing"))
+        elif file_hash(key) != entry["sha256"]:
+            problems.append((key, "changed since commit"))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep stale output temp files and verify committed outputs")
+    parser.add_argument("--sweep", nargs="*", metavar="DIR", help="directories to sweep recursively")
+    parser.add_argument("--max-age", type=float, default=STALE_AFTER, help="seconds before any temp is stale")
+    parser.add_argument("--verify", action="store_true", help="re-hash outputs against the manifest")
+    parser.add_argument("--manifest-dir", default=MANIFEST_DIR)
+    args = parser.parse_args()
+
+    for directory in args.sweep or []:
+        for path in sweep(directory, recursive=True, max_age=args.max_age):
+            print(f"removed {path}")
+    if args.verify:
+        problems = verify(args.manifest_dir)
+        for key, problem in problems:
+            print(f"{key}: {problem}")
+        print(f"{len(read_manifest(args.manifest_dir))} outputs in manifest, {len(problems)} problem(s)")
+        if problems:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
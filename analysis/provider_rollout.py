@@ -0,0 +1,207 @@
+#################################################################
+#Purpose
+#-----------
+# Detect when each provider started using the rheumatology PIFU outcome
+# codes ("4"/"5") from the visit stream, and attach that roll-out date to
+# patients as a timing / instrument variable. This is the "centre's
+# roll-out" event referred to in event_study_plot.do.
+
+#High-level logic
+#----------------
+#- One grouped pass: rheum OPAs (treatment_function_code "410") are coded
+  # by provider and month and counted with bincount into two (providers x
+  # months) matrices: rheum OPAs n and PIFU-outcome OPAs k.
+#- Two adoption rules, both vectorised over all providers at once:
+  #   threshold   - first month of a run of --persist consecutive months with
+  #                 PIFU share k/n >= --threshold and n >= --min-opa
+  #   changepoint - single step change in the PIFU share (binomial
+  #                 likelihood ratio over every split month, via cumulative
+  #                 sums); adoption = first month after the best split, kept
+  #                 if the share rises and 2*logLR >= --min-lr
+#- Patients inherit their provider's adoption month. Outputs are
+  # `post_rollout` (first rheum OPA on/after adoption) and
+  # `months_from_rollout`, for use as an instrument or timing variable.
+
+#Notes
+#-----
+#- The TPP opa table has no provider/trust code. The provider column is
+  # configurable (--provider-column, looked up on the event table first,
+  # then on the patient table). The default is `practice_stp`: the STP of
+  # the practice the patient was registered with at their first rheum OPA.
+
+#- provider_rollout.csv is released: its OPA counts go through
+  # disclosure.disclose (1-7 suppressed, the rest rounded to 5).
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (generate_opa_events)
+#- output/processed/provider_rollout.csv : one row per provider
+#- output/processed/patient_rollout.csv.gz : one row per patient
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.special import xlogy
+
+from dataset_io import STUDY_START, month_index
+from disclosure import disclose, round_counts
+from output_manager import write_csv
+
+RHEUM_TRT_CODE = "410"
+PIFU_OUTCOME_CODES = ["4", "5"]
+UNKNOWN_PROVIDER = "unknown"
+
+
+# =========================================================
+# Grouped pass
+# =========================================================
+def provider_month_counts(provider_code, month, pifu, n_providers, n_months):
+    """(providers x months) rheum OPA counts n and PIFU-outcome counts k."""
+    ok = (month >= 0) & (month < n_months)
+    cell = provider_code[ok] * n_months + month[ok]
+    size = n_providers * n_months
+    n = np.bincount(cell, minlength=size).reshape(n_providers, n_months)
+    k = np.bincount(cell, weights=pifu[ok], minlength=size).reshape(n_providers, n_months)
+    return n, k
+
+
+# =========================================================
+# Adoption rules
+# =========================================================
+def threshold_adoption(n, k, threshold=0.02, min_opa=10, persist=3):
+    """First month starting `persist` consecutive months above threshold (-1 = never)."""
+    if persist < 1:
+        raise ValueError(f"persist must be at least one month, got {persist}")
+    if persist > n.shape[1]:   # no window of that length fits in the study period
+        return np.full(n.shape[0], -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        above = (n >= min_opa) & (k / n >= threshold)
+    run = np.cumsum(np.pad(above, ((0, 0), (1, 0))), axis=1)
+    full = (run[:, persist:] - run[:, :-persist]) == persist   # run starting at each month
+    return np.where(full.any(axis=1), full.argmax(axis=1), -1)
+
+
+def changepoint_adoption(n, k, min_opa=30, min_lr=10.83):
+    """Best single step up in PIFU share per provider; returns (month, 2*logLR)."""
+    if n.shape[1] < 2:   # nothing to split
+        return np.full(n.shape[0], -1), np.full(n.shape[0], np.nan)
+    N, K = np.cumsum(n, axis=1), np.cumsum(k, axis=1)
+    n_tot, k_tot = N[:, -1:], K[:, -1:]
+
+    def loglik(kk, nn):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.where(nn > 0, kk / nn, 0.0)
+        return xlogy(kk, p) + xlogy(nn - kk, 1 - p)
+
+    # split after month t: pre = months 0..t, post = t+1..end
+    n1, k1 = N[:, :-1], K[:, :-1]
+    n2, k2 = n_tot - n1, k_tot - k1
+    lr = 2 * (loglik(k1, n1) + loglik(k2, n2) - loglik(k_tot, n_tot))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rises = k2 / n2 > k1 / n1
+    lr = np.where((n1 >= min_opa) & (n2 >= min_opa) & rises, lr, -np.inf)
+    best = lr.argmax(axis=1)
+    stat = lr[np.arange(len(lr)), best]
+    month = np.where(stat >= min_lr, best + 1, -1)
+    return month, np.where(np.isfinite(stat), stat, np.nan)
+
+
+# =========================================================
+# Detection
+# =========================================================
+def provider_of(events, cohort, column):
+    """Provider label per event, from the event table or the patient table."""
+    if column in events.columns:
+        return events[column].fillna(UNKNOWN_PROVIDER).astype(str)
+    if column not in cohort.columns:
+        raise KeyError(f"provider column {column!r} is in neither the event nor the patient table")
+    lookup = cohort.set_index("patient_id")[column].fillna(UNKNOWN_PROVIDER).astype(str)
+    return events["patient_id"].map(lookup).fillna(UNKNOWN_PROVIDER)
+
+
+def detect_rollout(events, cohort, column="practice_stp", rule="threshold", **params):
+    """Provider table and patient table with adoption timing."""
+    rheum = events[events["treatment_function_code"] == RHEUM_TRT_CODE]
+    provider = provider_of(rheum, cohort, column)
+    provider_code, providers = pd.factorize(provider, sort=True)
+    month = month_index(rheum["appointment_date"], STUDY_START)
+    n_months = int(month.max()) + 1
+    pifu = rheum["outcome_of_attendance"].isin(PIFU_OUTCOME_CODES).to_numpy(np.float64)
+    n, k = provider_month_counts(provider_code, month, pifu, len(providers), n_months)
+
+    threshold_month = threshold_adoption(
+        n, k, params.get("threshold", 0.02), params.get("min_opa", 10), params.get("persist", 3),
+    )
+    cp_month, cp_stat = changepoint_adoption(n, k, params.get("min_cp_opa", 30), params.get("min_lr", 10.83))
+    adoption = threshold_month if rule == "threshold" else cp_month
+
+    months = pd.date_range(STUDY_START, periods=n_months, freq="MS")
+
+    def as_date(m):
+        return pd.Series(np.where(m >= 0, months[np.clip(m, 0, None)], pd.NaT))
+
+    table = pd.DataFrame({
+        column: providers,
+        "rheum_opa": n.sum(axis=1),
+        "pifu_opa": k.sum(axis=1).astype(np.int64),
+        "threshold_month": as_date(threshold_month),
+        "changepoint_month": as_date(cp_month),
+        "changepoint_lr": cp_stat,
+        "adoption_date": as_date(adoption),
+    })
+
+    # patients: provider of their first rheum OPA, timing relative to adoption
+    first = rheum.assign(_provider=provider_code, _month=month).sort_values("appointment_date")
+    first = first.drop_duplicates("patient_id")
+    patient_adoption = adoption[first["_provider"].to_numpy()]
+    patients = pd.DataFrame({
+        "patient_id": first["patient_id"].to_numpy(),
+        column: providers[first["_provider"].to_numpy()],
+        "first_rheum_date": first["appointment_date"].to_numpy(),
+        "adoption_date": as_date(patient_adoption).to_numpy(),
+        "months_from_rollout": np.where(patient_adoption >= 0, first["_month"].to_numpy() - patient_adoption, np.nan),
+    })
+    patients["post_rollout"] = patients["months_from_rollout"] >= 0
+    return table, patients.sort_values("patient_id").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provider-level PIFU roll-out detection")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--provider-column", default="practice_stp")
+    parser.add_argument("--rule", choices=["threshold", "changepoint"], default="threshold")
+    parser.add_argument("--threshold", type=float, default=0.02, help="PIFU share of rheum OPAs")
+    parser.add_argument("--min-opa", type=int, default=10, help="rheum OPAs a month must have to count")
+    parser.add_argument("--persist", type=int, default=3, help="consecutive months above threshold")
+    parser.add_argument("--min-cp-opa", type=int, default=30, help="rheum OPAs needed on each side of a change point")
+    parser.add_argument("--min-lr", type=float, default=10.83, help="2*logLR for a change point (p~0.001)")
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    events = pd.read_csv(
+        args.events,
+        dtype={"treatment_function_code": str, "outcome_of_attendance": str, args.provider_column: str},
+        parse_dates=["appointment_date"],
+    )
+    cohort = pd.read_csv(args.cohort, dtype={args.provider_column: str})
+    table, patients = detect_rollout(
+        events, cohort, args.provider_column, args.rule,
+        threshold=args.threshold, min_opa=args.min_opa, persist=args.persist,
+        min_cp_opa=args.min_cp_opa, min_lr=args.min_lr,
+    )
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    write_csv(disclose(table, ["rheum_opa", "pifu_opa"]), outdir / "provider_rollout.csv", index=False)
+    write_csv(patients, outdir / "patient_rollout.csv.gz", index=False)
+    adopted = table["adoption_date"].notna().sum()
+    (n_patients,) = round_counts([len(patients)])
+    print(f"{adopted}/{len(table)} providers adopted PIFU ({args.rule} rule); {n_patients:.0f} patients (rounded)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,606 @@
+#################################################################
+#Purpose
+#-----------
+# Common-subexpression / redundant-filter analyser for the ehrQL definitions
+# (dataset_definition_rheum.py, measures.py, ...). Loads each definition,
+# walks its query-model graph and reports work that is done more than once
+# before it reaches the backend, e.g.
+#   - `last_address` built twice (IMD and rural/urban)
+#   - `has_any_diagnosis` defined in both the dataset and measures files
+#   - `first_opa` re-applying the 2018 filter that `all_opa` already has
+#   - DMARD / steroid rows sorted separately for first and last prescription
+
+#High-level logic
+#----------------
+#- Query-model nodes are frozen dataclasses, so structurally identical
+  # subtrees compare (and hash) equal. Before comparing, trees are
+  # canonicalised:
+  #   - row-level column references inside `where`/`sort_by` are rewritten to
+  #     the root table column (`dmard_records.date` == `medications.date`)
+  #   - filter conjuncts already enforced by an enclosing filter, or implied
+  #     by a tighter bound on the same column, are dropped
+#- Every frame-level subtree reached from more than one variable (or from
+  # more than one definition file) is reported with an estimated cost.
+#- `--emit` writes a deduplicated dataset definition in which shared
+  # subtrees are bound once to `_shared_N` names. It exits non-zero,
+  # writing nothing, if any node type has no ehrQL rendering.
+
+#Cost model
+#----------
+# Rough per-patient row counts per table (ROWS_PER_PATIENT) with a fixed
+# filter selectivity; scans/aggregations cost O(rows), sorts O(r log r).
+# Only the relative size of estimates is meaningful.
+
+#Usage
+#-----
+# python analysis/query_cse.py analysis/dataset_definition_rheum.py analysis/measures.py
+# python analysis/query_cse.py analysis/dataset_definition_rheum.py --emit output/dedup_definition.py
+#################################################################
+
+import argparse
+import dataclasses
+import datetime
+import hashlib
+import math
+import runpy
+import sys
+from collections import defaultdict
+from collections.abc import Mapping
+from pathlib import Path
+
+from output_manager import write_text
+
+NODE_MODULE_PREFIX = "ehrql.query_model"
+
+ROWS_PER_PATIENT = {
+    "clinical_events": 500,
+    "medications": 200,
+    "opa": 20,
+    "apcs": 5,
+    "addresses": 3,
+    "practice_registrations": 2,
+}
+FILTER_SELECTIVITY = 0.25
+
+# frame / aggregate node types worth reporting when shared
+FRAME_NODES = {"Filter", "Sort", "PickOneRowPerPatient", "PickOneRowPerPatientWithColumns"}
+PATIENT_LEVEL_NODES = {"PickOneRowPerPatient", "PickOneRowPerPatientWithColumns"}
+
+
+# =========================================================
+# Generic graph helpers
+# =========================================================
+def is_node(value):
+    return (
+        dataclasses.is_dataclass(value)
+        and not isinstance(value, type)
+        and type(value).__module__.startswith(NODE_MODULE_PREFIX)
+    )
+
+
+def kind(node):
+    """Class name without the enclosing namespace (Function.GE -> GE)."""
+    return type(node).__qualname__.rsplit(".", 1)[-1]
+
+
+def qualified_kind(node):
+    return type(node).__qualname__
+
+
+def _nodes_in(value):
+    if is_node(value):
+        yield value
+    elif isinstance(value, (tuple, list, set, frozenset)):
+        for item in value:
+            yield from _nodes_in(item)
+    elif isinstance(value, Mapping):
+        for key, item in value.items():
+            yield from _nodes_in(key)
+            yield from _nodes_in(item)
+
+
+def children(node):
+    for field in dataclasses.fields(node):
+        yield from _nodes_in(getattr(node, field.name))
+
+
+def _rebuild(value, fn):
+    if is_node(value):
+        return fn(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return type(value)(_rebuild(item, fn) for item in value)
+    if isinstance(value, Mapping):
+        items = {_rebuild(k, fn): _rebuild(v, fn) for k, v in value.items()}
+        try:
+            return type(value)(items)
+        except TypeError:
+            return items
+    return value
+
+
+def map_children(node, fn):
+    changes = {f.name: _rebuild(getattr(node, f.name), fn) for f in dataclasses.fields(node)}
+    return dataclasses.replace(node, **changes)
+
+
+def walk(root):
+    """Unique nodes reachable from root, children before parents."""
+    seen, order, stack = set(), [], [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node)
+            continue
+        if node in seen:
+            continue
+        seen.add(node)
+        stack.append((node, True))
+        stack.extend((child, False) for child in children(node) if child not in seen)
+    return order
+
+
+# =========================================================
+# Loading definitions
+# =========================================================
+def _qm(value):
+    return getattr(value, "_qm_node", value)
+
+
+def load_definition(path):
+    """Run a definition file; return {label: root node} for its variables.
+
+    Dataset variables are labelled by name (population as "population");
+    Measures are labelled "<measure>.numerator", ".denominator", ".<group>".
+    """
+    path = Path(path).resolve()
+    for extra in (str(path.parent), str(Path.cwd())):
+        if extra not in sys.path:
+            sys.path.insert(0, extra)
+    namespace = runpy.run_path(str(path), run_name="__ehrql_definition__")
+
+    roots = {}
+    for value in namespace.values():
+        cls = type(value).__name__
+        if cls == "Dataset" and hasattr(value, "_variables"):
+            if getattr(value, "_population", None) is not None:
+                roots["population"] = _qm(value._population)
+            for name, series in value._variables.items():
+                roots[name] = _qm(series)
+        elif cls == "Measures" and hasattr(value, "_measures"):
+            measures = value._measures
+            items = measures.values() if isinstance(measures, Mapping) else measures
+            for measure in items:
+                roots[f"{measure.name}.numerator"] = _qm(measure.numerator)
+                roots[f"{measure.name}.denominator"] = _qm(measure.denominator)
+                for group, series in (measure.group_by or {}).items():
+                    roots[f"{measure.name}.{group}"] = _qm(series)
+    return {label: node for label, node in roots.items() if is_node(node)}
+
+
+# =========================================================
+# Canonicalisation
+# =========================================================
+def root_frame(frame):
+    """Follow Filter/Sort sources back to the underlying table."""
+    while kind(frame) in ("Filter", "Sort"):
+        frame = frame.source
+    return frame
+
+
+def canonical_columns(series, table):
+    """Rewrite row-level column refs on frames derived from `table` to the table."""
+    def fix(node):
+        if kind(node) in PATIENT_LEVEL_NODES or qualified_kind(node).startswith("AggregateByPatient"):
+            return node  # patient-level series: leave untouched
+        if kind(node) == "SelectColumn" and root_frame(node.source) == table and node.source != table:
+            return dataclasses.replace(node, source=table)
+        return map_children(node, fix)
+    return fix(series)
+
+
+def conjuncts(condition):
+    if kind(condition) == "And":
+        return conjuncts(condition.lhs) + conjuncts(condition.rhs)
+    return [condition]
+
+
+def _bound(conjunct):
+    """(column, op, value) for `column <op> Value`, else None."""
+    if kind(conjunct) in ("GE", "GT", "LE", "LT") and kind(conjunct.rhs) == "Value":
+        return conjunct.lhs, kind(conjunct), conjunct.rhs.value
+    return None
+
+
+def implied_by(conjunct, enforced):
+    """True if an enforced conjunct already guarantees `conjunct`."""
+    if conjunct in enforced:
+        return True
+    bound = _bound(conjunct)
+    if bound is None:
+        return False
+    column, op, value = bound
+    for other in enforced:
+        other_bound = _bound(other)
+        if other_bound is None or other_bound[0] != column:
+            continue
+        _, other_op, other_value = other_bound
+        try:
+            if op in ("GE", "GT") and other_op in ("GE", "GT"):
+                if other_value > value or (other_value == value and (op == "GE" or other_op == "GT")):
+                    return True
+            if op in ("LE", "LT") and other_op in ("LE", "LT"):
+                if other_value < value or (other_value == value and (op == "LE" or other_op == "LT")):
+                    return True
+        except TypeError:
+            continue
+    return False
+
+
+def enforced_conjuncts(frame):
+    out = []
+    while kind(frame) in ("Filter", "Sort"):
+        if kind(frame) == "Filter":
+            out.extend(conjuncts(frame.condition))
+        frame = frame.source
+    return out
+
+
+def _and(parts, template):
+    condition = parts[0]
+    for part in parts[1:]:
+        condition = dataclasses.replace(template, lhs=condition, rhs=part)
+    return condition
+
+
+class Canonicaliser:
+    """Memoised bottom-up rewrite; records every redundant filter it drops."""
+
+    def __init__(self):
+        self.memo = {}
+        self.redundant = []   # (original Filter node, dropped conjuncts, fully_redundant)
+
+    def __call__(self, node):
+        if node in self.memo:
+            return self.memo[node]
+        new = map_children(node, self)
+        if kind(new) == "Filter":
+            table = root_frame(new.source)
+            condition = canonical_columns(new.condition, table)
+            enforced = enforced_conjuncts(new.source)
+            parts = conjuncts(condition)
+            kept = []
+            for part in parts:
+                if implied_by(part, enforced + kept):
+                    continue
+                kept.append(part)
+            if len(kept) < len(parts):
+                dropped = [p for p in parts if p not in kept]
+                self.redundant.append((node, dropped, not kept))
+            if not kept:
+                new = new.source
+            else:
+                template = condition if kind(condition) == "And" else None
+                condition = kept[0] if len(kept) == 1 or template is None else _and(kept, template)
+                new = dataclasses.replace(new, condition=condition)
+        elif kind(new) == "Sort":
+            new = dataclasses.replace(new, sort_by=canonical_columns(new.sort_by, root_frame(new.source)))
+        self.memo[node] = new
+        return new
+
+
+# =========================================================
+# Cost estimates
+# =========================================================
+def estimated_rows(node, memo):
+    if node in memo:
+        return memo[node]
+    k = kind(node)
+    if k == "SelectTable":
+        rows = ROWS_PER_PATIENT.get(node.name, 10)
+    elif k == "Filter":
+        rows = estimated_rows(node.source, memo) * FILTER_SELECTIVITY
+    elif k == "Sort":
+        rows = estimated_rows(node.source, memo)
+    else:
+        rows = 1
+    memo[node] = rows
+    return rows
+
+
+def node_cost(node, memo):
+    k = kind(node)
+    if k in ("SelectTable", "Filter"):
+        return estimated_rows(node.source if k == "Filter" else node, memo)
+    if k == "Sort":
+        r = estimated_rows(node, memo)
+        return r * math.log2(max(r, 2))
+    if k in PATIENT_LEVEL_NODES or qualified_kind(node).startswith("AggregateByPatient"):
+        return estimated_rows(getattr(node, "source", node), memo)
+    return 1
+
+
+def subtree_cost(node, memo):
+    return sum(node_cost(n, memo) for n in walk(node))
+
+
+# =========================================================
+# Analysis
+# =========================================================
+def analyse(definitions):
+    """definitions: {file: {label: node}} -> (report rows, canonical roots)."""
+    canon = Canonicaliser()
+    canonical = {
+        (file, label): canon(node)
+        for file, roots in definitions.items()
+        for label, node in roots.items()
+    }
+
+    users = defaultdict(set)
+    for key, root in canonical.items():
+        for node in walk(root):
+            if kind(node) in FRAME_NODES or qualified_kind(node).startswith("AggregateByPatient"):
+                users[node].add(key)
+
+    rows_memo = {}
+    report = []
+    for node, keys in users.items():
+        if len(keys) < 2:
+            continue
+        # only report the largest shared subtree, not every shared descendant
+        parents_shared = any(
+            node in set(children(other)) and users[other] == keys
+            for other in users if other is not node and len(users[other]) >= 2
+        )
+        if parents_shared:
+            continue
+        files = sorted({f for f, _ in keys})
+        cost = subtree_cost(node, rows_memo)
+        report.append({
+            "kind": "shared_subtree" if len(files) == 1 else "cross_definition",
+            "node": kind(node),
+            "used_by": sorted(f"{Path(f).name}:{label}" for f, label in keys),
+            "estimated_cost": cost,
+            "estimated_saving": cost * (len(keys) - 1),
+            "expression": render(node, {}),
+        })
+
+    # the same sorted frame picked more than once (first_for_patient + last_for_patient)
+    picks = defaultdict(set)
+    for root in canonical.values():
+        for node in walk(root):
+            if kind(node) in PATIENT_LEVEL_NODES:
+                picks[node.source].add(node)
+    for sort, picked in picks.items():
+        if len(picked) > 1 and kind(sort) == "Sort":
+            cost = node_cost(sort, rows_memo)
+            report.append({
+                "kind": "repeated_sort",
+                "node": "Sort",
+                "used_by": sorted(str(getattr(p, "position", "?")) for p in picked),
+                "estimated_cost": cost,
+                "estimated_saving": cost * (len(picked) - 1),
+                "expression": render(sort, {}),
+            })
+
+    for original, dropped, full in canon.redundant:
+        cost = node_cost(original, rows_memo)
+        report.append({
+            "kind": "redundant_filter" if full else "redundant_condition",
+            "node": "Filter",
+            "used_by": sorted(render(d, {}) for d in dropped),
+            "estimated_cost": cost,
+            "estimated_saving": cost if full else 0.0,
+            "expression": render(original, {}),
+        })
+
+    report.sort(key=lambda r: -r["estimated_saving"])
+    return report, canonical
+
+
+# =========================================================
+# Rendering back to ehrQL
+# =========================================================
+BINARY_OPS = {
+    "EQ": "==", "NE": "!=", "LT": "<", "LE": "<=", "GT": ">", "GE": ">=",
+    "And": "&", "Or": "|", "Add": "+", "Subtract": "-", "Multiply": "*", "TrueDivide": "/",
+}
+AGGREGATES = {
+    "Count": "count_for_patient", "Exists": "exists_for_patient", "CountDistinct": "count_distinct_for_patient",
+    "Sum": "sum_for_patient", "Min": "minimum_for_patient", "Max": "maximum_for_patient",
+    "Mean": "mean_for_patient",
+}
+DATE_PARTS = {"YearFromDate": "year", "MonthFromDate": "month", "DayFromDate": "day"}
+DATE_ADD = {"DateAddYears": "years", "DateAddMonths": "months", "DateAddDays": "days"}
+DATE_DIFF = {"DateDifferenceInYears": "years", "DateDifferenceInMonths": "months", "DateDifferenceInDays": "days"}
+VARIADIC = {"MinimumOf": "minimum_of", "MaximumOf": "maximum_of"}
+METHODS = {
+    "ToFirstOfMonth": "to_first_of_month", "ToFirstOfYear": "to_first_of_year",
+    "CastToInt": "as_int", "CastToFloat": "as_float",
+}
+
+# long literal collections (codelists) rendered as module-level names
+MAX_INLINE_VALUES = 10
+
+# marker for nodes render() has no ehrQL spelling for (fine in the report,
+# fatal for --emit)
+UNSUPPORTED = "<unsupported "
+
+CODES_MODULE = "ehrql.codes"
+
+
+def _is_code(value):
+    """SNOMEDCTCode, DMDCode, ICD10Code, ... (imported into the emitted header)."""
+    return type(value).__module__ == CODES_MODULE and hasattr(value, "value")
+
+
+def _code_classes(roots):
+    names = set()
+    for root in roots:
+        for node in walk(root):
+            if kind(node) == "Value":
+                values = node.value if isinstance(node.value, (frozenset, set, tuple, list)) else [node.value]
+                names.update(type(v).__name__ for v in values if _is_code(v))
+    return sorted(names)
+
+
+def _render_value(value, literals):
+    if isinstance(value, (frozenset, set, tuple, list)):
+        items = sorted(value, key=str)
+        text = "[" + ", ".join(_render_value(v, literals) for v in items) + "]"
+        if len(items) <= MAX_INLINE_VALUES:
+            return text
+        name = "codelist_" + hashlib.sha1(text.encode()).hexdigest()[:8]
+        literals[name] = text
+        return name
+    if isinstance(value, datetime.date):
+        return f"date({value.year}, {value.month}, {value.day})"
+    if _is_code(value):
+        return f"{type(value).__name__}({value.value!r})"
+    if hasattr(value, "name") and hasattr(value, "value") and type(value).__module__.startswith("ehrql"):
+        return repr(value.value)
+    return repr(value)
+
+
+def render(node, names, literals=None):
+    """ehrQL-style source for a node; nodes in `names` render as their name."""
+    literals = {} if literals is None else literals
+    if node in names:
+        return names[node]
+
+    def r(n):
+        return render(n, names, literals)
+
+    k, qk = kind(node), qualified_kind(node)
+    if k in ("SelectTable", "SelectPatientTable"):
+        return node.name
+    if k == "Value":
+        return _render_value(node.value, literals)
+    if k == "Filter":
+        return f"{r(node.source)}.where({r(node.condition)})"
+    if k == "Sort":
+        return f"{r(node.source)}.sort_by({r(node.sort_by)})"
+    if k in PATIENT_LEVEL_NODES:
+        position = str(getattr(node.position, "name", node.position)).lower()
+        return f"{r(node.source)}.{'first' if 'first' in position else 'last'}_for_patient()"
+    if k == "SelectColumn":
+        return f"{r(node.source)}.{node.name}"
+    if qk.startswith("AggregateByPatient") and k in AGGREGATES:
+        return f"{r(node.source)}.{AGGREGATES[k]}()"
+    if k in BINARY_OPS:
+        return f"({r(node.lhs)} {BINARY_OPS[k]} {r(node.rhs)})"
+    if k == "Not":
+        return f"~{r(node.source)}"
+    if k == "IsNull":
+        return f"{r(node.source)}.is_null()"
+    if k == "In":
+        return f"{r(node.lhs)}.is_in({r(node.rhs)})"
+    if k in DATE_PARTS:
+        return f"{r(node.source)}.{DATE_PARTS[k]}"
+    if k in DATE_ADD:
+        return f"({r(node.lhs)} + {DATE_ADD[k]}({r(node.rhs)}))"
+    if k in DATE_DIFF:
+        return f"({r(node.lhs)} - {r(node.rhs)}).{DATE_DIFF[k]}"
+    if k in VARIADIC:
+        return f"{VARIADIC[k]}({', '.join(r(n) for n in node.sources)})"
+    if k == "StringContains":
+        return f"{r(node.lhs)}.contains({r(node.rhs)})"
+    if k in METHODS:
+        return f"{r(node.source)}.{METHODS[k]}()"
+    if k == "Negate":
+        return f"(-{r(node.source)})"
+    if k == "FloorDivide":
+        return f"({r(node.lhs)} // {r(node.rhs)})"
+    if k == "Case":
+        whens = ", ".join(f"when({r(c)}).then({r(v)})" for c, v in node.cases.items())
+        default = r(node.default) if node.default is not None else "None"
+        return f"case({whens}, otherwise={default})"
+    args = ", ".join(r(c) for c in children(node))
+    return f"{UNSUPPORTED}{qk}>({args})"
+
+
+def emit_definition(canonical_roots, shared_nodes):
+    """Deduplicated dataset definition source for one file's canonical roots.
+
+    Raises ValueError if any node cannot be rendered as ehrQL.
+    """
+    order, seen = [], set()
+    for root in canonical_roots.values():
+        for node in walk(root):
+            if node in shared_nodes and node not in seen:
+                seen.add(node)
+                order.append(node)
+
+    names, literals, body = {}, {}, []
+    for i, node in enumerate(order, 1):
+        expr = render(node, names, literals)
+        names[node] = f"_shared_{i}"
+        body.append(f"_shared_{i} = {expr}")
+
+    body.append("")
+    body.append("dataset = create_dataset()")
+    for label, root in canonical_roots.items():
+        expr = render(root, names, literals)
+        if label == "population":
+            body.append(f"dataset.define_population({expr})")
+        else:
+            body.append(f"dataset.{label} = {expr}")
+
+    unsupported = sorted({
+        qualified_kind(node) for root in canonical_roots.values() for node in walk(root)
+        if render(node, {}, {}).startswith(UNSUPPORTED)
+    })
+    if unsupported:
+        raise ValueError(f"cannot emit ehrQL for node type(s): {', '.join(unsupported)}")
+
+    header = [
+        "# Generated by analysis/query_cse.py: shared subtrees bound once, redundant filters removed.",
+        "from datetime import date",
+        "",
+        "from ehrql import create_dataset, case, when, years, months, days, minimum_of, maximum_of",
+        "from ehrql.tables.tpp import *  # noqa: F401,F403",
+    ]
+    codes = _code_classes(canonical_roots.values())
+    if codes:
+        header.append(f"from {CODES_MODULE} import {', '.join(codes)}")
+    header.append("")
+    header += [f"{name} = {text}" for name, text in literals.items()]
+    return "\n".join(header + [""] + body) + "\n"
+
+
+def shared_nodes_for(canonical_roots):
+    users = defaultdict(set)
+    for label, root in canonical_roots.items():
+        for node in walk(root):
+            if kind(node) in FRAME_NODES or qualified_kind(node).startswith("AggregateByPatient"):
+                users[node].add(label)
+    return {node for node, labels in users.items() if len(labels) > 1}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report duplicated / redundant work in ehrQL definitions")
+    parser.add_argument("definitions", nargs="+")
+    parser.add_argument("--emit", help="write a deduplicated version of the first (dataset) definition")
+    parser.add_argument("--top", type=int, default=30)
+    args = parser.parse_args()
+
+    definitions = {path: load_definition(path) for path in args.definitions}
+    report, canonical = analyse(definitions)
+
+    print(f"{'kind':<20} {'saving':>10} {'cost':>10}  used by / expression")
+    for row in report[: args.top]:
+        print(f"{row['kind']:<20} {row['estimated_saving']:>10.0f} {row['estimated_cost']:>10.0f}  "
+              f"{', '.join(row['used_by'])}")
+        print(f"{'':<43}{row['expression'][:160]}")
+
+    if args.emit:
+        first = args.definitions[0]
+        roots = {label: node for (file, label), node in canonical.items() if file == first}
+        try:
+            source = emit_definition(roots, shared_nodes_for(roots))
+        except ValueError as error:
+            raise SystemExit(f"--emit: {error}")
+        write_text(args.emit, source)
+
+
+if __name__ == "__main__":
+    main()
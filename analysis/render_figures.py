@@ -0,0 +1,293 @@
+#################################################################
+#Purpose
+#-----------
+# Headless renderer for the resource-use, PIFU trend and event-study figures.
+# Python counterpart of resource_use_graphs.do, pfu_trend_plot.do and
+# event_study_plot.do: the OpenSAFELY Stata image cannot export PNGs, so
+# those figures otherwise have to be produced by hand.
+
+#High-level logic
+#----------------
+#- Read measures from the measure-partitioned cache (measures_cache.py; built
+  # from measures.csv if missing or stale) and the patient-level dataset once.
+#- Every figure is a `Figure` spec listing the measures it needs, a `prepare`
+  # step that turns them into a small plotting frame, and a `draw` step.
+  # Only partitions needed by the selected figures are loaded.
+#- The plotting frame is hashed; figures whose hash matches the last run
+  # (and whose PNG exists) are skipped.
+#- Remaining figures are drawn in parallel worker processes with the
+  # non-interactive Agg backend.
+
+#Notes
+#-----
+#- The PNGs are released, so every count is rounded / suppressed
+  # (disclosure.py) in the prepare step, and rates are computed from the
+  # rounded counts: no count of 1..REDACT_AT reaches a figure.
+
+#Outputs
+#-------
+#- output/processed/figures/*.png (same names as resource_use_graphs.do)
+#- output/processed/pfu_trend_plot.png, output/processed/event_study_monthly.png
+#- output/processed/figures/.figure_hashes.json (input hashes of the last run)
+#################################################################
+
+import argparse
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from dataset_io import DATASET_PATH, MEASURES_PATH, pick_column, read_dataset  # noqa: E402
+from disclosure import round_counts, share  # noqa: E402
+from measures_cache import CACHE_DIR, ensure_cache, read_manifest, read_measures  # noqa: E402
+from output_manager import save_figure, write_text  # noqa: E402
+
+HASH_FILE = ".figure_hashes.json"
+
+# UK national COVID-19 restriction periods (shaded on the time-series plots)
+COVID_RESTRICTIONS = [
+    ("2020-03-23", "2020-07-04"),
+    ("2020-11-05", "2020-12-02"),
+    ("2021-01-06", "2021-03-29"),
+]
+
+VISIT_MEASURES = {
+    "count_all_opa": "All OPA",
+    "count_rheum_opa": "Rheum OPA",
+    "count_nonrheum_opa": "Non-rheum OPA",
+}
+
+
+# =========================================================
+# Prepare steps (measure partitions, dataset) -> plotting frame
+# =========================================================
+def rounded(frame):
+    """Same frame with every value passed through disclosure.round_counts."""
+    return pd.DataFrame(round_counts(frame), index=frame.index, columns=frame.columns)
+
+
+def visits_per_patient(parts, dataset):
+    patients = round_counts(parts["patient_count"].frame().iloc[:, 0])
+    wide = rounded(pd.concat([parts[m].frame().iloc[:, 0].rename(m) for m in VISIT_MEASURES], axis=1))
+    return pd.DataFrame(share(wide, patients[:, None]), index=wide.index, columns=wide.columns)
+
+
+def visits_per_1000(parts, dataset):
+    return visits_per_patient(parts, dataset) * 1000
+
+
+def pifu_prepost(parts, dataset):
+    # sum visits and patient-months BEFORE dividing
+    rate = {
+        label: float(share(*round_counts([np.nansum(parts[m].numerator), np.nansum(parts[m].denominator)]))) * 1000
+        for label, m in (("Pre-PIFU", "count_all_opa_pre_pifu"), ("Post-PIFU", "count_all_opa_post_pifu"))
+    }
+    return pd.Series(rate).to_frame("rate_per1000")
+
+
+def by_group(measure, parts, dataset):
+    """Visit counts per period, one column per stratum (use via partial)."""
+    return rounded(parts[measure].frame("numerator"))
+
+
+def pfu_trend(parts, dataset):
+    pfu_date = pick_column(dataset, "first_rheum_pfu_date")
+    years = pfu_date.dropna().dt.year
+    return rounded(years.value_counts().sort_index().rename_axis("first_pfu_year").to_frame("n"))
+
+
+def event_study_monthly(parts, dataset):
+    """Patients by month of first OPA relative to first PFU (one row per patient, not visits)."""
+    pfu_date = pick_column(dataset, "first_rheum_pfu_date")
+    days = (dataset["first_opa_date"] - pfu_date).dt.days.dropna()
+    event_month = np.floor(days / 30).astype(int)
+    event_month = event_month[(event_month >= -36) & (event_month <= 36)]
+    return rounded(event_month.value_counts().sort_index().rename_axis("event_month").to_frame("patients"))
+
+
+# =========================================================
+# Draw steps (frame, ax)
+# =========================================================
+def shade_covid(ax):
+    for start, end in COVID_RESTRICTIONS:
+        ax.axvspan(pd.Timestamp(start), pd.Timestamp(end), color="black", alpha=0.15, lw=0)
+
+
+def draw_lines(frame, ax, shade=False):
+    if shade:
+        shade_covid(ax)
+    for col in frame.columns:
+        ax.plot(frame.index, frame[col], lw=1.5, label=VISIT_MEASURES.get(col, col))
+    ax.legend(loc="upper center", bbox_to_anchor=(0.5, -0.12), ncol=min(len(frame.columns), 4), frameon=False)
+
+
+def draw_lines_shaded(frame, ax):
+    draw_lines(frame, ax, shade=True)
+
+
+def draw_bar(frame, ax):
+    bars = ax.bar(frame.index, frame.iloc[:, 0], color="steelblue")
+    ax.bar_label(bars, fmt="%.2f")
+
+
+def draw_single(frame, ax):
+    ax.plot(frame.index, frame.iloc[:, 0], lw=2.5, color="blue")
+
+
+def draw_event_study(frame, ax):
+    ax.plot(frame.index, frame.iloc[:, 0], lw=2.5, color="blue")
+    ax.axvline(0, color="red", ls="--")
+
+
+@dataclass(frozen=True)
+class Figure:
+    name: str
+    path: str
+    prepare: Callable
+    draw: Callable
+    title: str
+    xlabel: str
+    ylabel: str
+    measures: tuple = ()
+    needs_dataset: bool = False
+
+
+FIGURES = [
+    Figure("all_opa_mean_per_patient", "figures/all_opa_mean_per_patient.png", visits_per_patient, draw_lines,
+           "Mean outpatient visits per patient over time", "Month", "Mean visits per patient per month",
+           measures=("count_all_opa", "count_rheum_opa", "count_nonrheum_opa", "patient_count")),
+    Figure("all_opa_mean_per1000", "figures/all_opa_mean_per1000.png", visits_per_1000, draw_lines_shaded,
+           "Mean outpatient visits per 1,000 patients over time", "Month", "Visits per 1,000 patients",
+           measures=("count_all_opa", "count_rheum_opa", "count_nonrheum_opa", "patient_count")),
+    Figure("pifu_prepost_bar_per1000", "figures/pifu_prepost_bar_per1000.png", pifu_prepost, draw_bar,
+           "Outpatient visit rates before and after first PIFU", "",
+           "Mean outpatient visits per 1,000 patients per month",
+           measures=("count_all_opa_pre_pifu", "count_all_opa_post_pifu")),
+    Figure("all_opa_by_sex", "figures/all_opa_by_sex.png", partial(by_group, "count_all_opa_by_sex"), draw_lines,
+           "Total outpatient visits over time — by sex", "Time period", "Number of outpatient visits",
+           measures=("count_all_opa_by_sex",)),
+    Figure("all_opa_by_pfu_sex_4line", "figures/all_opa_by_pfu_sex_4line.png",
+           partial(by_group, "count_all_opa_by_pfu_sex"), draw_lines,
+           "Total outpatient visits — PIFU vs Non-PIFU, by Sex", "Time period", "Number of outpatient visits",
+           measures=("count_all_opa_by_pfu_sex",)),
+    Figure("all_opa_by_diag_category", "figures/all_opa_by_diag_category.png",
+           partial(by_group, "count_all_opa_by_latest_diag_category"), draw_lines,
+           "Total outpatient visits over time — by diagnosis category", "Time period", "Number of outpatient visits",
+           measures=("count_all_opa_by_latest_diag_category",)),
+    Figure("all_opa_by_ethnicity", "figures/all_opa_by_ethnicity.png",
+           partial(by_group, "count_all_opa_by_ethnicity"), draw_lines,
+           "Total outpatient visits over time — by ethnicity", "Time period", "Number of outpatient visits",
+           measures=("count_all_opa_by_ethnicity",)),
+    Figure("all_opa_by_imd", "figures/all_opa_by_imd.png",
+           partial(by_group, "count_all_opa_by_imd"), draw_lines,
+           "Total outpatient visits over time — by IMD quintile", "Time period", "Number of outpatient visits",
+           measures=("count_all_opa_by_imd",)),
+    Figure("all_opa_by_ruralurb", "figures/all_opa_by_ruralurb.png",
+           partial(by_group, "count_all_opa_by_ruralurb"), draw_lines,
+           "Total outpatient visits over time — by rural/urban classification", "Time period",
+           "Number of outpatient visits",
+           measures=("count_all_opa_by_ruralurb",)),
+    Figure("pfu_trend_plot", "pfu_trend_plot.png", pfu_trend, draw_single,
+           "PFU Uptake Over Time", "Year of first PFU", "Number of PFU patients", needs_dataset=True),
+    Figure("event_study_monthly", "event_study_monthly.png", event_study_monthly, draw_event_study,
+           "Event Study: first OPA relative to first PFU", "Months from first PFU to first OPA",
+           "Number of patients",
+           needs_dataset=True),
+]
+
+
+# =========================================================
+# Rendering
+# =========================================================
+def frame_hash(figure, frame):
+    h = hashlib.sha256(figure.name.encode())
+    h.update(pd.util.hash_pandas_object(frame.reset_index(), index=False).to_numpy().tobytes())
+    h.update(",".join(map(str, frame.columns)).encode())
+    return h.hexdigest()
+
+
+def render(args):
+    figure, frame, path = args
+    fig, ax = plt.subplots(figsize=(10, 6))
+    figure.draw(frame, ax)
+    ax.set_title(figure.title)
+    ax.set_xlabel(figure.xlabel)
+    ax.set_ylabel(figure.ylabel)
+    fig.tight_layout()
+    save_figure(fig, path, dpi=160)
+    plt.close(fig)
+    return figure.name
+
+
+def render_all(cache_dir, dataset, outdir, n_jobs=1, force=False, only=None):
+    """Render every figure whose input frame changed; returns (drawn, skipped).
+
+    Only the measure partitions used by the selected figures are read.
+    """
+    figures = [f for f in FIGURES if not only or f.name in only]
+    if dataset is None:
+        figures = [f for f in figures if not f.needs_dataset]
+    manifest = read_manifest(cache_dir) if cache_dir else None
+    if manifest is None:
+        figures = [f for f in figures if not f.measures]
+    else:
+        figures = [f for f in figures if set(f.measures) <= set(manifest["measures"])]
+    parts = read_measures(sorted({m for f in figures for m in f.measures}), cache_dir) if manifest else {}
+
+    outdir = Path(outdir)
+    (outdir / "figures").mkdir(parents=True, exist_ok=True)
+    hash_path = outdir / "figures" / HASH_FILE
+    previous = json.loads(hash_path.read_text()) if hash_path.exists() else {}
+
+    current, tasks, skipped = {}, [], []
+    for figure in figures:
+        frame = figure.prepare(parts, dataset)
+        path = outdir / figure.path
+        current[figure.name] = frame_hash(figure, frame)
+        if not force and previous.get(figure.name) == current[figure.name] and path.exists():
+            skipped.append(figure.name)
+            continue
+        tasks.append((figure, frame, path))
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        drawn = [render(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            drawn = list(pool.map(render, tasks))
+
+    write_text(hash_path, json.dumps({**previous, **current}, indent=2, sort_keys=True))
+    return drawn, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render all resource-use, trend and event-study figures")
+    parser.add_argument("--measures", default=MEASURES_PATH)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--outdir", default="output/processed")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="redraw even if inputs are unchanged")
+    parser.add_argument("--only", nargs="*", help="figure names to render")
+    args = parser.parse_args()
+
+    cache_dir = None
+    if Path(args.measures).exists():
+        ensure_cache(args.measures, args.cache_dir)
+        cache_dir = args.cache_dir
+    dataset = read_dataset(args.dataset) if Path(args.dataset).exists() else None
+    drawn, skipped = render_all(cache_dir, dataset, args.outdir, args.jobs, args.force, args.only)
+    print(f"rendered {len(drawn)} figure(s), skipped {len(skipped)} unchanged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#################################################################
+#Purpose
+#-----------
+# Performance history of the project's jobs, built from the job-runner
+# metadata (metadata/*.log and the job table of metadata/db.sqlite), with
+# a regression check against a rolling baseline: a change to e.g.
+# dataset_definition_rheum.py that doubles extraction time is flagged on
+# the next ingest.
+
+#High-level logic
+#----------------
+#- Each log is a timestamped body followed by a key: value footer
+  # (job_definition_id, exit_code, created_at, completed_at, ...). Stage
+  # boundaries are the first line matching each STAGES pattern; a stage
+  # lasts until the next one starts (or the last log line).
+#- From the body: patients generated / matching (ehrQL dummy data, last
+  # "Generated N patients, found M matching"), rows imported (Stata
+  # "(k vars, n obs)") and whether generation gave up.
+#- The definition file (ehrQL dataset definition or do-file) is resolved
+  # to the last commit touching it before the job completed
+  # (`git rev-list -1 --before=<completed_at> HEAD -- <path>`) and the
+  # file as of that commit is hashed (`git show <rev>:<path>`), so the
+  # hash does not depend on when the history is ingested. Edits that were
+  # never committed are invisible; jobs on the backend always run from a
+  # commit.
+#- run_seconds is start -> completion from metadata/db.sqlite (queueing
+  # excluded); log_seconds spans the first to last log line. Jobs in the
+  # db without a log are added with their timings only.
+#- Runs are keyed by job id, so re-ingesting is a no-op. Every newly
+  # ingested successful run is compared with the median of the previous
+  # --window successful runs of the same action; durations above
+  # --factor x baseline (or throughput below baseline / --factor) are
+  # reported, with the baseline's definition hash for context.
+
+#Usage
+#-----
+# python analysis/run_history.py                      # ingest metadata/, report regressions
+# python analysis/run_history.py --window 5 --factor 1.5 --strict
+#################################################################
+
+import argparse
+import hashlib
+import re
+import sqlite3
+import subprocess
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from output_manager import write_csv
+
+METADATA_DIR = "metadata"
+HISTORY_DB = "output/run_history.sqlite"
+
+# stage name -> first log line that starts it
+STAGES = {
+    "compile": re.compile(r"Compiling dataset definition"),
+    "dummy_data": re.compile(r"Generating dummy dataset"),
+    "query": re.compile(r"Running query|Executing"),
+    "write": re.compile(r"Writing output|Writing dataset"),
+    "do_file": re.compile(r'^\. \. do "'),
+}
+TIMESTAMP = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?)Z ?(.*)$")
+GENERATED = re.compile(r"Generated (\d+) patients, found (\d+) matching")
+IMPORTED = re.compile(r"^\((\d+) vars?, ([\d,]+) obs\)")
+DEFINITION = re.compile(r"Compiling dataset definition from (\S+)|^\. \. do \"(analysis/[^\"]+)\"")
+
+RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    job_id TEXT PRIMARY KEY,
+    action TEXT,
+    source TEXT,
+    definition TEXT,
+    definition_sha256 TEXT,
+    definition_rev TEXT,
+    exit_code INTEGER,
+    status TEXT,
+    created_at INTEGER,
+    completed_at INTEGER,
+    wall_seconds REAL,
+    run_seconds REAL,
+    log_seconds REAL,
+    patients_generated INTEGER,
+    patients_matched INTEGER,
+    match_rate REAL,
+    rows_in INTEGER,
+    rows_per_second REAL,
+    gave_up INTEGER
+)
+"""
+STAGES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT,
+    stage TEXT,
+    seconds REAL,
+    PRIMARY KEY (job_id, stage)
+)
+"""
+
+
+@lru_cache(maxsize=None)
+def _git(*args):
+    """stdout of a git command as bytes, or None if git fails."""
+    try:
+        result = subprocess.run(["git", *args], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout
+
+
+def _definition(path, completed_at):
+    """(path, sha256, commit) of a definition file as committed when the job completed."""
+    if path is None or completed_at is None:
+        return path, None, None
+    rev = _git("rev-list", "-1", f"--before=@{int(completed_at)}", "HEAD", "--", path)
+    rev = rev.decode().strip() if rev else None
+    if not rev:
+        return path, None, None
+    content = _git("show", f"{rev}:./{path}")
+    return path, hashlib.sha256(content).hexdigest() if content is not None else None, rev
+
+
+# =========================================================
+# Parsing
+# =========================================================
+def parse_log(path):
+    """(run record, {stage: seconds}) from one job log."""
+    times, lines, footer = [], [], {}
+    for line in Path(path).read_text(encoding="utf-8", errors="replace").splitlines():
+        stamped = TIMESTAMP.match(line)
+        if stamped:
+            times.append(np.datetime64(stamped.group(1), "ns"))
+            lines.append(stamped.group(2))
+        elif ":" in line and not line.startswith(" "):
+            key, value = line.split(":", 1)
+            footer[key.strip()] = value.strip()
+
+    seconds = (np.array(times, "datetime64[ns]") - times[0]).astype(np.float64) / 1e9 if times else np.zeros(0)
+    log_seconds = float(seconds[-1]) if len(seconds) else None
+
+    starts = {}
+    for name, pattern in STAGES.items():
+        hit = next((i for i, text in enumerate(lines) if pattern.search(text)), None)
+        if hit is not None:
+            starts[name] = hit
+    ordered = sorted(starts.items(), key=lambda item: item[1])
+    stages = {}
+    for k, (name, start) in enumerate(ordered):
+        end = ordered[k + 1][1] if k + 1 < len(ordered) else len(lines) - 1
+        stages[name] = float(seconds[end] - seconds[start])
+
+    generated = [GENERATED.search(text) for text in lines]
+    generated = [m for m in generated if m]
+    imported = next((m for m in (IMPORTED.match(text) for text in lines) if m), None)
+    definition = next((m for m in (DEFINITION.search(text) for text in lines) if m), None)
+
+    created = int(footer["created_at"]) if "created_at" in footer else None
+    completed = int(footer["completed_at"]) if "completed_at" in footer else None
+    n_generated = int(generated[-1].group(1)) if generated else None
+    n_matched = int(generated[-1].group(2)) if generated else None
+    rows_in = int(imported.group(2).replace(",", "")) if imported else None
+    if n_generated and stages.get("dummy_data"):
+        rows_per_second = n_generated / stages["dummy_data"]
+    elif rows_in and log_seconds:
+        rows_per_second = rows_in / log_seconds
+    else:
+        rows_per_second = None
+
+    path_, sha, rev = _definition(
+        (definition.group(1) or definition.group(2)) if definition else None, completed
+    )
+    record = {
+        "job_id": footer.get("job_definition_id", Path(path).stem),
+        "action": Path(path).stem,
+        "source": str(path),
+        "definition": path_,
+        "definition_sha256": sha,
+        "definition_rev": rev,
+        "exit_code": int(footer["exit_code"]) if "exit_code" in footer else None,
+        "status": footer.get("status_message"),
+        "created_at": created,
+        "completed_at": completed,
+        "wall_seconds": completed - created if created is not None and completed is not None else None,
+        "run_seconds": None,
+        "log_seconds": log_seconds,
+        "patients_generated": n_generated,
+        "patients_matched": n_matched,
+        "match_rate": n_matched / n_generated if n_generated else None,
+        "rows_in": rows_in,
+        "rows_per_second": rows_per_second,
+        "gave_up": int(any("giving up" in text for text in lines)),
+    }
+    return record, stages
+
+
+def jobs_from_db(path):
+    """Run records for the job-runner job table (timings and status only)."""
+    with sqlite3.connect(path) as con:
+        jobs = pd.read_sql_query(
+            "SELECT id, action, run_command, state, status_code, created_at, started_at, completed_at FROM job", con
+        )
+    records = []
+    for job in jobs.itertuples():
+        command = re.search(r"(analysis/\S+\.(?:py|do))", job.run_command or "")
+        path, sha, rev = _definition(command.group(1) if command else None, job.completed_at)
+        done = job.completed_at is not None and job.started_at is not None
+        records.append({
+            "job_id": job.id, "action": job.action, "source": str(path), "definition": path,
+            "definition_sha256": sha, "definition_rev": rev,
+            "exit_code": 0 if job.state == "succeeded" else 1, "status": job.status_code,
+            "created_at": job.created_at, "completed_at": job.completed_at,
+            "wall_seconds": job.completed_at - job.created_at if done else None,
+            "run_seconds": float(job.completed_at - job.started_at) if done else None, "log_seconds": None,
+            "patients_generated": None, "patients_matched": None, "match_rate": None,
+            "rows_in": None, "rows_per_second": None, "gave_up": None,
+        })
+    return records
+
+
+# =========================================================
+# History store and regressions
+# =========================================================
+def open_history(db_path=HISTORY_DB):
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.execute(RUNS_SCHEMA)
+    con.execute(STAGES_SCHEMA)
+    # stores created before a column was added get it (NULL for old runs)
+    present = {row[1] for row in con.execute("PRAGMA table_info(runs)")}
+    for name, kind in re.findall(r"^ +(\w+) (\w+)", RUNS_SCHEMA, re.MULTILINE):
+        if name not in present:
+            con.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+    return con
+
+
+def ingest(con, records):
+    """Insert runs not yet in the store; returns the newly added job ids."""
+    known = {row[0] for row in con.execute("SELECT job_id FROM runs")}
+    added = []
+    for record, stages in records:
+        if record["job_id"] in known:
+            continue
+        columns = ", ".join(record)
+        con.execute(f"INSERT INTO runs ({columns}) VALUES ({', '.join('?' * len(record))})",
+                    list(record.values()))
+        con.executemany("INSERT INTO stages VALUES (?, ?, ?)",
+                        [(record["job_id"], stage, s) for stage, s in stages.items()])
+        known.add(record["job_id"])
+        added.append(record["job_id"])
+    con.commit()
+    return added
+
+
+def history(con):
+    """One row per run, stage durations as stage_<name> columns."""
+    runs = pd.read_sql_query("SELECT * FROM runs", con)
+    stages = pd.read_sql_query("SELECT * FROM stages", con)
+    if not stages.empty:
+        wide = stages.pivot(index="job_id", columns="stage", values="seconds").add_prefix("stage_")
+        runs = runs.merge(wide, left_on="job_id", right_index=True, how="left")
+    return runs.sort_values("completed_at", kind="stable").reset_index(drop=True)
+
+
+def regressions(runs, job_ids, window=5, factor=1.5, min_seconds=1.0):
+    """Metrics of the given runs that regressed against the rolling baseline."""
+    slower = ["run_seconds", "wall_seconds", "log_seconds"] + [c for c in runs.columns if c.startswith("stage_")]
+    flags = []
+    ok = runs[runs["exit_code"] == 0]
+    for job in runs[runs["job_id"].isin(job_ids) & (runs["exit_code"] == 0)].itertuples():
+        previous = ok[(ok["action"] == job.action) & (ok["completed_at"] < job.completed_at)].tail(window)
+        if previous.empty:
+            continue
+        for metric in slower + ["rows_per_second"]:
+            value = getattr(job, metric)
+            baseline = previous[metric].median()
+            if pd.isna(value) or pd.isna(baseline) or baseline <= 0:
+                continue
+            if metric == "rows_per_second":
+                regressed = value < baseline / factor
+            else:
+                regressed = value > baseline * factor and value - baseline >= min_seconds
+            if regressed:
+                flags.append({
+                    "job_id": job.job_id, "action": job.action, "metric": metric,
+                    "value": value, "baseline": baseline, "ratio": value / baseline,
+                    "baseline_runs": len(previous),
+                    "definition_sha256": job.definition_sha256,
+                    "baseline_sha256": previous["definition_sha256"].dropna().iloc[-1]
+                    if previous["definition_sha256"].notna().any() else None,
+                })
+    return pd.DataFrame(flags, columns=[
+        "job_id", "action", "metric", "value", "baseline", "ratio", "baseline_runs",
+        "definition_sha256", "baseline_sha256",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect job metadata into a performance history and flag regressions")
+    parser.add_argument("--metadata", default=METADATA_DIR)
+    parser.add_argument("--db", default=HISTORY_DB)
+    parser.add_argument("--window", type=int, default=5, help="previous successful runs in the baseline")
+    parser.add_argument("--factor", type=float, default=1.5, help="slowdown that counts as a regression")
+    parser.add_argument("--all", action="store_true", help="check every stored run, not only new ones")
+    parser.add_argument("--report", default="output/run_history_regressions.csv")
+    parser.add_argument("--strict", action="store_true", help="exit non-zero on any regression")
+    args = parser.parse_args()
+
+    metadata = Path(args.metadata)
+    jobs = {}
+    if (metadata / "db.sqlite").exists():
+        jobs = {record["job_id"]: record for record in jobs_from_db(metadata / "db.sqlite")}
+    records = []
+    for path in sorted(metadata.glob("*.log")):
+        record, stages = parse_log(path)
+        record["run_seconds"] = jobs.pop(record["job_id"], {}).get("run_seconds")
+        records.append((record, stages))
+    records += [(record, {}) for record in jobs.values()]
+
+    con = open_history(args.db)
+    added = ingest(con, records)
+    runs = history(con)
+    con.close()
+
+    checked = runs["job_id"] if args.all else added
+    flags = regressions(runs, checked, args.window, args.factor)
+    Path(args.report).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(flags, args.report, index=False)
+
+    print(f"{len(added)} new run(s), {len(runs)} in {args.db}; {len(flags)} regression(s)")
+    for flag in flags.itertuples():
+        changed = "" if flag.definition_sha256 == flag.baseline_sha256 else " (definition changed)"
+        print(f"  {flag.action} {flag.job_id}: {flag.metric} {flag.value:.1f} vs {flag.baseline:.1f}"
+              f" (x{flag.ratio:.2f}){changed}")
+    if args.strict and len(flags):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#################################################################
+#Purpose
+#-----------
+# Sensitivity-analysis sweep over the analysis choices that are currently
+# commented-out alternatives in the ehrQL definitions:
+#   attended_only   opa.attendance_status.is_in(["5","6"])
+#   study_start     2018-01-01 (dataset_definition_rheum) vs 2018-06-01 (variable_functions)
+#   pifu_from_2022  only count PIFU outcomes on/after 2022-01-01
+#   sex             all vs male/female only
+#   n_months        length of the monthly measures window (N_months)
+# Every combination is evaluated from one set of cached base tables instead
+# of editing the definitions and re-running the extraction per variant.
+
+#High-level logic
+#----------------
+#- Base tables (OPA events + cohort from dataset_definition_opa_events.py)
+  # are materialised ONCE as typed .npy arrays (patient code, day, month,
+  # rheum / PIFU-outcome / attended flags, sex). They are rebuilt only when
+  # the source extracts change.
+#- Scenarios are the Cartesian product of SWITCHES (override with --set).
+  # Each scenario is a set of boolean masks over the cached arrays and runs
+  # in a worker process that opens the arrays memory-mapped.
+#- Per scenario: cohort size, PIFU patients, OPAs per patient in the 12
+  # months before/after first PIFU, and monthly all/rheum OPA counts and new
+  # PIFU patients. Counts are rounded / suppressed (disclosure.py) in the
+  # worker and pifu_share is taken from the rounded counts.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (generate_opa_events)
+#- output/processed/sensitivity_results.csv : tidy, one row per
+  # scenario x metric (x period for monthly metrics), with the switch values
+#################################################################
+
+import argparse
+import itertools
+import json
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START, month_index
+from disclosure import round_counts, share
+from measures_cache import file_hash
+from output_manager import atomic_path, write_csv, write_text
+
+CACHE_DIR = "output/processed/sensitivity_base"
+
+SWITCHES = {
+    "attended_only": [False, True],
+    "study_start": ["2018-01-01", "2018-06-01"],
+    "pifu_from_2022": [False, True],
+    "sex": ["all", "male_female"],
+    "n_months": [96, 120],
+}
+
+ATTENDED_CODES = ["5", "6"]
+PIFU_OUTCOME_CODES = ["4", "5"]
+RHEUM_TRT_CODE = "410"
+PIFU_RESTRICTION_START = "2022-01-01"
+SEX_CODES = {"male": 0, "female": 1}  # anything else -> 2
+
+# cached arrays, opened once per worker process
+_base = {}
+
+
+# =========================================================
+# Base tables
+# =========================================================
+def _days(dates):
+    return (pd.to_datetime(dates).to_numpy("datetime64[D]").astype(np.int64)).astype(np.int32)
+
+
+def build_base(events_path, cohort_path, cache_dir=CACHE_DIR):
+    """Parse the extracts once into .npy arrays; returns the manifest."""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cohort = pd.read_csv(cohort_path, dtype={"sex": str}).sort_values("patient_id")
+    events = pd.read_csv(
+        events_path,
+        dtype={"treatment_function_code": str, "outcome_of_attendance": str, "attendance_status": str},
+        parse_dates=["appointment_date"],
+    )
+    events = events[events["appointment_date"].notna()]
+
+    patient_ids = cohort["patient_id"].to_numpy()
+    event_ids = events["patient_id"].to_numpy()
+    codes = np.searchsorted(patient_ids, event_ids)
+    known = (codes < len(patient_ids)) & (patient_ids[np.minimum(codes, len(patient_ids) - 1)] == event_ids)
+    events, codes = events[known], codes[known]
+
+    arrays = {
+        "patient": codes.astype(np.int32),
+        "day": _days(events["appointment_date"]),
+        "month": month_index(events["appointment_date"], STUDY_START).astype(np.int16),
+        "rheum": (events["treatment_function_code"] == RHEUM_TRT_CODE).to_numpy(),
+        "pifu_outcome": events["outcome_of_attendance"].isin(PIFU_OUTCOME_CODES).to_numpy(),
+        "attended": events["attendance_status"].isin(ATTENDED_CODES).to_numpy(),
+        "sex": cohort["sex"].map(SEX_CODES).fillna(2).to_numpy(np.int8),
+    }
+    for name, values in arrays.items():
+        with atomic_path(cache_dir / f"{name}.npy") as tmp:
+            np.save(tmp, values)
+    manifest = {
+        "sources": {str(p): file_hash(p) for p in (events_path, cohort_path)},
+        "n_patients": len(patient_ids),
+        "n_events": int(len(codes)),
+    }
+    write_text(cache_dir / "manifest.json", json.dumps(manifest, indent=2))
+    return manifest
+
+
+def ensure_base(events_path, cohort_path, cache_dir=CACHE_DIR):
+    """Rebuild the cached base tables only if an extract changed."""
+    path = Path(cache_dir) / "manifest.json"
+    if path.exists():
+        manifest = json.loads(path.read_text())
+        current = {str(p): file_hash(p) for p in (events_path, cohort_path)}
+        if manifest["sources"] == current:
+            return manifest
+    return build_base(events_path, cohort_path, cache_dir)
+
+
+def _open_base(cache_dir):
+    for name in ("patient", "day", "month", "rheum", "pifu_outcome", "attended", "sex"):
+        _base[name] = np.load(Path(cache_dir) / f"{name}.npy", mmap_mode="r")
+
+
+# =========================================================
+# Scenarios
+# =========================================================
+def scenario_grid(switches=SWITCHES):
+    names = list(switches)
+    return [dict(zip(names, values)) for values in itertools.product(*(switches[n] for n in names))]
+
+
+def scenario_id(scenario):
+    return "|".join(f"{k}={v}" for k, v in scenario.items())
+
+
+def evaluate(scenario):
+    """Tidy metric rows for one scenario, from the cached arrays."""
+    b = _base
+    n_patients = len(b["sex"])
+    start_month = int(month_index([scenario["study_start"]], STUDY_START)[0])
+    n_months = int(scenario["n_months"])
+
+    month = np.asarray(b["month"])
+    keep = (month >= start_month) & (month < start_month + n_months)
+    if scenario["attended_only"]:
+        keep &= b["attended"]
+    sex_ok = np.asarray(b["sex"]) < 2 if scenario["sex"] == "male_female" else np.ones(n_patients, bool)
+    keep &= sex_ok[b["patient"]]
+
+    patient = np.asarray(b["patient"])[keep]
+    day = np.asarray(b["day"])[keep]
+    period = month[keep] - start_month
+    rheum = np.asarray(b["rheum"])[keep]
+
+    cohort = np.bincount(patient[rheum], minlength=n_patients) > 0
+    in_cohort = cohort[patient]
+
+    pifu = rheum & np.asarray(b["pifu_outcome"])[keep]
+    if scenario["pifu_from_2022"]:
+        pifu &= day >= _days([PIFU_RESTRICTION_START])[0]
+    # earliest PIFU day per patient: sort PIFU events by day, keep first per patient
+    order = np.argsort(day[pifu], kind="stable")
+    pifu_patient, first_index = np.unique(patient[pifu][order], return_index=True)
+    first_pifu = np.full(n_patients, np.iinfo(np.int32).max, dtype=np.int64)
+    first_pifu[pifu_patient] = day[pifu][order][first_index]
+    first_pifu_period = np.full(n_patients, -1, dtype=np.int64)
+    first_pifu_period[pifu_patient] = period[pifu][order][first_index]
+    n_pifu = len(pifu_patient)
+
+    rel = day - first_pifu[patient]
+    pre = ((rel >= -365) & (rel < 0)).sum()
+    post = ((rel > 0) & (rel <= 365)).sum()
+
+    cohort_patients, pifu_patients = round_counts([cohort.sum(), n_pifu])
+    scalars = {
+        "cohort_patients": cohort_patients,
+        "pifu_patients": pifu_patients,
+        "pifu_share": float(share(pifu_patients, cohort_patients)),
+        "opa_per_patient_12m_pre_pifu": pre / n_pifu if n_pifu else np.nan,
+        "opa_per_patient_12m_post_pifu": post / n_pifu if n_pifu else np.nan,
+    }
+    monthly = {
+        "count_all_opa": np.bincount(period[in_cohort], minlength=n_months),
+        "count_rheum_opa": np.bincount(period[in_cohort & rheum], minlength=n_months),
+        "new_pifu_patients": np.bincount(first_pifu_period[pifu_patient], minlength=n_months),
+    }
+
+    key = scenario_id(scenario)
+    rows = [{"scenario": key, "metric": m, "period": np.nan, "value": v} for m, v in scalars.items()]
+    periods = pd.date_range(scenario["study_start"], periods=n_months, freq="MS").strftime("%Y-%m-%d")
+    for metric, counts in monthly.items():
+        rows += [
+            {"scenario": key, "metric": metric, "period": p, "value": c}
+            for p, c in zip(periods, round_counts(counts[:n_months]))
+        ]
+    return rows
+
+
+def run_sweep(scenarios, cache_dir=CACHE_DIR, n_jobs=1):
+    with Pool(n_jobs, initializer=_open_base, initargs=(cache_dir,)) as pool:
+        results = pool.map(evaluate, scenarios)
+    tidy = pd.DataFrame([row for rows in results for row in rows])
+    switches = pd.DataFrame([{**s, "scenario": scenario_id(s)} for s in scenarios])
+    return switches.merge(tidy, on="scenario")
+
+
+def parse_overrides(items, switches=SWITCHES):
+    """--set name=v1,v2 -> switch grid with typed values."""
+    grid = dict(switches)
+    for item in items:
+        name, values = item.split("=", 1)
+        if name not in grid:
+            raise SystemExit(f"unknown switch {name!r}; choose from {', '.join(grid)}")
+        kind = type(grid[name][0])
+        if kind is bool:
+            grid[name] = [v.strip().lower() in ("1", "true", "yes") for v in values.split(",")]
+        else:
+            grid[name] = [kind(v.strip()) for v in values.split(",")]
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensitivity sweep over cohort / outcome definition switches")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--set", action="append", default=[], metavar="SWITCH=V1,V2",
+                        help="override the values of one switch, e.g. n_months=60,96,120")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--output", default="output/processed/sensitivity_results.csv")
+    args = parser.parse_args()
+
+    ensure_base(args.events, args.cohort, args.cache_dir)
+    scenarios = scenario_grid(parse_overrides(args.set))
+    results = run_sweep(scenarios, args.cache_dir, args.jobs)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(results, args.output, index=False)
+    print(f"{len(scenarios)} scenario(s), {len(results)} result rows -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
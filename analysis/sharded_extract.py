@@ -0,0 +1,258 @@
+#################################################################
+#Purpose
+#-----------
+# Sharded local execution of a dataset definition (default:
+# dataset_definition_rheum.py). Instead of one monolithic
+# `generate-dataset` run, the input tables are split by a hash of
+# patient_id into N shards, each shard is extracted in its own process and
+# the shard outputs are stream-merged into one patient_id-sorted .csv.gz.
+
+#High-level logic
+#----------------
+#- Split: every <table>.csv[.gz] in the tables directory (ehrQL
+  # `--dummy-tables` layout, one file per TPP table) is read in chunks and
+  # each row routed to shard splitmix64(patient_id) % N. All rows of a
+  # patient land in the same shard, so every per-patient query is exact.
+#- Extract: `ehrql generate-dataset <definition> --dummy-tables <shard>`
+  # runs for each shard in a separate process, up to --jobs at a time.
+  # Finished shards are kept, so a re-run (or the retry pass) only repeats
+  # the shards that failed; each failed shard is retried alone.
+#- Shard tables are written through output_manager.atomic_path and a
+  # split.json marker is written after the last one, so a run resumes only
+  # from a complete split; an interrupted split is discarded and redone.
+  # Scratch files under --workdir are kept out of the output manifest
+  # (manifest=False); only the merged dataset is recorded.
+#- Merge: shard outputs are sorted by patient_id (already the case for
+  # ehrQL output; re-sorted otherwise) and k-way merged with heapq.merge
+  # into a gzip written with mtime=0 and no filename, so identical inputs give a
+  # byte-identical file regardless of shard timing.
+
+#Notes
+#-----
+#- Local development only: the OpenSAFELY backend runs the plain
+  # generate_dataset_definition_rheum action.
+#- Only single-table dataset definitions are supported (no event tables).
+#- Use --ehrql "opensafely exec ehrql:v1" to run through the docker image.
+
+#Usage
+#-----
+# python analysis/sharded_extract.py --tables dummy_tables --shards 8 --jobs 8
+#################################################################
+
+import argparse
+import gzip
+import heapq
+import json
+import shlex
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import DATASET_PATH
+from output_manager import atomic_path
+
+DEFINITION = "analysis/dataset_definition_rheum.py"
+WORKDIR = "output/shards"
+# written once every shard table is complete; only then can a run resume
+SPLIT_DONE = "split.json"
+
+
+# =========================================================
+# Split
+# =========================================================
+def shard_of(patient_id, n_shards):
+    """Stable shard number per patient (splitmix64 finaliser, then mod N)."""
+    x = np.asarray(patient_id, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x % np.uint64(n_shards)).astype(np.int64)
+
+
+def table_files(tables_dir):
+    return sorted(p for p in Path(tables_dir).iterdir() if p.name.endswith((".csv", ".csv.gz")))
+
+
+def split_tables(tables_dir, workdir, n_shards, chunksize=500_000):
+    """Write workdir/shard_XX/tables/<table>.csv for every input table."""
+    shard_dirs = [Path(workdir) / f"shard_{i:02d}" / "tables" for i in range(n_shards)]
+    for d in shard_dirs:
+        d.mkdir(parents=True, exist_ok=True)
+
+    for path in table_files(tables_dir):
+        name = path.name.removesuffix(".gz")
+        header = pd.read_csv(path, nrows=0).columns
+        if "patient_id" not in header:
+            for d in shard_dirs:
+                with atomic_path(d / path.name, manifest=False) as tmp:
+                    shutil.copyfile(path, tmp)
+            continue
+        with ExitStack() as stack:
+            # each shard table is committed only once the whole table is split
+            tmps = [stack.enter_context(atomic_path(d / name, manifest=False)) for d in shard_dirs]
+            outs = [stack.enter_context(open(tmp, "w", newline="")) for tmp in tmps]
+            for out in outs:
+                out.write(",".join(header) + "\n")
+            # strings throughout so values are written back exactly as read
+            for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize):
+                shard = shard_of(chunk["patient_id"].astype(np.int64), n_shards)
+                for i, rows in chunk.groupby(shard, sort=False):
+                    rows.to_csv(outs[i], header=False, index=False)
+
+    tables = [p.name for p in table_files(tables_dir)]
+    with atomic_path(Path(workdir) / SPLIT_DONE, manifest=False) as tmp:
+        tmp.write_text(json.dumps({"shards": n_shards, "tables": tables}))
+    return [d.parent for d in shard_dirs]
+
+
+def prepare_shards(tables_dir, workdir, n_shards):
+    """Shard directories, resumed only from a split that ran to completion."""
+    workdir = Path(workdir)
+    marker = workdir / SPLIT_DONE
+    if marker.exists():
+        done = json.loads(marker.read_text())
+        if done["shards"] != n_shards:
+            raise SystemExit(f"{workdir} holds {done['shards']} shards; remove it or pass --shards {done['shards']}")
+        print(f"resuming {n_shards} existing shard(s)")
+        return sorted(workdir.glob("shard_*"))
+    if workdir.exists():
+        print(f"discarding incomplete split in {workdir}")
+        shutil.rmtree(workdir)
+    return split_tables(tables_dir, workdir, n_shards)
+
+
+# =========================================================
+# Extract
+# =========================================================
+def _patient_key(line):
+    return int(line.split(",", 1)[0])
+
+
+def sort_shard_output(path):
+    """Ensure rows are ordered by patient_id (rewrites the file only if not)."""
+    with gzip.open(path, "rt", newline="") as f:
+        header = f.readline()
+        previous, ordered = -1, True
+        for line in f:
+            key = _patient_key(line)
+            if key < previous:
+                ordered = False
+                break
+            previous = key
+    if ordered:
+        return
+    with gzip.open(path, "rt", newline="") as f:
+        header = f.readline()
+        lines = sorted(f, key=_patient_key)
+    with atomic_path(path, manifest=False) as tmp, gzip.open(tmp, "wt", newline="") as f:
+        f.write(header)
+        f.writelines(lines)
+
+
+def run_shard(shard_dir, definition, ehrql_cmd):
+    """Extract one shard; returns (shard_dir, ok, seconds, message)."""
+    output = shard_dir / "dataset.csv.gz"
+    if output.exists():
+        return shard_dir, True, 0.0, "cached"
+    partial = shard_dir / "dataset.partial.csv.gz"
+    cmd = shlex.split(ehrql_cmd) + [
+        "generate-dataset", definition,
+        "--dummy-tables", str(shard_dir / "tables"),
+        "--output", str(partial),
+    ]
+    start = time.perf_counter()
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        message = (result.stderr.strip().splitlines() or [f"exit code {result.returncode}"])[-1]
+        return shard_dir, False, seconds, message
+    sort_shard_output(partial)
+    partial.replace(output)
+    return shard_dir, True, seconds, "ok"
+
+
+def extract_shards(shard_dirs, definition, ehrql_cmd, n_jobs, retries=2):
+    """Run all shards in parallel, then retry each failed shard on its own."""
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(pool.map(lambda d: run_shard(d, definition, ehrql_cmd), shard_dirs))
+    for shard_dir, ok, seconds, message in results:
+        print(f"{shard_dir.name}: {'ok' if ok else 'FAILED'} in {seconds:.1f}s {'' if ok else message}")
+
+    failed = [d for d, ok, _, _ in results if not ok]
+    for attempt in range(1, retries + 1):
+        if not failed:
+            break
+        still_failed = []
+        for shard_dir in failed:
+            _, ok, seconds, message = run_shard(shard_dir, definition, ehrql_cmd)
+            print(f"{shard_dir.name}: retry {attempt} {'ok' if ok else 'FAILED'} in {seconds:.1f}s")
+            if not ok:
+                still_failed.append(shard_dir)
+        failed = still_failed
+    if failed:
+        raise SystemExit(f"shard(s) failed after {retries} retries: {', '.join(d.name for d in failed)}")
+    return [d / "dataset.csv.gz" for d in shard_dirs]
+
+
+# =========================================================
+# Merge
+# =========================================================
+def _keyed_lines(f):
+    for line in f:
+        yield _patient_key(line), line
+
+
+def merge_shards(paths, output):
+    """k-way merge of patient_id-sorted shard outputs into one .csv.gz."""
+    files = [gzip.open(p, "rt", newline="") for p in paths]
+    try:
+        headers = {f.readline() for f in files}
+        if len(headers) != 1:
+            raise ValueError("shard outputs have different columns")
+        n_rows = 0
+        with atomic_path(output) as tmp, open(tmp, "wb") as raw:
+            with gzip.GzipFile(filename="", fileobj=raw, mode="wb", mtime=0) as gz:
+                gz.write(headers.pop().encode())
+                for _, line in heapq.merge(*(_keyed_lines(f) for f in files), key=lambda kv: kv[0]):
+                    gz.write(line.encode())
+                    n_rows += 1
+    finally:
+        for f in files:
+            f.close()
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded local extraction with a deterministic merge")
+    parser.add_argument("--definition", default=DEFINITION)
+    parser.add_argument("--tables", required=True, help="directory of <table>.csv[.gz] files")
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--jobs", type=int, default=8)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--workdir", default=WORKDIR)
+    parser.add_argument("--ehrql", default="ehrql", help='command prefix, e.g. "opensafely exec ehrql:v1"')
+    parser.add_argument("--output", default=DATASET_PATH)
+    parser.add_argument("--keep", action="store_true", help="keep the shard directories")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    workdir = Path(args.workdir)
+    shard_dirs = prepare_shards(args.tables, workdir, args.shards)
+    paths = extract_shards(shard_dirs, args.definition, args.ehrql, args.jobs, args.retries)
+    n_rows = merge_shards(paths, args.output)
+    if not args.keep:
+        shutil.rmtree(workdir)
+    print(f"{n_rows} rows from {len(paths)} shard(s) -> {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
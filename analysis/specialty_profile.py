@@ -0,0 +1,146 @@
+#################################################################
+#Purpose
+#-----------
+# Per-patient resource use for EVERY outpatient specialty
+# (treatment_function_code), not just rheum "410" vs everything else:
+# visit counts, first/last visit dates and visits in the --window days
+# before / after first_rheum_pfu_date. Used for health-economic spill-over
+# (cardiology, orthopaedics, dermatology, ... visits around PIFU).
+
+#High-level logic
+#----------------
+#- One grouped pass over the OPA event table: rows are sorted once by
+  # (patient, specialty, date), so each (patient, specialty) cell is a
+  # contiguous run. Counts and first/last dates are read at the run
+  # boundaries; pre/post-PIFU window counts are bincounts over run ids.
+#- Results are sparse (patients x specialties) CSR matrices: only cells
+  # with at least one visit are stored, and there is no variable per code.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (generate_opa_events)
+#- output/processed/specialty_profile/
+  #   visits.npz, pre_pifu.npz, post_pifu.npz, first_day.npz, last_day.npz
+  #                       sparse matrices (days since 1970-01-01 for dates)
+  #   patients.npy        row labels (patient_id)
+  #   specialties.csv     column labels (treatment_function_code)
+#- output/processed/specialty_summary.csv : one row per specialty
+  # (released: counts rounded / suppressed by disclosure.disclose)
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from disclosure import disclose, round_counts
+from output_manager import atomic_path, write_csv
+
+PROFILE_DIR = "output/processed/specialty_profile"
+MATRICES = ["visits", "pre_pifu", "post_pifu", "first_day", "last_day"]
+SUMMARY_COUNTS = ["patients", "visits", "pifu_patients_with_visit", "visits_pre_pifu", "visits_post_pifu"]
+
+
+def _days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]").astype(np.int64)
+
+
+def specialty_profile(patient, day, specialty, pifu_day, n_patients, n_specialties, window=365):
+    """Sparse (patients x specialties) matrices from one sorted pass over visits."""
+    order = np.lexsort((day, specialty, patient))
+    patient, day, specialty = patient[order], day[order], specialty[order]
+
+    new = np.ones(len(day), bool)
+    new[1:] = (patient[1:] != patient[:-1]) | (specialty[1:] != specialty[:-1])
+    run = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:], len(day)] - 1
+
+    # window counts relative to first PIFU (never-PIFU patients stay 0)
+    anchor = pifu_day[patient]
+    has_pifu = anchor != np.iinfo(np.int64).min
+    rel = np.where(has_pifu, day - np.where(has_pifu, anchor, 0), 0)
+    pre = has_pifu & (rel >= -window) & (rel < 0)
+    post = has_pifu & (rel > 0) & (rel <= window)
+
+    cell = (patient[first], specialty[first])
+    shape = (n_patients, n_specialties)
+    values = {
+        "visits": np.bincount(run),
+        "pre_pifu": np.bincount(run, weights=pre).astype(np.int64),
+        "post_pifu": np.bincount(run, weights=post).astype(np.int64),
+        "first_day": day[first],
+        "last_day": day[last],
+    }
+    return {name: sparse.csr_matrix((v, cell), shape=shape) for name, v in values.items()}
+
+
+def summary(profile, specialties, pifu):
+    """Patients, visits and PIFU-window visits per specialty."""
+    visits = profile["visits"]
+    return pd.DataFrame({
+        "treatment_function_code": specialties,
+        "patients": np.diff(visits.tocsc().indptr),
+        "visits": np.asarray(visits.sum(axis=0)).ravel(),
+        "pifu_patients_with_visit": np.diff(visits[pifu].tocsc().indptr),
+        "visits_pre_pifu": np.asarray(profile["pre_pifu"].sum(axis=0)).ravel(),
+        "visits_post_pifu": np.asarray(profile["post_pifu"].sum(axis=0)).ravel(),
+    }).sort_values("visits", ascending=False)
+
+
+def save_profile(profile, patient_ids, specialties, out_dir=PROFILE_DIR):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, matrix in profile.items():
+        with atomic_path(out_dir / f"{name}.npz") as tmp:
+            sparse.save_npz(tmp, matrix)
+    with atomic_path(out_dir / "patients.npy") as tmp:
+        np.save(tmp, np.asarray(patient_ids))
+    write_csv(pd.DataFrame({"treatment_function_code": specialties}), out_dir / "specialties.csv", index=False)
+
+
+def load_profile(out_dir=PROFILE_DIR):
+    """Matrices, patient ids and specialty codes written by save_profile."""
+    out_dir = Path(out_dir)
+    profile = {name: sparse.load_npz(out_dir / f"{name}.npz") for name in MATRICES}
+    specialties = pd.read_csv(out_dir / "specialties.csv", dtype=str)["treatment_function_code"].to_numpy()
+    return profile, np.load(out_dir / "patients.npy"), specialties
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-patient visit profile for every outpatient specialty")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--window", type=int, default=365, help="days before / after first PIFU")
+    parser.add_argument("--outdir", default=PROFILE_DIR)
+    parser.add_argument("--summary", default="output/processed/specialty_summary.csv")
+    args = parser.parse_args()
+
+    cohort = pd.read_csv(args.cohort, usecols=["patient_id", "first_rheum_pfu_date"]).sort_values("patient_id")
+    events = pd.read_csv(args.events, usecols=["patient_id", "appointment_date", "treatment_function_code"],
+                         dtype={"treatment_function_code": str})
+    events = events[events["appointment_date"].notna()]
+
+    patient = pd.Index(cohort["patient_id"]).get_indexer(events["patient_id"])
+    known = patient >= 0
+    specialty, specialties = pd.factorize(
+        events["treatment_function_code"].str.strip().replace("", np.nan).fillna("missing"), sort=True
+    )
+    pifu_day = _days(cohort["first_rheum_pfu_date"])
+    profile = specialty_profile(
+        patient[known], _days(events["appointment_date"])[known], specialty[known],
+        pifu_day, len(cohort), len(specialties), args.window,
+    )
+
+    save_profile(profile, cohort["patient_id"].to_numpy(), specialties, args.outdir)
+    report = summary(profile, specialties, pifu_day != np.iinfo(np.int64).min)
+    Path(args.summary).parent.mkdir(parents=True, exist_ok=True)
+    write_csv(disclose(report, SUMMARY_COUNTS), args.summary, index=False)
+    n_patients, n_cells = round_counts([len(cohort), profile["visits"].nnz])
+    print(f"{n_patients:.0f} patients x {len(specialties)} specialties, {n_cells:.0f} non-empty cells (rounded)")
+
+
+if __name__ == "__main__":
+    main()
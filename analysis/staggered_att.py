@@ -0,0 +1,213 @@
+#################################################################
+#Purpose
+#-----------
+# Group-time average treatment effects on the treated, ATT(g, t), for the
+# staggered entry of patients onto rheumatology PIFU (Callaway & Sant'Anna
+# style, unconditional parallel trends). Pooled TWFE (event_study.py) is
+# biased when effects vary across entry cohorts; this estimator is not.
+
+#High-level logic
+#----------------
+#- Cohort g = calendar month of `first_rheum_pfu_date`; never-PIFU patients
+  # have no cohort.
+#- ATT(g, t) = mean(Y_t - Y_{g-1} | G = g) - mean(Y_t - Y_{g-1} | control),
+  # control = not yet treated at max(t, g-1) (plus never treated, optional).
+#- Each (g, t) cell runs in a worker process. The person-month outcome panel
+  # and cohort vector are written once as .npy files and opened memory-mapped
+  # by every worker, so nothing is copied per task.
+#- Cells are aggregated into event-time (t - g) and calendar-time effects,
+  # weighted by cohort size; SEs come from summed influence functions,
+  # computed in a second parallel pass.
+
+#Inputs / Outputs
+#----------------
+#- output/opa_events/opa.csv.gz and dataset.csv.gz (dataset_definition_opa_events.py)
+#- output/processed/att_gt.csv, att_event_time.csv, att_calendar_time.csv
+  # (released: att_gt's n_treated / n_control go through disclosure.disclose,
+  # and cells with a suppressed count have att / se / CI blanked and are
+  # left out of the event- and calendar-time aggregates, whose weights would
+  # otherwise carry them)
+#################################################################
+
+import argparse
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START, month_index
+from disclosure import REDACT_AT, disclose
+from event_study import build_person_month_panel
+from output_manager import write_csv
+
+NEVER_TREATED = np.iinfo(np.int32).max
+CELL_COLUMNS = ["cohort", "period", "att", "se", "n_treated", "n_control"]
+
+# memory-mapped arrays, opened once per worker process
+_panel = {}
+
+
+# =========================================================
+# Shared panel
+# =========================================================
+def write_panel(y, cohort, workdir):
+    """Save outcomes as (months, patients) so each period is contiguous."""
+    workdir = Path(workdir)
+    np.save(workdir / "y.npy", np.ascontiguousarray(y.T, dtype=np.float64))
+    np.save(workdir / "cohort.npy", cohort.astype(np.int32))
+    return workdir
+
+
+def _open_panel(workdir):
+    _panel["y"] = np.load(Path(workdir) / "y.npy", mmap_mode="r")
+    _panel["cohort"] = np.load(Path(workdir) / "cohort.npy", mmap_mode="r")
+
+
+def _cell_arrays(g, t, include_never):
+    y, cohort = _panel["y"], _panel["cohort"]
+    base = g - 1
+    delta = y[t] - y[base]
+    treated = cohort == g
+    control = (cohort > max(t, base)) & (cohort != g)
+    if not include_never:
+        control &= cohort != NEVER_TREATED
+    return delta, treated, control
+
+
+def _influence(delta, treated, control):
+    """ATT and per-patient influence function (ATT - truth ~ mean(psi))."""
+    n = len(delta)
+    n_t, n_c = treated.sum(), control.sum()
+    mu_t = delta[treated].mean()
+    mu_c = delta[control].mean()
+    psi = np.zeros(n)
+    psi[treated] = n * (delta[treated] - mu_t) / n_t
+    psi[control] = -n * (delta[control] - mu_c) / n_c
+    return mu_t - mu_c, psi
+
+
+def _cell_task(args):
+    g, t, include_never = args
+    delta, treated, control = _cell_arrays(g, t, include_never)
+    n_t, n_c = int(treated.sum()), int(control.sum())
+    if n_t == 0 or n_c == 0:
+        return None
+    att, psi = _influence(delta, treated, control)
+    se = np.sqrt((psi**2).sum()) / len(psi)
+    return {"cohort": g, "period": t, "att": att, "se": se, "n_treated": n_t, "n_control": n_c}
+
+
+def _aggregate_task(args):
+    key, cells, weights, include_never = args
+    total = None
+    estimate = 0.0
+    for (g, t), w in zip(cells, weights):
+        att, psi = _influence(*_cell_arrays(g, t, include_never))
+        estimate += w * att
+        total = w * psi if total is None else total + w * psi
+    return key, estimate, np.sqrt((total**2).sum()) / len(total)
+
+
+# =========================================================
+# Estimation
+# =========================================================
+def cell_grid(cohort, n_months, pre=12, post=12):
+    """(g, t) pairs within the event window that have a valid base period."""
+    cohorts = np.unique(cohort[(cohort != NEVER_TREATED) & (cohort >= 1) & (cohort < n_months)])
+    cells = []
+    for g in cohorts:
+        for t in range(max(g - pre, 0), min(g + post, n_months - 1) + 1):
+            if t != g - 1:
+                cells.append((int(g), t))
+    return cells
+
+
+def estimate_att_gt(workdir, cells, n_jobs=1, include_never=True):
+    tasks = [(g, t, include_never) for g, t in cells]
+    with Pool(n_jobs, initializer=_open_panel, initargs=(workdir,)) as pool:
+        rows = pool.map(_cell_task, tasks, chunksize=max(1, len(tasks) // (4 * n_jobs)))
+    att_gt = pd.DataFrame([r for r in rows if r is not None], columns=CELL_COLUMNS)
+    att_gt["event_time"] = att_gt["period"] - att_gt["cohort"]
+    att_gt["lci"] = att_gt["att"] - 1.96 * att_gt["se"]
+    att_gt["uci"] = att_gt["att"] + 1.96 * att_gt["se"]
+    return att_gt
+
+
+def releasable(att_gt, redact_at=REDACT_AT):
+    """Cells whose treated and control counts both survive suppression."""
+    return (att_gt["n_treated"] > redact_at) & (att_gt["n_control"] > redact_at)
+
+
+def disclose_att_gt(att_gt, redact_at=REDACT_AT):
+    """att_gt for release: counts rounded / suppressed, estimates blanked where a count is suppressed."""
+    out = disclose(att_gt, ["n_treated", "n_control"], redact_at)
+    out.loc[~releasable(att_gt, redact_at), ["att", "se", "lci", "uci"]] = np.nan
+    return out
+
+
+def aggregate(att_gt, workdir, by, n_jobs=1, include_never=True):
+    """Cohort-size weighted averages of ATT(g, t) by event or calendar time.
+
+    by="event_time" averages over cohorts at each t - g; by="period" averages
+    over already-treated cohorts (t >= g) in each calendar month.
+    """
+    cells = att_gt if by == "event_time" else att_gt[att_gt["event_time"] >= 0]
+    tasks = []
+    for key, grp in cells.groupby(by):
+        weights = grp["n_treated"] / grp["n_treated"].sum()
+        tasks.append((key, list(zip(grp["cohort"], grp["period"])), weights.to_numpy(), include_never))
+
+    with Pool(n_jobs, initializer=_open_panel, initargs=(workdir,)) as pool:
+        rows = pool.map(_aggregate_task, tasks)
+    out = pd.DataFrame(rows, columns=[by, "att", "se"])
+    out["lci"] = out["att"] - 1.96 * out["se"]
+    out["uci"] = out["att"] + 1.96 * out["se"]
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Staggered-adoption ATT(g, t) for rheum PIFU entry cohorts")
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz")
+    parser.add_argument("--cohort", default="output/opa_events/dataset.csv.gz")
+    parser.add_argument("--pre", type=int, default=12)
+    parser.add_argument("--post", type=int, default=12)
+    parser.add_argument("--not-yet-treated-only", action="store_true",
+                        help="exclude never-PIFU patients from the control group")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    cohort_df = pd.read_csv(args.cohort, parse_dates=["first_rheum_pfu_date"]).sort_values("patient_id")
+    events = pd.read_csv(args.events, parse_dates=["appointment_date"])
+
+    visit_month = month_index(events["appointment_date"], STUDY_START)
+    n_months = int(visit_month.max()) + 1
+    treat_month = month_index(cohort_df["first_rheum_pfu_date"], STUDY_START)
+    panel = build_person_month_panel(
+        events["patient_id"].to_numpy(), visit_month, cohort_df["patient_id"].to_numpy(), treat_month, n_months,
+    )
+    y = panel["y"].reshape(len(cohort_df), n_months)
+    cohort = np.where(treat_month >= 0, treat_month, NEVER_TREATED)
+    include_never = not args.not_yet_treated_only
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        write_panel(y, cohort, workdir)
+        cells = cell_grid(cohort, n_months, args.pre, args.post)
+        if not cells:
+            raise SystemExit(f"no PIFU entry cohort between month 1 and {n_months - 1}: nothing to estimate")
+        att_gt = estimate_att_gt(workdir, cells, args.jobs, include_never)
+        released = att_gt[releasable(att_gt)]
+        event_time = aggregate(released, workdir, "event_time", args.jobs, include_never)
+        calendar = aggregate(released, workdir, "period", args.jobs, include_never)
+
+    write_csv(disclose_att_gt(att_gt), outdir / "att_gt.csv", index=False)
+    write_csv(event_time, outdir / "att_event_time.csv", index=False)
+    write_csv(calendar, outdir / "att_calendar_time.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#################################################################
+#Purpose
+#-----------
+# Time from first rheum PIFU (`first_rheum_pfu_date`) to the next OPA, with
+# censoring at the end of follow-up (`fu_days`: death, deregistration or
+# end of study) and death as a competing risk. Curves and log-rank tests
+# are computed for every stratifying column at once.
+
+#High-level logic
+#----------------
+#- Per PIFU patient: event 1 = next OPA on or before the end of follow-up,
+  # event 2 = death at the end of follow-up, otherwise censored. Times beyond
+  # --horizon days are censored at the horizon.
+#- All strata of all columns (plus "overall") are stacked into one array of
+  # (stratum, time, event) rows and sorted once. The risk-set counts come
+  # from grouped cumulative sums over that sorted array, so there is no
+  # per-stratum loop:
+  #   n_risk  = stratum size - exits before t
+  #   KM      = prod(1 - d1/n)        next OPA, death censored (+ Greenwood CI)
+  #   CIF_k   = sum S(t-) * d_k / n   Aalen-Johansen, S = all-cause KM
+#- Log-rank (next OPA, death censored) per column: the (times x levels)
+  # at-risk and event matrices are filled with bincount and reverse cumsums.
+  # O - E and its covariance then need one matrix product.
+
+#Inputs / Outputs
+#----------------
+#- output/dataset_definition_rheum.csv.gz (generate_dataset_definition_rheum)
+#- output/opa_events/opa.csv.gz (generate_opa_events): next OPA, used when
+  # the extract has no `days_to_next_visit`
+#- output/processed/next_visit_curves.csv  : stratum x time curves
+  # (released: built by `release_curves` from disclosure.round_cumulative
+  # counts, so each row's increments are 0 or >= CUMULATIVE_STEP and the
+  # curves are recomputed from those counts; strata whose size is
+  # suppressed are left out)
+#- output/processed/next_visit_logrank.csv : one test per stratifying column
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from dataset_io import DATASET_PATH, read_dataset
+from disclosure import round_counts, round_cumulative
+from output_manager import write_csv
+
+STRATA = [
+    "sex", "age_rheum_pfu_group", "ethnicity", "imd_quintile", "rural_urban_classification",
+    "latest_diag_category", "region", "covid_phase",
+]
+CENSORED, NEXT_VISIT, DEATH = 0, 1, 2
+
+# end of follow-up used by fu_days (features/demographics.py)
+FOLLOW_UP_END = "2026-12-31"
+
+
+def _days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]")
+
+
+# =========================================================
+# Outcome
+# =========================================================
+def next_visit_days(patient_ids, start, events):
+    """Days from `start` to each patient's first OPA after it (NaN = none)."""
+    code = pd.Index(patient_ids).get_indexer(events["patient_id"])
+    day = _days(events["appointment_date"]).astype(np.int64)
+    ok = (code >= 0) & (day > np.iinfo(np.int64).min)
+    # (patient row, day) packed into one sorted key; the first visit strictly
+    # after the start day is found by bisection and must belong to the patient
+    key = np.sort(code[ok] * (1 << 32) + day[ok])
+    rows = np.arange(len(patient_ids))
+    start_day = start.astype(np.int64)
+    at = np.searchsorted(key, rows * (1 << 32) + start_day, side="right")
+    hit = at < len(key)
+    hit[hit] &= key[at[hit]] >> 32 == rows[hit]
+    days = np.full(len(patient_ids), np.nan)
+    days[hit] = (key[at[hit]] & ((1 << 32) - 1)) - start_day[hit]
+    return days
+
+
+def outcome(df, next_days, horizon=None):
+    """(time, event) per PIFU patient with death as the competing event (time NaN = unknown)."""
+    start = _days(df["first_rheum_pfu_date"])
+    if "fu_days" in df.columns:
+        follow_up = df["fu_days"].to_numpy(np.float64)
+    else:
+        end = np.datetime64(FOLLOW_UP_END, "D")
+        for column in ("dod", "deregister_date"):
+            if column in df.columns:
+                end = np.fmin(end, _days(df[column]))
+        follow_up = (end - start).astype(np.float64)
+    died = np.zeros(len(df), bool)
+    if "dod" in df.columns:
+        dod = _days(df["dod"])
+        died = ~np.isnat(dod) & ((dod - start).astype(np.float64) <= follow_up)
+
+    visited = next_days <= follow_up
+    time = np.where(visited, next_days, follow_up)
+    event = np.where(visited, NEXT_VISIT, np.where(died, DEATH, CENSORED))
+    if horizon is not None:
+        event = np.where(time > horizon, CENSORED, event)
+        time = np.minimum(time, horizon)
+    return np.maximum(time, 0), event
+
+
+# =========================================================
+# Stacked strata
+# =========================================================
+def stack_strata(df, columns):
+    """Row index and global stratum code for every (column, level) plus overall."""
+    labels = [("overall", "all")]
+    rows = [np.arange(len(df))]
+    codes = [np.zeros(len(df), dtype=np.int64)]
+    for column in columns:
+        code, levels = pd.factorize(df[column].astype(object).fillna("missing"), sort=True)
+        codes.append(code + len(labels))
+        rows.append(np.arange(len(df)))
+        labels += [(column, str(level)) for level in levels]
+    return np.concatenate(rows), np.concatenate(codes), pd.DataFrame(labels, columns=["variable", "level"])
+
+
+def _group_cumsum(values, group_start):
+    """Cumulative sum restarting at every group start (values sorted by group)."""
+    total = np.cumsum(values)
+    start = np.maximum.accumulate(np.where(group_start, np.arange(len(values)), 0))
+    return total - (total - values)[start]
+
+
+def curves(stratum, time, event, labels, z=1.96):
+    """KM and cumulative incidence per stratum at every distinct event/censoring time."""
+    order = np.lexsort((time, stratum))
+    stratum, time, event = stratum[order], time[order], event[order]
+
+    # one row per distinct (stratum, time)
+    new = np.ones(len(time), bool)
+    new[1:] = (stratum[1:] != stratum[:-1]) | (time[1:] != time[:-1])
+    idx = np.flatnonzero(new)
+    key = np.cumsum(new) - 1
+    d1 = np.bincount(key, weights=event == NEXT_VISIT)
+    d2 = np.bincount(key, weights=event == DEATH)
+    exits = np.bincount(key).astype(np.float64)
+    s, t = stratum[idx], time[idx]
+
+    first = np.ones(len(s), bool)
+    first[1:] = s[1:] != s[:-1]
+    size = np.bincount(stratum, minlength=len(labels)).astype(np.float64)[s]
+    n = size - (_group_cumsum(exits, first) - exits)
+
+    out = labels.iloc[s].reset_index(drop=True)
+    return out.assign(
+        days=t, n_risk=n.astype(np.int64), n_next_visit=d1.astype(np.int64), n_death=d2.astype(np.int64),
+        n_censored=(exits - d1 - d2).astype(np.int64), **estimates(first, n, d1, d2, z),
+    )
+
+
+def estimates(first, n, d1, d2, z=1.96):
+    """KM (Greenwood log-log CI) and Aalen-Johansen CIFs from per-row at-risk and event counts."""
+    def product_limit(d):
+        """exp(grouped cumsum(log(1 - d/n))), exact zeros tracked separately."""
+        q = 1 - d / n
+        zero = _group_cumsum((q <= 0).astype(np.float64), first) > 0
+        log_s = _group_cumsum(np.log(np.where(q > 0, q, 1.0)), first)
+        return np.where(zero, 0.0, np.exp(log_s))
+
+    km = product_limit(d1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        greenwood = _group_cumsum(np.where(n > d1, d1 / (n * (n - d1)), 0.0), first)
+        # log(-log) interval, stays within [0, 1]
+        se_loglog = np.sqrt(greenwood) / np.abs(np.log(km))
+        lci = km ** np.exp(z * se_loglog)
+        uci = km ** np.exp(-z * se_loglog)
+
+    overall = product_limit(d1 + d2)
+    prev = np.where(first, 1.0, np.r_[1.0, overall[:-1]])
+    return {
+        "km_no_visit": km,
+        "km_lci": np.where(np.isfinite(se_loglog), lci, np.nan),
+        "km_uci": np.where(np.isfinite(se_loglog), uci, np.nan),
+        "cif_next_visit": _group_cumsum(prev * d1 / n, first),
+        "cif_death": _group_cumsum(prev * d2 / n, first),
+    }
+
+
+def release_curves(table, z=1.96):
+    """Curves for release, recomputed from cumulatively rounded counts.
+
+    Event and censoring counts are rounded with disclosure.round_cumulative
+    per stratum, the stratum size with round_counts, and the risk set is
+    rebuilt from those. Rows where nothing changes after rounding are
+    dropped, and strata with a suppressed size are left out.
+    """
+    first = np.ones(len(table), bool)
+    first[1:] = ((table["variable"].to_numpy()[1:] != table["variable"].to_numpy()[:-1])
+                 | (table["level"].to_numpy()[1:] != table["level"].to_numpy()[:-1]))
+    start = np.maximum.accumulate(np.where(first, np.arange(len(table)), 0))
+    size = round_counts(table["n_risk"].to_numpy()[start])
+    d1, d2, censored = (round_cumulative(table[c], first) for c in ("n_next_visit", "n_death", "n_censored"))
+    exits = d1 + d2 + censored
+    n = np.maximum(size - (_group_cumsum(exits, first) - exits), exits)
+
+    keep = ~np.isnan(size) & (first | (exits > 0))
+    first, n, d1, d2, censored = first[keep], n[keep], d1[keep], d2[keep], censored[keep]
+    out = table.loc[keep, ["variable", "level", "days"]].reset_index(drop=True)
+    return out.assign(
+        n_risk=n.astype(np.int64), n_next_visit=d1.astype(np.int64), n_death=d2.astype(np.int64),
+        n_censored=censored.astype(np.int64), **estimates(first, n, d1, d2, z),
+    )
+
+
+def logrank(codes, time, event, n_levels):
+    """Log-rank chi-square for next OPA across levels (death censored)."""
+    times, t_index = np.unique(time, return_inverse=True)
+    cell = t_index * n_levels + codes
+    shape = (len(times), n_levels)
+    d = np.bincount(cell, weights=event == NEXT_VISIT, minlength=shape[0] * shape[1]).reshape(shape)
+    exits = np.bincount(cell, minlength=shape[0] * shape[1]).reshape(shape)
+    n = np.cumsum(exits[::-1], axis=0)[::-1].astype(np.float64)     # at risk at each time
+
+    n_tot, d_tot = n.sum(axis=1), d.sum(axis=1)
+    use = (n_tot > 1) & (d_tot > 0)
+    n, d, n_tot, d_tot = n[use], d[use], n_tot[use], d_tot[use]
+    expected = n * (d_tot / n_tot)[:, None]
+    o_minus_e = (d - expected).sum(axis=0)
+    # V_jk = sum_t f_t n_jt (1[j = k] n_t - n_kt)
+    factor = d_tot * (n_tot - d_tot) / (n_tot**2 * (n_tot - 1))
+    cov = np.diag((n * (factor * n_tot)[:, None]).sum(axis=0)) - (n * factor[:, None]).T @ n
+    keep = np.flatnonzero(n.sum(axis=0) > 0)[:-1]
+    if len(keep) == 0:
+        return np.nan, 0, np.nan
+    chi2 = float(o_minus_e[keep] @ np.linalg.pinv(cov[np.ix_(keep, keep)]) @ o_minus_e[keep])
+    df = len(keep)
+    return chi2, df, float(stats.chi2.sf(chi2, df))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from first rheum PIFU to next OPA, death as competing risk")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--events", default="output/opa_events/opa.csv.gz",
+                        help="opa event table, used if the extract has no days_to_next_visit")
+    parser.add_argument("--strata", nargs="*", default=STRATA)
+    parser.add_argument("--horizon", type=int, default=730, help="censor at this many days")
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    columns = ["patient_id", "first_rheum_pfu_date", "days_to_next_visit", "fu_days", "dod",
+               "deregister_date"] + args.strata
+    df = read_dataset(args.dataset, columns=columns)
+    df = df[df["first_rheum_pfu_date"].notna()].sort_values("patient_id").reset_index(drop=True)
+    strata = [c for c in args.strata if c in df.columns]
+
+    if "days_to_next_visit" in df.columns:
+        next_days = df["days_to_next_visit"].to_numpy(np.float64)
+    else:
+        events = pd.read_csv(args.events, usecols=["patient_id", "appointment_date"])
+        next_days = next_visit_days(df["patient_id"].to_numpy(), _days(df["first_rheum_pfu_date"]), events)
+    time, event = outcome(df, next_days, args.horizon)
+    known = np.isfinite(time)
+    df, time, event = df[known].reset_index(drop=True), time[known].astype(np.int64), event[known]
+
+    rows, stratum, labels = stack_strata(df, strata)
+    table = curves(stratum, time[rows], event[rows], labels)
+
+    tests = []
+    for column in strata:
+        code = pd.factorize(df[column].astype(object).fillna("missing"))[0]
+        chi2, dof, p = logrank(code, time, event, code.max() + 1)
+        tests.append({"variable": column, "chi2": chi2, "df": dof, "p_value": p})
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    write_csv(release_curves(table), outdir / "next_visit_curves.csv", index=False)
+    write_csv(pd.DataFrame(tests), outdir / "next_visit_logrank.csv", index=False)
+    n_patients, *counts = round_counts([len(df), *np.bincount(event, minlength=3)])
+    print(f"{n_patients:.0f} PIFU patients: {counts[NEXT_VISIT]:.0f} next OPA, {counts[DEATH]:.0f} died, "
+          f"{counts[CENSORED]:.0f} censored (rounded); {len(labels)} strata")
+
+
+if __name__ == "__main__":
+    main()
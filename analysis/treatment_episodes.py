@@ -0,0 +1,192 @@
+#################################################################
+#Purpose
+#-----------
+# Continuous csDMARD / systemic steroid treatment episodes from the
+# prescription stream, and exposure status at anchor dates (first OPA,
+# first rheum OPA, first PIFU) and at the start of every measures month.
+# dataset_definition_rheum.py only keeps first/last date, code and count.
+
+#High-level logic
+#----------------
+#- Each prescription covers --supply-days from its issue date (the TPP
+  # medications table has no quantity or duration). Prescriptions are sorted
+  # once by (patient, category, date). A new episode starts where the
+  # category changes or the gap since the previous prescription's cover
+  # ends exceeds --gap days; episode ids are a cumulative sum of those breaks.
+#- Category = drug class ("dmard" / "steroid") or, with --level drug, the
+  # drug name, taken from the first word of the codelist `term`.
+#- Exposure at an anchor: episodes are sorted by a packed (patient,
+  # category, start) key. One searchsorted finds, for every (patient,
+  # category) query, the last episode starting on or before the anchor;
+  # the patient is exposed if that episode's end is after the anchor.
+#- Monthly exposure: each episode adds +1 at the first month start it
+  # covers and -1 at the first month start after it ends. A cumulative sum
+  # gives the number of patients on treatment at every month start.
+
+#Inputs / Outputs
+#----------------
+#- output/prescriptions/prescriptions.csv.gz and dataset.csv.gz
+  # (generate_prescriptions)
+#- output/processed/treatment_episodes.csv.gz : one row per episode
+#- output/processed/treatment_exposure.csv.gz : patient x anchor exposure flags
+#- output/processed/treatment_monthly.csv     : patients exposed per month start
+  # (released: counts go through disclosure.disclose)
+#################################################################
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import STUDY_START
+from disclosure import disclose
+from output_manager import write_csv
+
+CODELISTS = ["analysis/codelists/DMARD_cod.csv", "analysis/codelists/c19corstedrug_cod.csv"]
+ANCHORS = ["first_opa_date", "first_rheum_date", "first_rheum_pfu_date"]
+# large patient-level outputs: fast gzip, the default level dominates run time
+FAST_GZIP = {"method": "gzip", "compresslevel": 1}
+
+
+def _days(dates):
+    return pd.to_datetime(pd.Series(dates)).to_numpy("datetime64[D]").astype(np.int64)
+
+
+def drug_names(paths=CODELISTS):
+    """dm+d code -> drug name (first word of the codelist term)."""
+    names = {}
+    for path in paths:
+        if Path(path).exists():
+            codes = pd.read_csv(path, dtype=str)
+            names.update(zip(codes["code"], codes["term"].str.split().str[0].str.lower()))
+    return names
+
+
+# =========================================================
+# Episodes
+# =========================================================
+def build_episodes(patient, day, category, supply_days=28, gap_days=30):
+    """Episode table from prescription arrays (patient code, day, category code)."""
+    order = np.lexsort((day, category, patient))
+    patient, day, category = patient[order], day[order], category[order]
+
+    new = np.ones(len(day), bool)
+    new[1:] = (
+        (patient[1:] != patient[:-1])
+        | (category[1:] != category[:-1])
+        | (day[1:] - day[:-1] > supply_days + gap_days)
+    )
+    episode = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:], len(day)] - 1
+    return pd.DataFrame({
+        "patient": patient[first],
+        "category": category[first],
+        "start": day[first],
+        "end": day[last] + supply_days,           # first day no longer covered
+        "n_prescriptions": np.bincount(episode),
+    })
+
+
+def _packed(patient, category, day, n_categories):
+    return (patient * n_categories + category) * (1 << 32) + (day + (1 << 31))
+
+
+def exposure_at(episodes, patient, anchor_day, n_categories):
+    """(patients x categories) boolean exposure on anchor_day (NaT anchor -> False)."""
+    key = _packed(episodes["patient"].to_numpy(), episodes["category"].to_numpy(),
+                  episodes["start"].to_numpy(), n_categories)
+    end = episodes["end"].to_numpy()
+    p = np.repeat(patient, n_categories)
+    c = np.tile(np.arange(n_categories), len(patient))
+    a = np.repeat(anchor_day, n_categories)
+    missing = a == np.iinfo(np.int64).min
+    a = np.where(missing, 0, a)
+    query = _packed(p, c, a, n_categories)
+    at = np.searchsorted(key, query, side="right") - 1
+    hit = at >= 0
+    hit[hit] &= (key[at[hit]] >> 32) == (query[hit] >> 32)      # same patient and category
+    hit[hit] &= end[at[hit]] > a[hit]
+    hit &= ~missing
+    return hit.reshape(len(patient), n_categories)
+
+
+def monthly_exposure(episodes, n_categories, months):
+    """(months x categories) patients exposed at each month start."""
+    month_days = _days(months)
+    first = np.searchsorted(month_days, episodes["start"].to_numpy(), side="left")
+    after = np.searchsorted(month_days, episodes["end"].to_numpy(), side="left")
+    category = episodes["category"].to_numpy()
+    size = (len(months) + 1) * n_categories
+    change = (
+        np.bincount(first * n_categories + category, minlength=size)
+        - np.bincount(after * n_categories + category, minlength=size)
+    ).reshape(len(months) + 1, n_categories)
+    return np.cumsum(change, axis=0)[:-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DMARD / steroid treatment episodes and exposure")
+    parser.add_argument("--prescriptions", default="output/prescriptions/prescriptions.csv.gz")
+    parser.add_argument("--cohort", default="output/prescriptions/dataset.csv.gz")
+    parser.add_argument("--level", choices=["class", "drug"], default="class")
+    parser.add_argument("--supply-days", type=int, default=28, help="days covered by one prescription")
+    parser.add_argument("--gap", type=int, default=30, help="permissible gap between covers, days")
+    parser.add_argument("--anchors", nargs="*", default=ANCHORS)
+    parser.add_argument("--outdir", default="output/processed")
+    args = parser.parse_args()
+
+    cohort = pd.read_csv(args.cohort).sort_values("patient_id").reset_index(drop=True)
+    rx = pd.read_csv(args.prescriptions, dtype={"dmd_code": str, "drug_class": str})
+    rx = rx[rx["date"].notna()]
+
+    if args.level == "drug":
+        names = drug_names()
+        if not names:
+            print("no codelist terms found; using dm+d codes as drug categories")
+        labels = rx["dmd_code"].map(names).fillna(rx["dmd_code"])
+    else:
+        labels = rx["drug_class"]
+    category, categories = pd.factorize(labels, sort=True)
+    patient = pd.Index(cohort["patient_id"]).get_indexer(rx["patient_id"])
+    known = patient >= 0
+    episodes = build_episodes(
+        patient[known], _days(rx["date"])[known], category[known], args.supply_days, args.gap
+    )
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    labelled = episodes.assign(
+        patient_id=cohort["patient_id"].to_numpy()[episodes["patient"]],
+        category=categories[episodes["category"]],
+        start=episodes["start"].to_numpy().astype("datetime64[D]"),
+        end=episodes["end"].to_numpy().astype("datetime64[D]"),
+    )
+    write_csv(
+        labelled[["patient_id", "category", "start", "end", "n_prescriptions"]],
+        outdir / "treatment_episodes.csv.gz", index=False, compression=FAST_GZIP,
+    )
+
+    exposure = pd.DataFrame({"patient_id": cohort["patient_id"]})
+    rows = np.arange(len(cohort))
+    for anchor in [a for a in args.anchors if a in cohort.columns]:
+        flags = exposure_at(episodes, rows, _days(cohort[anchor]), len(categories))
+        for j, name in enumerate(categories):
+            exposure[f"{name}_at_{anchor.removesuffix('_date')}"] = flags[:, j]
+    write_csv(exposure, outdir / "treatment_exposure.csv.gz", index=False, compression=FAST_GZIP)
+
+    last = pd.to_datetime(rx["date"]).max()
+    months = pd.date_range(STUDY_START, last, freq="MS")
+    counts = monthly_exposure(episodes, len(categories), months)
+    monthly = pd.DataFrame({
+        "month": np.repeat(months.strftime("%Y-%m-%d"), len(categories)),
+        "category": np.tile(categories, len(months)),
+        "patients_exposed": counts.ravel(),
+    })
+    write_csv(disclose(monthly, ["patients_exposed"]), outdir / "treatment_monthly.csv", index=False)
+    print(f"{len(rx)} prescriptions -> {len(episodes)} episodes in {len(categories)} categories")
+
+
+if __name__ == "__main__":
+    main()
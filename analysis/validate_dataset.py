@@ -0,0 +1,385 @@
+#################################################################
+#Purpose
+#-----------
+# Check an extracted dataset against analysis/data_dictionary.md: column
+# types, allowed category values, ranges, required / unique columns and
+# the cross-column rules listed in the dictionary (e.g.
+# first_rheum_pfu_date >= first_rheum_date). Reports violation counts per
+# check and a few offending patient_ids.
+
+#High-level logic
+#----------------
+#- The dictionary is compiled once into a Schema per "Data Dictionary:"
+  # section. Cells are escaped markdown (\*\*first\\\_opa\\\_date\*\*), so
+  # backslashes and bold markers are stripped before reading them. The
+  # Values column holds `backticked` categories, an inclusive [low, high]
+  # range and the words required / unique; rules are the backticked
+  # `a op b` items of the section's rule list.
+#- The file is read once, in chunks, only for the columns that have a check
+  # (CSV via the pandas C reader with numbers as float64 and categories as
+  # category; Parquet via pyarrow record batches). If a numeric column holds
+  # text the CSV is re-read with numbers as text to locate it. Each column
+  # is parsed once per chunk; every check is a boolean mask over the chunk,
+  # summed into the counts, and the first --samples patient_ids per check
+  # are kept. Uniqueness is checked on the collected ids at the end.
+#- The section is picked by the best overlap with the file's columns
+  # unless --section is given.
+
+#Inputs / Outputs
+#----------------
+#- analysis/data_dictionary.md, the dataset to check
+#- output/processed/validation_report.csv  : check, kind, checked, violations
+  # (released: patient-count rows go through disclosure.disclose, schema
+  # checks such as missing / undocumented columns are not patient counts
+  # and stay as they are; --strict uses the exact counts)
+#- output/processed/validation_samples.csv : check, patient_id (examples)
+#################################################################
+
+import argparse
+import operator
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import DATASET_PATH
+from disclosure import round_counts
+from output_manager import write_csv
+
+DICTIONARY = "analysis/data_dictionary.md"
+ID_COLUMN = "patient_id"
+
+OPERATORS = {
+    ">=": operator.ge, "<=": operator.le, ">": operator.gt,
+    "<": operator.lt, "==": operator.eq, "!=": operator.ne,
+}
+RULE = re.compile(r"^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(\w+)\s*$")
+
+
+# =========================================================
+# Dictionary -> schema
+# =========================================================
+@dataclass
+class Column:
+    name: str
+    type: str                       # int / float / date / str
+    max_length: int = None          # strN
+    domain: tuple = None
+    low: object = None
+    high: object = None
+    required: bool = False
+    unique: bool = False
+
+
+@dataclass
+class Rule:
+    left: str
+    op: str
+    right: str
+
+    @property
+    def name(self):
+        return f"{self.left} {self.op} {self.right}"
+
+
+@dataclass
+class Schema:
+    name: str
+    columns: dict = field(default_factory=dict)
+    rules: list = field(default_factory=list)
+
+
+def _unescape(text):
+    return text.replace("\\", "").replace("**", "").strip()
+
+
+def _bound(text, kind):
+    text = text.strip()
+    if not text:
+        return None
+    return np.datetime64(text, "D") if kind == "date" else float(text)
+
+
+def _column(cells):
+    """Column spec from one table row ({header: unescaped cell})."""
+    kind = cells.get("type", "str").lower()
+    max_length = None
+    if kind.startswith("str") and kind[3:].isdigit():
+        kind, max_length = "str", int(kind[3:])
+    values = cells.get("values", "")
+    domain = tuple(re.findall(r"`([^`]*)`", values)) or None
+    low = high = None
+    bounds = re.search(r"\[([^\]]*)\]", re.sub(r"`[^`]*`", "", values))
+    if bounds:
+        low, high = (_bound(b, kind) for b in (bounds.group(1).split(",") + [""])[:2])
+    words = set(re.findall(r"[a-z]+", re.sub(r"`[^`]*`|\[[^\]]*\]", "", values)))
+    return Column(cells["variable"], kind, max_length, domain, low, high,
+                  "required" in words, "unique" in words)
+
+
+def parse_dictionary(path=DICTIONARY):
+    """{section name: Schema} from the markdown data dictionary."""
+    schemas, current, header = {}, None, None
+    for raw in Path(path).read_text(encoding="utf-8").splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        text = _unescape(line)
+        if text.startswith("#"):
+            title = text.lstrip("#").strip()
+            if title.lower().startswith("data dictionary:"):
+                name = title.split(":", 1)[1].strip()
+                current = schemas.setdefault(name, Schema(name))
+            header = None
+            continue
+        if current is None:
+            continue
+        if line.startswith("|"):
+            cells = [_unescape(c) for c in line.strip("|").split("|")]
+            if all(set(c) <= set("-: ") for c in cells):
+                continue
+            if header is None:
+                header = [c.lower() for c in cells]
+                continue
+            row = dict(zip(header, cells))
+            if row.get("variable"):
+                column = _column(row)
+                current.columns[column.name] = column
+        elif line.startswith(("-", "*")):
+            header = None
+            expression = re.search(r"`([^`]*)`", text)
+            match = RULE.match(expression.group(1)) if expression else None
+            if match:
+                current.rules.append(Rule(*match.groups()))
+    return schemas
+
+
+def pick_schema(schemas, columns, section=None):
+    if section is not None:
+        return schemas[section]
+    return max(schemas.values(), key=lambda s: len(set(s.columns) & set(columns)))
+
+
+# =========================================================
+# Chunked validation
+# =========================================================
+def read_chunks(path, columns, chunksize, dtypes=None):
+    path = Path(path)
+    if path.name.endswith(".parquet"):
+        # optional dependency, only needed for Parquet files
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas(date_as_object=False)
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=dtypes or str, keep_default_na=False,
+                               na_values=[""], chunksize=chunksize)
+
+
+def csv_dtypes(schema, columns, text_numbers=False):
+    """C-reader dtypes: numbers as float64, categories as category, the rest as text."""
+    dtypes = {}
+    for name in columns:
+        column = schema.columns[name]
+        if column.type in ("int", "float") and not text_numbers:
+            dtypes[name] = "float64"
+        elif column.domain is not None:
+            dtypes[name] = "category"
+        else:
+            dtypes[name] = str
+    return dtypes
+
+
+def header_of(path):
+    path = Path(path)
+    if path.name.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return list(pq.ParquetFile(path).schema_arrow.names)
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def _dates(values):
+    """datetime64[D] array; unparseable text -> NaT."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.to_numpy("datetime64[D]")
+    return pd.to_datetime(values, format="%Y-%m-%d", errors="coerce").to_numpy("datetime64[D]")
+
+
+def parse_column(values, column):
+    """(parsed values, null mask, type-violation mask) for one chunk column."""
+    null = values.isna().to_numpy()
+    if column.type == "date":
+        parsed = _dates(values)
+        return parsed, null, np.isnat(parsed) & ~null
+    if column.type in ("int", "float"):
+        if pd.api.types.is_float_dtype(values):
+            parsed = values.to_numpy(np.float64)
+        else:
+            parsed = pd.to_numeric(values, errors="coerce").to_numpy(np.float64)
+        bad = np.isnan(parsed) & ~null
+        if column.type == "int":
+            bad |= ~np.isnan(parsed) & (parsed != np.floor(parsed))
+        return parsed, null, bad
+    return values.to_numpy(dtype=object), null, np.zeros(len(values), bool)
+
+
+def chunk_checks(chunk, schema):
+    """{check name: (kind, checked mask, violation mask)} for one chunk."""
+    checks, parsed = {}, {}
+    for name in chunk.columns:
+        column = schema.columns[name]
+        values, null, bad_type = parse_column(chunk[name], column)
+        parsed[name] = (values, null | bad_type)
+        present = ~null
+        if column.required:
+            checks[f"{name} required"] = ("required", np.ones(len(null), bool), null)
+        checks[f"{name} type {column.type}"] = ("type", present, bad_type)
+        valid = present & ~bad_type
+        if column.max_length is not None:
+            lengths = chunk[name].str.len().to_numpy(np.float64)
+            checks[f"{name} length <= {column.max_length}"] = ("type", present, present & (lengths > column.max_length))
+        if column.domain is not None:
+            outside = ~chunk[name].isin(column.domain).to_numpy()
+            checks[f"{name} in domain"] = ("domain", present, present & outside)
+        if column.low is not None or column.high is not None:
+            out = np.zeros(len(values), bool)
+            if column.low is not None:
+                out |= valid & (values < column.low)
+            if column.high is not None:
+                out |= valid & (values > column.high)
+            low = "" if column.low is None else column.low
+            high = "" if column.high is None else column.high
+            checks[f"{name} in [{low}, {high}]"] = ("range", valid, out)
+
+    for rule in schema.rules:
+        if rule.left not in parsed or rule.right not in parsed:
+            continue
+        (left, left_missing), (right, right_missing) = parsed[rule.left], parsed[rule.right]
+        both = ~left_missing & ~right_missing
+        with np.errstate(invalid="ignore"):
+            holds = OPERATORS[rule.op](left, right)
+        checks[rule.name] = ("rule", both, both & ~holds)
+    return checks
+
+
+def checked_columns(schema, header):
+    """Documented columns that have something to check (plus patient_id)."""
+    in_rules = {c for rule in schema.rules for c in (rule.left, rule.right)}
+    return [
+        name for name in header
+        if name in schema.columns and (
+            name == ID_COLUMN or name in in_rules or schema.columns[name].type != "str"
+            or schema.columns[name].domain is not None or schema.columns[name].max_length is not None
+            or schema.columns[name].required
+        )
+    ]
+
+
+def _scan(path, schema, columns, chunksize, n_samples, dtypes):
+    rows, samples, ids = {}, {}, []
+    for chunk in read_chunks(path, columns, chunksize, dtypes):
+        patient_id = chunk[ID_COLUMN].to_numpy() if ID_COLUMN in chunk else np.arange(len(chunk))
+        if ID_COLUMN in chunk and schema.columns[ID_COLUMN].unique:
+            ids.append(pd.to_numeric(chunk[ID_COLUMN], errors="coerce").to_numpy(np.float64))
+        for name, (kind, checked, violation) in chunk_checks(chunk, schema).items():
+            total = rows.setdefault(name, {"check": name, "kind": kind, "checked": 0, "violations": 0})
+            total["checked"] += int(checked.sum())
+            total["violations"] += int(violation.sum())
+            kept = samples.setdefault(name, [])
+            if len(kept) < n_samples and violation.any():
+                kept.extend(patient_id[violation][: n_samples - len(kept)].tolist())
+    return rows, samples, ids
+
+
+def validate(path, schema, chunksize=1_000_000, n_samples=5):
+    """Report and sample frames from one pass over the file."""
+    header = header_of(path)
+    columns = checked_columns(schema, header)
+    try:
+        rows, samples, ids = _scan(path, schema, columns, chunksize, n_samples, csv_dtypes(schema, columns))
+    except ValueError:
+        # a non-numeric value in a numeric column: re-read numbers as text to find it
+        dtypes = csv_dtypes(schema, columns, text_numbers=True)
+        rows, samples, ids = _scan(path, schema, columns, chunksize, n_samples, dtypes)
+
+    if ids:
+        ids = np.sort(np.concatenate(ids))
+        ids = ids[~np.isnan(ids)]
+        duplicated = ids[1:][ids[1:] == ids[:-1]]
+        name = f"{ID_COLUMN} unique"
+        rows[name] = {"check": name, "kind": "unique", "checked": len(ids), "violations": len(duplicated)}
+        samples[name] = np.unique(duplicated)[:n_samples].astype(np.int64).tolist()
+
+    for name in schema.columns:
+        if name not in header:
+            rows[f"{name} present"] = {"check": f"{name} present", "kind": "missing_column",
+                                       "checked": 1, "violations": 1}
+    for name in header:
+        if name not in schema.columns:
+            rows[f"{name} documented"] = {"check": f"{name} documented", "kind": "undocumented_column",
+                                          "checked": 1, "violations": 1}
+    for rule in schema.rules:
+        if rule.name not in rows:
+            rows[rule.name] = {"check": rule.name, "kind": "rule", "checked": 0, "violations": 0}
+
+    report = pd.DataFrame(list(rows.values()), columns=["check", "kind", "checked", "violations"])
+    sample_frame = pd.DataFrame(
+        [(name, pid) for name, kept in samples.items() for pid in kept], columns=["check", ID_COLUMN]
+    )
+    return report, sample_frame
+
+
+# checks about the file's columns, not its patients
+SCHEMA_KINDS = {"missing_column", "undocumented_column"}
+
+
+def disclose_report(report):
+    """Report for release: checked / violations rounded and suppressed on patient-count rows only."""
+    out = report.copy()
+    counts = ~out["kind"].isin(SCHEMA_KINDS).to_numpy()
+    for column in ("checked", "violations"):
+        values = out[column].to_numpy(np.float64)
+        out[column] = pd.array(np.where(counts, round_counts(values), values), dtype="Int64")
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate an extract against the data dictionary")
+    parser.add_argument("--dataset", default=DATASET_PATH, help=".csv[.gz] or .parquet")
+    parser.add_argument("--dictionary", default=DICTIONARY)
+    parser.add_argument("--section", help="dictionary section (default: best column overlap)")
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    parser.add_argument("--samples", type=int, default=5, help="patient_ids kept per failing check")
+    parser.add_argument("--outdir", default="output/processed")
+    parser.add_argument("--strict", action="store_true", help="exit non-zero on any violation")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    schemas = parse_dictionary(args.dictionary)
+    schema = pick_schema(schemas, header_of(args.dataset), args.section)
+    report, samples = validate(args.dataset, schema, args.chunksize, args.samples)
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    released = disclose_report(report)
+    write_csv(released, outdir / "validation_report.csv", index=False)
+    write_csv(samples, outdir / "validation_samples.csv", index=False)
+
+    failing = report[report["violations"] > 0]
+    print(f"{args.dataset} vs '{schema.name}': {len(report)} checks, {len(failing)} failing "
+          f"({time.perf_counter() - start:.1f}s)")
+    for row in released[report["violations"] > 0].itertuples():
+        if row.kind in SCHEMA_KINDS:
+            print(f"  {row.check}: no")
+        else:
+            print(f"  {row.check}: {row.violations} of {row.checked} (rounded)")
+    if args.strict and len(failing):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,141 @@
 ####################################################################
-# This code extracts all people who had a rheumatology outpatient visit
+# Shared derived-variable helpers:
+#- declarative binning specs (edges + labels) for age bands, IMD quintile
+  # and COVID phase, turned into ehrQL case/when expressions by to_ehrql()
+  # and applied to NumPy arrays by bin_codes() / bin_labels(), so ehrQL
+  # definitions and local engines band values identically;
+#- opa_characteristics(): the original extraction of all people who had a
+  # rheumatology outpatient visit.
+#ehrQL and NumPy are imported where used: ehrQL definitions (ehrql:v1) and
+#local modules (python:v2) both import this file and only one is installed.
 ####################################################################
 
-
-from ehrql import create_dataset, case, when, years, days, weeks, show
-from ehrql.tables.tpp import patients, practice_registrations, clinical_events, opa
-
-dataset = create_dataset()
-dataset.configure_dummy_data(population_size=9000)
-
-
+import datetime
+from dataclasses import dataclass
+from functools import reduce
+from operator import and_
+
+
+# =========================================================
+# Binning specs
+# =========================================================
+@dataclass(frozen=True)
+class Bins:
+    """Consecutive intervals between `edges` (None = unbounded), one label each.
+
+    closed="left" gives [lo, hi); closed="right" gives (lo, hi] with the lowest
+    edge included. Null and out-of-range values get `otherwise`.
+    """
+    edges: tuple
+    labels: tuple
+    closed: str = "left"
+    otherwise: object = "missing"
+
+    def __post_init__(self):
+        if len(self.labels) != len(self.edges) - 1:
+            raise ValueError(f"{len(self.edges)} edges need {len(self.edges) - 1} labels, got {len(self.labels)}")
+        if self.closed not in ("left", "right"):
+            raise ValueError(f"closed must be 'left' or 'right', not {self.closed!r}")
+
+
+AGE_EDGES = (None, 18, 30, 40, 50, 60, 70, 80, 90, None)
+
+# age_opa_group / age_rheum_pfu_group
+AGE_BANDS = Bins(AGE_EDGES, ("0-17", "18-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80-89", "90+"))
+
+# measures.py age_band: same edges, adults only (under 18 -> "missing")
+MEASURES_AGE_BANDS = Bins(
+    AGE_EDGES[1:],
+    tuple(f"age_{label.replace('-', '_')}" for label in AGE_BANDS.labels[1:]),
+)
+
+# number of LSOAs in England, used for the fixed IMD quintile cutpoints;
+# imd_rounded starts at 0 (not 1) because it is rounded
+N_LSOA = 32844
+IMD_QUINTILES = Bins(
+    tuple(int(N_LSOA * k / 5) for k in range(6)),
+    ("1 (most deprived)", "2", "3", "4", "5 (least deprived)"),
+    closed="right",
+    otherwise="unknown",
+)
+
+# covid_phase of the first OPA date
+COVID_PHASES = Bins(
+    (None, datetime.date(2020, 1, 1), datetime.date(2022, 1, 1), None),
+    ("pre", "peri", "post"),
+    otherwise=None,
+)
+
+
+def to_ehrql(bins, series):
+    """ehrQL case/when expression banding `series` (first matching bin wins)."""
+    from ehrql import case, when
+
+    branches = []
+    last = len(bins.labels) - 1
+    for i, label in enumerate(bins.labels):
+        lo, hi = bins.edges[i], bins.edges[i + 1]
+        conditions = []
+        if lo is not None:
+            conditions.append(series >= lo if bins.closed == "left" or i == 0 else series > lo)
+        if hi is not None:
+            conditions.append(series < hi if bins.closed == "left" else series <= hi)
+        if not conditions:
+            conditions.append(series.is_not_null())
+        branches.append(when(reduce(and_, conditions)).then(label))
+    return case(*branches, otherwise=bins.otherwise)
+
+
+def _edge_values(bins):
+    """Edges as float64 (dates as days since 1970-01-01), unbounded as +-inf."""
+    import numpy as np
+
+    finite = [e for e in bins.edges if e is not None]
+    dates = bool(finite) and isinstance(finite[0], datetime.date)
+    edges = np.array([
+        (-np.inf if i == 0 else np.inf) if e is None
+        else (np.datetime64(e, "D").astype(np.int64) if dates else e)
+        for i, e in enumerate(bins.edges)
+    ], dtype=np.float64)
+    return edges, dates
+
+
+def bin_codes(bins, values):
+    """Bin index of every value (searchsorted); -1 for null / out of range."""
+    import numpy as np
+
+    edges, dates = _edge_values(bins)
+    if dates:
+        days = np.asarray(values, dtype="datetime64[D]")
+        x = np.where(np.isnat(days), np.nan, days.astype(np.int64).astype(np.float64))
+    else:
+        x = np.asarray(values, dtype=np.float64)
+    if bins.closed == "left":
+        code = np.searchsorted(edges, x, side="right") - 1
+    else:
+        code = np.searchsorted(edges, x, side="left") - 1
+        code[x == edges[0]] = 0
+    n = len(bins.labels)
+    return np.where(np.isnan(x) | (code < 0) | (code >= n), -1, code)
+
+
+def bin_labels(bins, values):
+    """Label of every value, `otherwise` for null / out of range (object array)."""
+    import numpy as np
+
+    lookup = np.array(list(bins.labels) + [bins.otherwise], dtype=object)
+    return lookup[bin_codes(bins, values)]
+
+
+# =========================================================
+# Rheumatology OPA extraction
+# =========================================================
 def opa_characteristics(all_opa):
+    from ehrql import create_dataset, days, years
+    from ehrql.tables.tpp import patients, practice_registrations
+
+    dataset = create_dataset()
+    dataset.configure_dummy_data(population_size=9000)
 
     # everyone with an outpatient visit
     first_opa = all_opa.where(
@@ -86,17 +211,7 @@ def opa_characteristics(all_opa):
     dataset.sex = patients.sex
 
     dataset.age = patients.age_on(dataset.first_opa_date)
-    dataset.age_group = case(
-            when(dataset.age < 30).then("18-29"),
-            when(dataset.age < 40).then("30-39"),
-            when(dataset.age < 50).then("40-49"),
-            when(dataset.age < 60).then("50-59"),
-            when(dataset.age < 70).then("60-69"),
-            when(dataset.age < 80).then("70-79"),
-            when(dataset.age < 90).then("80-89"),
-            when(dataset.age >= 90).then("90+"),
-            otherwise="missing",
-    )
+    dataset.age_group = to_ehrql(AGE_BANDS, dataset.age)
 
     dataset.region = practice_registrations.for_patient_on(dataset.first_opa_date).practice_nuts1_region_name
 
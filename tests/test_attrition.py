@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from attrition import CRITERIA, funnel, mask_histogram, mask_table
+
+
+def extract(n=500, seed=8):
+    rng = np.random.default_rng(seed)
+    first_opa = pd.to_datetime("2018-01-01") + pd.to_timedelta(rng.integers(0, 2500, n), "D")
+    death = first_opa + pd.to_timedelta(rng.integers(-400, 400, n), "D")
+    return pd.DataFrame({
+        "patient_id": np.arange(n),
+        "age_opa": np.where(rng.random(n) < 0.05, np.nan, rng.integers(5, 95, n)),
+        "has_any_diagnosis": rng.choice(["T", "F"], n, p=[0.7, 0.3]),
+        "date_of_death": pd.Series(death).where(rng.random(n) < 0.2),
+        "registered_at_first_opa": rng.choice(["T", "F", None], n, p=[0.85, 0.1, 0.05]),
+        "first_opa_date": pd.Series(first_opa).where(rng.random(n) < 0.9),
+    })
+
+
+def naive_passes(row):
+    """The define_population criteria, one patient at a time."""
+    return [
+        not pd.isna(row.age_opa) and row.age_opa >= 18,
+        row.has_any_diagnosis == "T",
+        pd.isna(row.date_of_death) or (not pd.isna(row.first_opa_date) and row.date_of_death > row.first_opa_date),
+        row.registered_at_first_opa == "T",
+        not pd.isna(row.first_opa_date),
+    ]
+
+
+def test_histogram_and_funnel_match_a_row_loop(tmp_path):
+    df = extract()
+    path = tmp_path / "attrition.csv.gz"
+    df.to_csv(path, index=False)
+    histogram, seconds = mask_histogram(path, chunksize=97)
+    assert len(seconds) == len(CRITERIA)
+
+    passes = [naive_passes(row) for row in df.itertuples()]
+    expected = np.zeros(1 << len(CRITERIA), dtype=np.int64)
+    for ok in passes:
+        expected[sum(1 << bit for bit, p in enumerate(ok) if not p)] += 1
+    np.testing.assert_array_equal(histogram, expected)
+
+    order = [3, 0, 4, 1, 2]
+    report = funnel(histogram, order=order)
+    left = list(range(len(df)))
+    for bit, row in zip(order, report.itertuples()):
+        assert row.criterion == CRITERIA[bit].name
+        assert row.failing == sum(not ok[bit] for ok in passes)
+        assert row.marginal_excluded == sum(not ok[bit] and sum(ok) == len(ok) - 1 for ok in passes)
+        dropped = [i for i in left if not passes[i][bit]]
+        left = [i for i in left if passes[i][bit]]
+        assert row.sequential_excluded == len(dropped) and row.remaining == len(left)
+    assert report["remaining"].iloc[-1] == sum(all(ok) for ok in passes) == histogram[0]
+
+    masks = mask_table(histogram)
+    assert masks["patients"].sum() == len(df)
+    assert masks.loc[masks["mask"] == 0, "failed_criteria"].item() == "(included)"
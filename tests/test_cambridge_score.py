@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cambridge_score import (
+    CONDITIONS, CRITERIA, condition_matrix, criterion_codes, criterion_counts, load_config, parse_rule, score,
+)
+
+
+def test_shipped_config_is_not_runnable_until_filled_in():
+    with pytest.raises(SystemExit, match="no condition rules"):
+        load_config(CONDITIONS, CRITERIA)
+
+
+@pytest.mark.parametrize("rule", ["__import__('os')", "a and b", "a + b", "a.b", "a |"])
+def test_rules_only_combine_names(rule):
+    with pytest.raises(ValueError):
+        parse_rule(rule)
+
+
+def test_rule_names():
+    assert parse_rule("(a | b) & ~c")[1] == {"a", "b", "c"}
+
+
+def write_config(tmp_path, conditions, criteria):
+    pd.DataFrame({"code": ["C1"]}).to_csv(tmp_path / "diag.csv", index=False)
+    pd.DataFrame({"dmd": ["D1", "D2"]}).to_csv(tmp_path / "rx.csv", index=False)
+    pd.DataFrame(conditions, columns=["condition", "rule", "weight"]).to_csv(tmp_path / "conditions.csv", index=False)
+    criteria = [[name, source, str(tmp_path / codelist), column, lookback, n]
+                for name, source, codelist, column, lookback, n in criteria]
+    pd.DataFrame(criteria, columns=["criterion", "source", "codelist", "column", "lookback_days", "min_events"]).to_csv(
+        tmp_path / "criteria.csv", index=False)
+    return load_config(tmp_path / "conditions.csv", tmp_path / "criteria.csv")
+
+
+def test_prescriptions_without_diagnosis(tmp_path):
+    # condition: >= 4 prescriptions in the last year AND NOT a diagnosis code ever
+    criteria, conditions = write_config(
+        tmp_path,
+        [["Painful condition", "rx_4_in_12m & ~diagnosis", "0.5"], ["Other", "diagnosis | rx_4_in_12m", ""]],
+        [["rx_4_in_12m", "medications", "rx.csv", "dmd", "365", "4"],
+         ["diagnosis", "clinical_events", "diag.csv", "", "", ""],
+         ["unused", "medications", "rx.csv", "dmd", "", ""]],
+    )
+    assert list(criteria["criterion"]) == ["rx_4_in_12m", "diagnosis"]
+    anchor = np.datetime64("2022-01-01")
+    rx_dates = [anchor - np.timedelta64(d, "D") for d in (10, 50, 100, 200)]
+    events = {
+        "medications": pd.DataFrame({
+            "patient": [0] * 4 + [1] * 4 + [2] * 4 + [3] * 3,
+            "date": rx_dates * 3 + rx_dates[:3],
+            "code": ["D1", "D2", "D1", "D2"] * 2 + ["D1", "D1", "D1", "X"] + ["D1"] * 3,
+        }),
+        "clinical_events": pd.DataFrame({"patient": [1], "date": [anchor - np.timedelta64(3000, "D")], "code": ["C1"]}),
+    }
+    anchor_day = np.full(5, anchor.astype("datetime64[D]").astype(np.int64))
+    counts = criterion_counts(events, anchor_day, criteria, criterion_codes(criteria), 5)
+    indicators = condition_matrix(counts, criteria, conditions).toarray()
+    # 0: 4 rx, no code; 1: 4 rx + code; 2: only 3 rx in the codelist; 3: 3 rx; 4: nothing
+    np.testing.assert_array_equal(indicators[:, 0], [1, 0, 0, 0, 0])
+    np.testing.assert_array_equal(indicators[:, 1], [1, 1, 0, 0, 0])
+    np.testing.assert_array_equal(score(indicators, conditions), [0.5, 0, 0, 0, 0])
+
+
+def test_undefined_and_incomplete_criteria_exit(tmp_path):
+    with pytest.raises(SystemExit, match="not defined"):
+        write_config(tmp_path, [["A", "missing", "1"]], [["diagnosis", "clinical_events", "diag.csv", "", "", ""]])
+    with pytest.raises(SystemExit, match="need a codelist"):
+        write_config(tmp_path, [["A", "diagnosis", "1"]], [["diagnosis", "gp_records", "diag.csv", "", "", ""]])
@@ -0,0 +1,57 @@
+import numpy as np
+
+import cost_effectiveness
+from cost_effectiveness import (
+    ARMS, DEFAULTS, estimate_parameters, icer, point_parameters, run_cohort, run_microsimulation,
+)
+
+
+def naive_parameters(pfu_day, patient, day, study_start, data_end, window=365):
+    pifu_visits = trad_visits = returns = 0
+    pifu_years = trad_years = exposure = 0.0
+    for i, pfu in enumerate(pfu_day):
+        mine = sorted(d for p, d in zip(patient, day) if p == i)
+        pifu_visits += sum(pfu < d <= pfu + window for d in mine)
+        trad_visits += sum(pfu - window <= d < pfu for d in mine)
+        censor = max(0, min(window, data_end - pfu))
+        pifu_years += censor / 365.25
+        trad_years += max(0, min(window, pfu - study_start)) / 365.25
+        later = [d - pfu for d in mine if d > pfu]
+        if later and later[0] <= censor:
+            returns += 1
+            exposure += later[0]
+        else:
+            exposure += censor
+    return pifu_visits, pifu_years, trad_visits, trad_years, returns, exposure / 30.4375
+
+
+def test_estimate_parameters_matches_naive_loop():
+    rng = np.random.default_rng(0)
+    study_start, data_end = 0, 3000
+    pfu_day = rng.integers(100, 2900, 50)
+    patient = rng.integers(0, 50, 2000)
+    day = rng.integers(0, data_end + 1, 2000)
+
+    stats = estimate_parameters(pfu_day, patient, day, study_start, data_end)
+    expected = naive_parameters(pfu_day, patient, day, study_start, data_end)
+    got = (stats["pifu_visits"], stats["pifu_person_years"], stats["trad_visits"], stats["trad_person_years"],
+           stats["return_events"], stats["return_exposure_months"])
+    np.testing.assert_allclose(got, expected)
+
+
+def test_no_utility_shift_is_cost_minimisation():
+    stats = estimate_parameters(np.array([400]), np.array([0, 0, 0, 0]), np.array([100, 200, 300, 500]), 0, 1000)
+    base = point_parameters(stats, DEFAULTS)
+    (c_trad, q_trad), (c_pifu, q_pifu) = (run_cohort(base, arm) for arm in ARMS)
+    assert DEFAULTS["pifu_utility_shift"] == 0
+    assert np.isnan(icer(c_pifu - c_trad, q_pifu - q_trad))
+    assert c_pifu[0] != c_trad[0]
+
+
+def test_microsimulation_survives_rows_summing_just_below_one(monkeypatch):
+    stats = estimate_parameters(np.array([400]), np.array([0, 0, 0, 0]), np.array([100, 200, 300, 500]), 0, 1000)
+    params = point_parameters(stats, DEFAULTS)
+    exact = cost_effectiveness.transition_matrices
+    monkeypatch.setattr(cost_effectiveness, "transition_matrices", lambda p, arm: exact(p, arm) * (1 - 1e-3))
+    costs, qalys = run_microsimulation(params, "pifu", 5000, seed=1, defaults={**DEFAULTS, "horizon_months": 3})
+    assert np.isfinite(costs).all() and np.isfinite(qalys).all()
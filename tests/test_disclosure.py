@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from disclosure import CUMULATIVE_STEP, disclose, round_counts, round_cumulative, share
+
+
+def test_small_counts_suppressed_and_rest_rounded_to_five():
+    got = round_counts([0, 1, 7, 8, 12, 13, 1002])
+    np.testing.assert_array_equal(got, [0, np.nan, np.nan, 10, 10, 15, 1000])
+
+
+def test_disclose_writes_suppressed_counts_as_empty():
+    frame = disclose(pd.DataFrame({"label": ["a", "b"], "n": [3, 42]}), ["n"])
+    assert frame.to_csv(index=False) == "label,n\na,\nb,40\n"
+
+
+def test_share_uses_disclosed_values():
+    np.testing.assert_array_equal(share([10, np.nan], [20, 40]), [0.5, np.nan])
+
+
+def test_round_cumulative_increments_are_zero_or_a_full_step():
+    counts = np.array([1, 0, 3, 9, 2, 0, 1, 4, 4])
+    first = np.array([1, 0, 0, 0, 0, 1, 0, 0, 0], bool)
+    released = round_cumulative(counts, first)
+    assert ((released == 0) | (released >= CUMULATIVE_STEP)).all()
+    np.testing.assert_array_equal(released, [10, 0, 0, 10, 0, 0, 10, 0, 0])
+    np.testing.assert_array_equal(round_cumulative([12, 1]), [20, 0])
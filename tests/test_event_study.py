@@ -0,0 +1,46 @@
+import numpy as np
+
+from event_study import build_person_month_panel, event_time_bins, fit_twfe
+
+
+def dense_twfe(y, bin_code, n_bins, patient, month):
+    """Dummy-variable OLS with patient and month FE and patient-clustered sandwich."""
+    n_patients, n_months = patient.max() + 1, month.max() + 1
+    X = np.column_stack([
+        (bin_code[:, None] == np.arange(n_bins)).astype(float),
+        (patient[:, None] == np.arange(n_patients)).astype(float),
+        (month[:, None] == np.arange(1, n_months)).astype(float),
+    ])
+    bread = np.linalg.inv(X.T @ X)
+    beta = bread @ X.T @ y
+    resid = y - X @ beta
+    scores = np.zeros((n_patients, X.shape[1]))
+    np.add.at(scores, patient, X * resid[:, None])
+    n = len(y)
+    dof = (n_patients / (n_patients - 1)) * ((n - 1) / (n - n_bins - (n_months - 1)))
+    vcov = dof * bread @ scores.T @ scores @ bread
+    return beta[:n_bins], vcov[:n_bins, :n_bins]
+
+
+def test_absorbed_fe_matches_dummy_variable_ols():
+    rng = np.random.default_rng(11)
+    n_patients, n_months = 40, 30
+    treat = np.where(rng.random(n_patients) < 0.6, rng.integers(5, 25, n_patients), -1)
+    visits = rng.poisson(3, size=n_patients * n_months)
+    visit_patient = np.repeat(np.repeat(np.arange(n_patients), n_months), visits) + 100
+    visit_month = np.repeat(np.tile(np.arange(n_months), n_patients), visits)
+    panel = build_person_month_panel(visit_patient, visit_month, np.arange(n_patients) + 100, treat, n_months)
+    bin_code, event_times = event_time_bins(panel["rel_time"], (-4, 4))
+
+    beta, vcov = fit_twfe(panel["y"], bin_code, len(event_times), panel["patient"], panel["month"], tol=1e-13)
+    dense_beta, dense_vcov = dense_twfe(panel["y"], bin_code, len(event_times), panel["patient"], panel["month"])
+    np.testing.assert_allclose(beta, dense_beta, rtol=1e-6, atol=1e-9)
+    np.testing.assert_allclose(vcov, dense_vcov, rtol=1e-5, atol=1e-10)
+
+
+def test_panel_counts_visits_per_person_month():
+    panel = build_person_month_panel(
+        np.array([7, 7, 9, 8]), np.array([0, 0, 2, 5]), np.array([7, 9]), np.array([1, -1]), 3,
+    )
+    np.testing.assert_array_equal(panel["y"], [2, 0, 0, 0, 0, 1])
+    assert panel["rel_time"][0] == -1 and panel["rel_time"][3] == np.iinfo(np.int64).min
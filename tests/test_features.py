@@ -0,0 +1,90 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class Expr:
+    """Stand-in for an ehrQL series / frame: every operation records itself and returns a new Expr."""
+
+    def __init__(self, log, path):
+        self._log, self._path = log, path
+
+    def __getattr__(self, name):
+        return Expr(self._log, f"{self._path}.{name}")
+
+    def __call__(self, *args, **kwargs):
+        self._log.append(self._path)
+        return Expr(self._log, f"{self._path}()")
+
+    def _op(self, *args):
+        return Expr(self._log, f"({self._path} op)")
+
+    __and__ = __or__ = __invert__ = __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = _op
+    __add__ = __sub__ = __rsub__ = __radd__ = _op
+    __hash__ = object.__hash__
+
+
+TABLES = ["addresses", "apcs", "clinical_events", "ethnicity_from_sus", "medications", "ons_deaths", "opa",
+          "patients", "practice_registrations"]
+
+
+@pytest.fixture
+def features(monkeypatch):
+    """Import the feature modules against a recording stand-in for ehrql."""
+    log = []
+    ehrql = types.ModuleType("ehrql")
+    ehrql.codelist_from_csv = lambda *args, category_column=None, **kwargs: {} if category_column else []
+    for name in ("case", "when", "minimum_of", "maximum_of", "years", "months", "days", "create_dataset"):
+        setattr(ehrql, name, Expr(log, name))
+    tables = types.ModuleType("ehrql.tables")
+    tpp = types.ModuleType("ehrql.tables.tpp")
+    for name in TABLES:
+        setattr(tpp, name, Expr(log, name))
+    for name, module in (("ehrql", ehrql), ("ehrql.tables", tables), ("ehrql.tables.tpp", tpp)):
+        monkeypatch.setitem(sys.modules, name, module)
+    for name in [m for m in sys.modules if m == "codelists" or m.startswith("features")]:
+        monkeypatch.delitem(sys.modules, name)
+
+    modules = {name: importlib.import_module(f"features.{name}")
+               for name in ("opa", "diagnosis", "demographics", "deprivation", "medications")}
+    yield modules, log
+    for name in [m for m in sys.modules if m == "codelists" or m.startswith("features")]:
+        del sys.modules[name]
+
+
+def factories(module):
+    return {name: f for name, f in vars(module).items() if hasattr(f, "cache_info") and f.__module__ == module.__name__}
+
+
+def test_importing_builds_nothing(features):
+    modules, log = features
+    assert log == []
+    assert all(factories(module) for module in modules.values())
+
+
+def test_each_factory_builds_once_and_returns_the_same_object(features):
+    modules, log = features
+    for module in modules.values():
+        for name, factory in factories(module).items():
+            assert factory() is factory(), f"{module.__name__}.{name}"
+
+    # first_opa_date anchors the demographics and several opa frames, and is built once
+    opa = modules["opa"]
+    assert opa.first_opa_date.cache_info().misses == 1
+    assert opa.first_opa_date.cache_info().hits > 0
+    assert opa.all_opa.cache_info().misses == 1
+
+
+def test_consumers_share_the_base_frame(features):
+    modules, log = features
+    opa = modules["opa"]
+    opa.first_opa()
+    opa.first_rheum()
+    assert log.count("opa.where") == 1          # all_opa, reused by both
+    built = len(log)
+    opa.first_opa()
+    opa.first_rheum()
+    opa.all_rheum_opa()
+    assert len(log) == built
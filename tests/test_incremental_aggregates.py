@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+from incremental_aggregates import STREAMS, compare, empty_state, fold, to_frame
+
+
+def random_streams(seed, n=400, patients=60):
+    rng = np.random.default_rng(seed)
+
+    def dates(lo="2016-06-01", span=3000):
+        # few distinct days so same-day ties (broken by payload) are common
+        return (np.datetime64(lo) + rng.integers(0, span // 30, n) * 30).astype(str)
+
+    def codes(values):
+        return rng.choice(values, n)
+
+    patient = rng.integers(1, patients, n)
+    return {
+        "opa": pd.DataFrame({
+            "patient_id": patient, "opa_ident": [f"op{i}" for i in range(n)], "appointment_date": dates(),
+            "treatment_function_code": codes(["410", "110", "300", None]),
+            "outcome_of_attendance": codes(["1", "4", "5", None]),
+        }),
+        "medications": pd.DataFrame({
+            "patient_id": rng.integers(1, patients, n), "date": dates(),
+            "drug_class": codes(["dmard", "steroid"]), "dmd_code": codes(["d1", "d2", "d3"]),
+        }),
+        "gp_diagnoses": pd.DataFrame({
+            "patient_id": rng.integers(1, patients, n), "date": dates(),
+            "snomedct_code": codes(["s1", "s2"]), "category": codes(["RA", "PsA"]),
+        }),
+        "apcs_diagnoses": pd.DataFrame({
+            "patient_id": rng.integers(1, patients, n), "admission_date": dates(),
+            "code": codes(["M05", "M06"]), "category": codes(["RA", "AS"]), "all_diagnoses": codes(["M05;I10", "M06"]),
+        }),
+    }
+
+
+def split(streams, cuts):
+    """Increments (since, until] at the given cut dates."""
+    bounds = ["0000-01-01"] + cuts + ["9999-12-31"]
+    return [
+        {stream: frame[(frame[STREAMS[stream]] > lo) & (frame[STREAMS[stream]] <= hi)].reset_index(drop=True)
+         for stream, frame in streams.items()}
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def test_folding_increments_equals_full_rebuild():
+    streams = random_streams(7)
+    full, _ = fold(empty_state(), streams)
+    increments = split(streams, ["2018-03-01", "2020-01-01", "2022-07-01"])
+    for order in (increments, increments[::-1]):
+        state = empty_state()
+        for increment in order:
+            state, _ = fold(state, increment)
+        assert compare(state, full) == []
+    pd.testing.assert_frame_equal(to_frame(state), to_frame(full))
+
+
+def test_full_rebuild_matches_pandas_reference():
+    streams = random_streams(8)
+    state, _ = fold(empty_state(), streams)
+    frame = to_frame(state).set_index("patient_id")
+    opa = streams["opa"]
+    since_2018 = opa[opa["appointment_date"] >= "2018-01-01"]
+    np.testing.assert_array_equal(
+        frame["count_all_opa"], since_2018.groupby("patient_id")["opa_ident"].nunique().reindex(frame.index, fill_value=0))
+    non_rheum = opa[opa["treatment_function_code"] != "410"]
+    np.testing.assert_array_equal(
+        frame["non_rheum_opa_last_date"].dropna().astype(str),
+        non_rheum.groupby("patient_id")["appointment_date"].max().reindex(frame["non_rheum_opa_last_date"].dropna().index))
+    rx = streams["medications"]
+    dmard = rx[rx["drug_class"] == "dmard"].sort_values(["patient_id", "date", "dmd_code"])
+    last = dmard.groupby("patient_id").last()
+    np.testing.assert_array_equal(frame.loc[last.index, "DMARD_last_code"], last["dmd_code"])
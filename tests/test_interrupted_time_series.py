@@ -0,0 +1,32 @@
+import numpy as np
+
+from interrupted_time_series import fit_batch, segmented_design
+
+
+def design(n=48):
+    periods = (np.datetime64("2019-01", "M") + np.arange(n)).astype("datetime64[D]")
+    return segmented_design(periods, {"break": "2021-01-01"})
+
+
+def test_batch_matches_per_series_ols():
+    X, terms = design()
+    rng = np.random.default_rng(1)
+    Y = X @ rng.normal(size=(X.shape[1], 5)) + rng.normal(size=(X.shape[0], 5))
+    mask = rng.random(Y.shape) > 0.1
+    coef, _, dof = fit_batch(X, np.where(mask, Y, 0.0), mask)
+    for s in range(Y.shape[1]):
+        expected = np.linalg.lstsq(X[mask[:, s]], Y[mask[:, s], s], rcond=None)[0]
+        np.testing.assert_allclose(coef[s], expected, rtol=1e-8)
+        assert dof[s] == mask[:, s].sum() - len(terms)
+
+
+def test_series_missing_one_side_of_breakpoint_is_nan_not_fatal():
+    X, _ = design()
+    rng = np.random.default_rng(2)
+    Y = rng.normal(size=(X.shape[0], 3))
+    mask = np.ones_like(Y, dtype=bool)
+    mask[24:, 1] = False         # nothing after the breakpoint
+    mask[:24, 2] = False         # nothing before it (e.g. pfu strata before adoption)
+    coef, se, _ = fit_batch(X, np.where(mask, Y, 0.0), mask)
+    assert np.isfinite(coef[0]).all() and np.isfinite(se[0]).all()
+    assert np.isnan(coef[1:]).all() and np.isnan(se[1:]).all()
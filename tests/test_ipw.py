@@ -0,0 +1,93 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+import ipw
+from disclosure import REDACT_AT
+from ipw import NUMERIC, balance, design_matrix, disclose_balance, fit_logistic, ipw_weights, propensity
+
+
+def newton_logistic(X, y, iterations=50):
+    X = np.column_stack([np.ones(len(y)), X])
+    beta = np.zeros(X.shape[1])
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-X @ beta))
+        beta += np.linalg.solve(X.T @ (X * (p * (1 - p))[:, None]), X.T @ (y - p))
+    return beta
+
+
+def cohort(seed=9, n=4000):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "sex": rng.choice(["female", "male"], n),
+        "region": rng.choice(["London", "North", None], n),
+        "age_opa": rng.normal(55, 15, n).round(),
+    })
+    df.loc[rng.random(n) < 0.05, "age_opa"] = np.nan
+    eta = -0.5 + 0.8 * (df["sex"] == "female") - 0.6 * df["region"].isna() + 0.02 * (df["age_opa"].fillna(55) - 55)
+    t = rng.random(n) < 1 / (1 + np.exp(-eta.to_numpy()))
+    return df, t
+
+
+def test_sparse_lbfgs_matches_newton_on_the_dense_design():
+    df, t = cohort()
+    X, names = design_matrix(df, categorical=["sex", "region"], numeric=["age_opa"])
+    assert names == ["sex=female", "sex=male", "region=London", "region=North", "region=missing",
+                     "age_opa", "age_opa=missing"]
+    # drop one level per categorical so the unpenalised model is identified
+    keep = [0, 2, 3, 5, 6]
+    intercept, coefs = fit_logistic(X[:, keep], t.astype(float), penalty=1e-6)
+    reference = newton_logistic(X[:, keep].toarray(), t.astype(float))
+    np.testing.assert_allclose(np.r_[intercept, coefs], reference, atol=1e-3)
+
+
+def test_saturated_model_weights_balance_every_level():
+    df, t = cohort()
+    X, names = design_matrix(df, categorical=["sex", "region"], numeric=[])
+    cells = design_matrix(pd.DataFrame({"cell": df["sex"] + "/" + df["region"].fillna("missing")}), ["cell"], [])[0]
+    ps = propensity(cells, *fit_logistic(cells, t.astype(float), penalty=1e-6))
+    report = balance(X, names, t, {"ate": ipw_weights(t, ps), "att": ipw_weights(t, ps, "att")})
+    assert report["smd_unweighted"].abs().max() > 0.1
+    assert report["smd_ate"].abs().max() < 1e-3 and report["smd_att"].abs().max() < 1e-3
+
+
+def test_weight_formulas():
+    t = np.array([True, True, False, False])
+    ps = np.array([0.5, 0.25, 0.5, 0.25])
+    np.testing.assert_allclose(ipw_weights(t, ps), [1.0, 2.0, 1.0, 0.5 / 0.75])
+    np.testing.assert_allclose(ipw_weights(t, ps, "att"), [1.0, 1.0, 1.0, 1 / 3])
+
+
+def test_pifu_anchored_counts_are_not_default_covariates():
+    assert not {"before_1yr", "before_2yr", "before_3yr"} & set(NUMERIC)
+
+
+def test_released_balance_uses_rounded_counts_and_blanks_small_levels():
+    df, t = cohort()
+    df.loc[np.flatnonzero(t)[:3], "region"] = "Islands"     # 3 PIFU patients, no controls
+    X, names = design_matrix(df, categorical=["sex", "region"], numeric=["age_opa"])
+    report = balance(X, names, t, {"weighted": np.ones(len(t))})
+    released = disclose_balance(report, X, t).set_index("covariate")
+    assert released.loc["region=Islands"].drop(["n_control"]).isna().all()
+    assert released.loc["region=Islands", "n_control"] == 0
+    exact = X[t].toarray().sum(axis=0)
+    for name, count in zip(names, exact):
+        if "=" in name and count > REDACT_AT:
+            n = released.loc[name, "n_pifu"]
+            assert n % 5 == 0 and abs(n - count) <= 2.5
+            assert released.loc[name, "mean_pifu"] == n / (round(t.sum() / 5) * 5)
+    assert pd.isna(released.loc["age_opa", "n_pifu"]) and not np.isnan(released.loc["age_opa", "mean_pifu"])
+
+
+def test_main_resolves_the_treatment_alias(tmp_path, monkeypatch, capsys):
+    df, t = cohort(n=500)
+    df.insert(0, "patient_id", np.arange(len(df)))
+    df["any_pfu"] = np.where(t, "T", "F")
+    df.to_csv(tmp_path / "dataset.csv", index=False)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["ipw.py", "--dataset", "dataset.csv", "--outdir", "out"])
+    ipw.main()
+    assert (tmp_path / "out" / "ipw_balance.csv").exists()
+    n_pifu = round(t.sum() / 5) * 5
+    assert f"{n_pifu} PIFU" in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import sqlite3
+
+import pandas as pd
+
+from local_backend import build_backend, dsn
+
+
+def write_tables(directory):
+    pd.DataFrame({
+        "patient_id": [1, 2, 3],
+        "date_of_birth": ["1950-01-01", "1980-06-01", ""],
+        "sex": ["female", "male", "unknown"],
+    }).to_csv(directory / "patients.csv", index=False)
+    pd.DataFrame({
+        "patient_id": [1, 1, 2, 3, 3],
+        "appointment_date": ["2019-02-01", "2021-05-03", "2018-03-04", "", "2022-01-01"],
+        "treatment_function_code": ["410", "110", "410", "410", ""],
+        "outcome_of_attendance": ["5", "1", "", "5", "3"],
+        "first_attendance": ["T", "F", "F", "", "T"],
+        "opa_ident": [10, 11, 12, 13, ""],
+    }).to_csv(directory / "opa.csv.gz", index=False)
+    (directory / "not_a_table.csv").write_text("patient_id\n1\n")
+
+
+def test_loads_csv_tables_and_answers_the_same_query_as_pandas(tmp_path):
+    write_tables(tmp_path)
+    db = tmp_path / "backend.sqlite"
+    assert build_backend(tmp_path, db) == {"opa": 5, "patients": 3}
+
+    con = sqlite3.connect(db)
+    rows = con.execute(
+        "SELECT patient_id, COUNT(*), MIN(appointment_date) FROM opa "
+        "WHERE treatment_function_code = '410' AND appointment_date >= '2018-01-01' GROUP BY patient_id"
+    ).fetchall()
+    opa = pd.read_csv(tmp_path / "opa.csv.gz", dtype=str)
+    rheum = opa[(opa["treatment_function_code"] == "410") & (opa["appointment_date"] >= "2018-01-01")]
+    expected = rheum.groupby("patient_id")["appointment_date"].agg(["count", "min"])
+    assert rows == [(int(p), int(n), d) for p, (n, d) in expected.iterrows()]
+
+    # empty cells are NULL, booleans 0/1, identifiers integers
+    assert con.execute("SELECT COUNT(*) FROM opa WHERE appointment_date IS NULL").fetchone() == (1,)
+    assert con.execute("SELECT first_attendance FROM opa ORDER BY rowid").fetchall() == [
+        (1,), (0,), (0,), (None,), (1,)]
+    assert con.execute("SELECT typeof(opa_ident), opa_ident FROM opa WHERE rowid = 1").fetchone() == ("integer", 10)
+    assert con.execute("SELECT date_of_birth FROM patients WHERE patient_id = 3").fetchone() == (None,)
+
+    indexes = {row[1] for row in con.execute("PRAGMA index_list('opa')")}
+    assert {"ix_opa_patient_date", "ix_opa_treatment_function_code"} <= indexes
+    assert con.execute("PRAGMA index_list('patients')").fetchone()[2] == 1     # unique
+    con.close()
+
+
+def test_dsn_is_a_sqlalchemy_sqlite_url(tmp_path):
+    assert dsn("output/local_backend.sqlite") == "sqlite:///output/local_backend.sqlite"
+    assert dsn(tmp_path / "x.sqlite") == f"sqlite:///{tmp_path.as_posix()}/x.sqlite"
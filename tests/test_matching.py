@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from matching import match
+
+NAT = pd.NaT
+
+
+def cohort_frame(rows):
+    frame = pd.DataFrame(rows, columns=["patient_id", "first_rheum_pfu_date", "dod", "deregister_date"])
+    for column in ("first_rheum_pfu_date", "dod", "deregister_date"):
+        frame[column] = pd.to_datetime(frame[column])
+    frame["first_rheum_date"] = pd.Timestamp("2019-01-01")
+    frame["age_opa_group"], frame["sex"], frame["latest_diag_category"], frame["region"] = "50-59", "F", "RA", "London"
+    return frame
+
+
+def visits(pairs):
+    return pd.DataFrame({
+        "patient_id": [p for p, _ in pairs],
+        "appointment_date": pd.to_datetime([d for _, d in pairs]),
+        "treatment_function_code": "410",
+    })
+
+
+def test_controls_are_drawn_per_patient_not_per_visit():
+    # control 1 attends 30 times in the case's month, control 2 once
+    cohort = cohort_frame([
+        (0, "2021-03-15", NAT, NAT),
+        (1, NAT, NAT, NAT),
+        (2, NAT, NAT, NAT),
+    ])
+    events = visits([(1, f"2021-03-{d:02d}") for d in range(1, 31)] + [(2, "2021-03-20")])
+    drawn = [
+        match(cohort, events, ratio=1, seed=seed).query("~case")["patient_id"].item()
+        for seed in range(400)
+    ]
+    assert 0.4 < np.mean(np.asarray(drawn) == 1) < 0.6
+
+
+def test_eligibility_is_checked_at_the_case_index_date():
+    cohort = cohort_frame([
+        (0, "2021-03-15", NAT, NAT),
+        (1, NAT, "2021-03-10", NAT),            # visit on the 2nd, died before the index date
+        (2, "2021-03-12", NAT, NAT),            # visit on the 3rd, on PIFU before the index date
+        (3, NAT, NAT, "2021-03-14"),            # visit on the 4th, deregistered before the index date
+        (4, "2021-06-01", NAT, NAT),            # visit after the index date, becomes a case later
+        (5, NAT, NAT, NAT),
+    ])
+    events = visits([(1, "2021-03-02"), (2, "2021-03-03"), (3, "2021-03-04"), (4, "2021-03-28"), (5, "2021-03-05")])
+    sets = match(cohort, events, ratio=4, reuse_controls=True)
+    first = sets[sets["set_id"] == sets.loc[sets["patient_id"] == 0, "set_id"].item()]
+    assert sorted(first.loc[~first["case"], "patient_id"]) == [4, 5]
+
+
+def test_controls_are_not_reused_by_default():
+    cohort = cohort_frame([
+        (0, "2021-03-15", NAT, NAT),
+        (1, "2021-03-20", NAT, NAT),
+        (2, NAT, NAT, NAT),
+    ])
+    events = visits([(2, "2021-03-01")])
+    sets = match(cohort, events, ratio=1)
+    assert (~sets["case"]).sum() == 1
+    assert (~match(cohort, events, ratio=1, reuse_controls=True)["case"]).sum() == 2
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from disclosure import CUMULATIVE_STEP
+from mcf import build_arrays, mcf, release_mcf, tidy
+
+
+def simulate(n=80, seed=6):
+    rng = np.random.default_rng(seed)
+    cohort = pd.DataFrame({
+        "patient_id": np.arange(n),
+        "first_rheum_pfu_date": pd.to_datetime("2018-01-10") + pd.to_timedelta(rng.integers(0, 800, n), "D"),
+    })
+    m = 1500
+    patient = rng.integers(0, n, m)
+    events = pd.DataFrame({
+        "patient_id": patient,
+        "appointment_date": cohort["first_rheum_pfu_date"].to_numpy()[patient]
+        + pd.to_timedelta(rng.integers(-30, 50, m), "D").to_numpy(),
+        "treatment_function_code": rng.choice(["410", "110"], m),
+    })
+    follow_up = np.where(rng.random(n) < 0.3, rng.integers(0, 40, n), np.nan)
+    return cohort, events, patient, follow_up
+
+
+def test_grid_mcf_matches_per_day_loop():
+    n, pre, post = 80, 20, 40
+    cohort, events, patient, follow_up = simulate(n)
+    arrays, years = build_arrays(cohort, events, follow_up, pre, post)
+    curve, visits, at_risk = mcf(arrays)
+
+    pfu = cohort["first_rheum_pfu_date"].to_numpy("datetime64[D]")
+    data_end = events["appointment_date"].max().to_datetime64().astype("datetime64[D]")
+    rel = (events["appointment_date"].to_numpy("datetime64[D]") - pfu[patient]).astype(int)
+    is_rheum = events["treatment_function_code"].to_numpy() == "410"
+    for s, (year, specialty) in enumerate((y, sp) for y in years for sp in ("rheum", "non_rheum")):
+        members = np.flatnonzero(cohort["first_rheum_pfu_date"].dt.year == year)
+        total, want = 0.0, []
+        for d in range(-pre, post + 1):
+            risk = visit_count = 0
+            for p in members:
+                end = data_end if np.isnan(follow_up[p]) else min(data_end, pfu[p] + int(follow_up[p]))
+                first = max(-pre, (np.datetime64("2018-01-01") - pfu[p]).astype(int))
+                last = min(post, (end - pfu[p]).astype(int))
+                if first <= d <= last:
+                    risk += 1
+                    mine = (patient == p) & (rel == d) & (is_rheum if specialty == "rheum" else ~is_rheum)
+                    visit_count += 0 if d == 0 else mine.sum()
+            total += visit_count / risk if risk else 0.0
+            want.append((risk, visit_count, total))
+        want = np.array(want)
+        np.testing.assert_array_equal(at_risk[s], want[:, 0])
+        np.testing.assert_array_equal(visits[s], want[:, 1])
+        np.testing.assert_allclose(curve[s], want[:, 2], atol=1e-12)
+
+
+def test_released_mcf_is_recomputed_from_rounded_counts():
+    pre, post = 20, 40
+    cohort, events, _, follow_up = simulate(n=400, seed=7)
+    arrays, years = build_arrays(cohort, events, follow_up, pre, post)
+    exact = tidy(years, pre, *mcf(arrays))
+    released = release_mcf(exact)
+
+    assert ((released["visits"] == 0) | (released["visits"] >= CUMULATIVE_STEP)).all()
+    assert (released["at_risk"].dropna() % 5 == 0).all()
+    assert (released["day"] == 0).sum() == exact["cohort"].nunique() * 2
+    for (year, specialty), got in released.groupby(["cohort", "specialty"]):
+        # the released MCF uses only the released counts
+        rate = np.where(got["visits"] > 0, got["visits"] / got["at_risk"].astype(float), 0.0)
+        np.testing.assert_allclose(got["mcf"], np.cumsum(rate), atol=1e-12)
+        # cumulative visits are the exact ones rounded up to the next step
+        series = exact[(exact["cohort"] == year) & (exact["specialty"] == specialty)]
+        total = series.set_index("day")["visits"].cumsum()
+        gap = got["visits"].cumsum().to_numpy() - total.loc[got["day"]].to_numpy()
+        assert ((gap >= 0) & (gap < CUMULATIVE_STEP)).all()
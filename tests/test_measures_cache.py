@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import measures_cache
+from measures_cache import ensure_cache, read_measures
+
+
+def write_measures(path, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for start in pd.date_range("2020-01-01", periods=6, freq="MS"):
+        rows.append(("patient_count", start, rng.integers(50, 100), rng.integers(100, 200), None, None))
+        for sex in ("female", "male"):
+            for region in ("London", None):
+                rows.append(("count_all_opa_by_sex", start, rng.integers(0, 30), rng.integers(10, 50), sex, region))
+    # a duplicated (period, stratum) row is summed
+    rows.append(("patient_count", pd.Timestamp("2020-01-01"), 7, 3, None, None))
+    frame = pd.DataFrame(rows, columns=["measure", "interval_start", "numerator", "denominator", "sex", "region"])
+    frame["interval_end"] = frame["interval_start"] + pd.offsets.MonthEnd(0)
+    frame["ratio"] = frame["numerator"] / frame["denominator"]
+    frame.to_csv(path, index=False)
+    return frame
+
+
+@pytest.fixture
+def measures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path / "measures.csv"
+
+
+def test_partitions_match_a_pivot_of_the_csv(measures):
+    frame = write_measures(measures)
+    ensure_cache(measures, "cache")
+    parts = read_measures(["patient_count", "count_all_opa_by_sex", "not_a_measure"], "cache")
+    assert set(parts) == {"patient_count", "count_all_opa_by_sex"}
+
+    for name, part in parts.items():
+        rows = frame[frame["measure"] == name].fillna({"sex": "missing", "region": "missing"})
+        keys = ["interval_start"] + part.group_columns
+        for field in ("numerator", "denominator"):
+            got = part.frame(field)
+            for row in rows.groupby(keys, as_index=False)[field].sum().itertuples(index=False):
+                start, *labels, value = row
+                assert got.loc[start, " / ".join(labels) if labels else name] == value
+    assert parts["patient_count"].group_columns == []
+    assert parts["count_all_opa_by_sex"].group_columns == ["sex", "region"]
+
+
+def test_cache_is_rebuilt_only_when_measures_change(measures, monkeypatch):
+    write_measures(measures)
+    builds = []
+    build = measures_cache.build_cache
+    monkeypatch.setattr(measures_cache, "build_cache", lambda *args: builds.append(1) or build(*args))
+
+    ensure_cache(measures, "cache")
+    ensure_cache(measures, "cache")
+    assert len(builds) == 1
+
+    write_measures(measures, seed=1)
+    manifest = ensure_cache(measures, "cache")
+    assert len(builds) == 2 and manifest["source_sha256"] == measures_cache.file_hash(measures)
+    ensure_cache(measures, "cache")
+    assert len(builds) == 2
@@ -0,0 +1,74 @@
+import os
+import time
+
+import pytest
+
+import output_manager
+from output_manager import atomic_path, is_stale, read_manifest, sweep, temp_path, verify, write_text
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(output_manager, "_swept", set())
+    return tmp_path
+
+
+def test_commit_renames_and_records_hash(workdir):
+    write_text("output/x.txt", "hello")
+    entry = read_manifest()["output/x.txt"]
+    assert (workdir / "output" / "x.txt").read_text() == "hello"
+    assert entry["bytes"] == 5 and entry["sha256"] == output_manager.file_hash("output/x.txt")
+    assert list((workdir / "output").glob("*.tmp*")) == [] and verify() == []
+
+
+def test_failed_write_keeps_previous_output_and_removes_temp(workdir):
+    write_text("output/x.txt", "old")
+    with pytest.raises(RuntimeError):
+        with atomic_path("output/x.txt") as tmp:
+            tmp.write_text("half written")
+            raise RuntimeError("interrupted")
+    assert (workdir / "output" / "x.txt").read_text() == "old"
+    assert list((workdir / "output").glob("*.tmp*")) == []
+    with pytest.raises(FileNotFoundError):
+        with atomic_path("output/y.txt"):
+            pass
+    assert not (workdir / "output" / "y.txt").exists()
+
+
+def test_unrecorded_writes_are_atomic_but_not_in_manifest(workdir):
+    with atomic_path("output/shards/s.csv", manifest=False) as tmp:
+        tmp.write_text("a\n")
+    assert (workdir / "output" / "shards" / "s.csv").read_text() == "a\n"
+    assert read_manifest() == {}
+
+
+def test_verify_reports_changed_and_missing(workdir):
+    write_text("output/a.txt", "a")
+    write_text("output/b.txt", "b")
+    (workdir / "output" / "a.txt").write_text("edited")
+    os.remove(workdir / "output" / "b.txt")
+    assert sorted(verify()) == [("output/a.txt", "changed since commit"), ("output/b.txt", "missing")]
+
+
+def test_sweep_removes_only_stale_temps(workdir):
+    out = workdir / "output"
+    out.mkdir()
+    dead = out / f"x.{output_manager.HOST}-999999999-0123abcd.tmp.csv"
+    live = temp_path(out / "y.csv")                       # this process
+    legacy_old, legacy_new = out / "z.csv.0a1b.tmp", out / "w.csv.0a1b.tmp"
+    for path in (dead, live, legacy_old, legacy_new):
+        path.write_text("partial")
+    old = time.time() - output_manager.STALE_AFTER - 60
+    os.utime(legacy_old, (old, old))
+    (out / "keep.csv").write_text("real output")
+
+    assert is_stale(dead) and not is_stale(live)
+    assert sorted(p.name for p in sweep(out)) == sorted([dead.name, legacy_old.name])
+    assert sorted(p.name for p in out.iterdir()) == sorted([live.name, legacy_new.name, "keep.csv"])
+
+
+def test_manifest_ignores_torn_entries(workdir):
+    write_text("output/a.txt", "a")
+    (workdir / "output" / ".manifest" / "broken.json").write_text("{")
+    assert list(read_manifest()) == ["output/a.txt"]
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from provider_rollout import changepoint_adoption, threshold_adoption
+
+
+def naive_threshold(n, k, threshold, min_opa, persist):
+    out = []
+    for row_n, row_k in zip(n, k):
+        above = [nn >= min_opa and kk / nn >= threshold for nn, kk in zip(row_n, row_k)]
+        start = [t for t in range(len(above) - persist + 1) if all(above[t:t + persist])]
+        out.append(start[0] if start else -1)
+    return np.array(out)
+
+
+def test_threshold_matches_naive_scan():
+    rng = np.random.default_rng(3)
+    n = rng.integers(5, 40, size=(50, 24))
+    k = rng.binomial(n, rng.uniform(0, 0.1, size=(50, 1)))
+    for persist in (1, 3, 6):
+        np.testing.assert_array_equal(
+            threshold_adoption(n, k, 0.05, 10, persist), naive_threshold(n, k, 0.05, 10, persist),
+        )
+
+
+def test_threshold_window_longer_than_study_is_never_adopted():
+    n = np.full((2, 4), 50)
+    k = np.full((2, 4), 25)
+    np.testing.assert_array_equal(threshold_adoption(n, k, persist=4), [0, 0])
+    np.testing.assert_array_equal(threshold_adoption(n, k, persist=5), [-1, -1])
+    with pytest.raises(ValueError):
+        threshold_adoption(n, k, persist=0)
+
+
+def test_changepoint_finds_step_and_handles_single_month():
+    n = np.full((1, 12), 100)
+    k = np.array([[1] * 5 + [30] * 7])
+    month, stat = changepoint_adoption(n, k)
+    assert month[0] == 5 and stat[0] > 10.83
+    month, stat = changepoint_adoption(n[:, :1], k[:, :1])
+    assert month[0] == -1 and np.isnan(stat[0])
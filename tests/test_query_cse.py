@@ -0,0 +1,108 @@
+import ast
+import dataclasses
+import datetime
+
+import pytest
+
+from query_cse import analyse, emit_definition, load_definition, shared_nodes_for
+
+
+def node_type(qualname, *fields):
+    cls = dataclasses.make_dataclass(qualname.rsplit(".", 1)[-1], fields, frozen=True)
+    cls.__module__ = "ehrql.query_model.nodes"
+    cls.__qualname__ = qualname
+    return cls
+
+
+Value = node_type("Value", "value")
+SelectPatientTable = node_type("SelectPatientTable", "name")
+SelectColumn = node_type("SelectColumn", "source", "name")
+DateDifferenceInYears = node_type("Function.DateDifferenceInYears", "lhs", "rhs")
+MinimumOf = node_type("Function.MinimumOf", "sources")
+StringContains = node_type("Function.StringContains", "lhs", "rhs")
+Mystery = node_type("Function.Mystery", "source")
+In = node_type("Function.In", "lhs", "rhs")
+SelectTable = node_type("SelectTable", "name")
+AggregateExists = node_type("AggregateByPatient.Exists", "source")
+Filter = node_type("Filter", "source", "condition")
+
+
+@dataclasses.dataclass(frozen=True)
+class SNOMEDCTCode:
+    value: str
+
+
+SNOMEDCTCode.__module__ = "ehrql.codes"
+
+patients = SelectPatientTable("patients")
+dob = SelectColumn(patients, "date_of_birth")
+
+
+def test_emits_valid_python_for_age_minimum_and_contains():
+    roots = {
+        "age": DateDifferenceInYears(Value(datetime.date(2020, 1, 1)), dob),
+        "earliest": MinimumOf((dob, Value(datetime.date(2018, 1, 1)))),
+        "rheumatoid": StringContains(SelectColumn(patients, "all_diagnoses"), Value("M05")),
+    }
+    source = emit_definition(roots, shared_nodes_for(roots))
+    ast.parse(source)
+    assert "dataset.age = (date(2020, 1, 1) - patients.date_of_birth).years" in source
+    assert "minimum_of(patients.date_of_birth, date(2018, 1, 1))" in source
+    assert "patients.all_diagnoses.contains('M05')" in source
+
+
+def test_refuses_to_emit_unsupported_nodes():
+    with pytest.raises(ValueError, match="Function.Mystery"):
+        emit_definition({"x": Mystery(dob)}, set())
+
+
+def test_codelist_is_in_renders_code_objects_and_imports_their_class():
+    events = SelectTable("clinical_events")
+    codes = frozenset(SNOMEDCTCode(str(100000 + i)) for i in range(12))
+    small = frozenset({SNOMEDCTCode("69896004")})
+    roots = {
+        "ra": AggregateExists(Filter(events, In(SelectColumn(events, "snomedct_code"), Value(codes)))),
+        "one": AggregateExists(Filter(events, In(SelectColumn(events, "snomedct_code"), Value(small)))),
+    }
+    source = emit_definition(roots, shared_nodes_for(roots))
+    ast.parse(source)
+    assert "from ehrql.codes import SNOMEDCTCode" in source
+    assert "is_in([SNOMEDCTCode('69896004')])" in source
+    # long codelists are bound once at module level
+    assert "= [SNOMEDCTCode('100000'), SNOMEDCTCode('100001')," in source
+    namespace = {"SNOMEDCTCode": SNOMEDCTCode}
+    for line in source.splitlines():
+        if line.startswith("codelist_"):
+            exec(line, namespace)
+    assert [set(v) for k, v in namespace.items() if k.startswith("codelist_")] == [codes]
+
+
+DEFINITION = '''
+from ehrql import create_dataset, minimum_of
+from ehrql.tables.tpp import apcs, clinical_events, patients
+
+dataset = create_dataset()
+admissions = apcs.where(apcs.admission_date.is_on_or_after("2018-01-01"))
+dataset.define_population(admissions.exists_for_patient())
+dataset.age = patients.age_on("2020-01-01")
+dataset.first = minimum_of(admissions.admission_date.minimum_for_patient(), patients.date_of_birth)
+dataset.ra = admissions.where(admissions.all_diagnoses.contains_any_of(["M05", "M06"])).exists_for_patient()
+dataset.n = admissions.count_for_patient()
+dataset.ra_coded = clinical_events.where(
+    clinical_events.snomedct_code.is_in([str(100000 + i) for i in range(12)])
+).exists_for_patient()
+dataset.dm_coded = clinical_events.where(clinical_events.snomedct_code.is_in(["73211009"])).exists_for_patient()
+'''
+
+
+def test_round_trip_through_ehrql(tmp_path):
+    pytest.importorskip("ehrql")
+    original = tmp_path / "definition.py"
+    original.write_text(DEFINITION)
+    _, canonical = analyse({str(original): load_definition(original)})
+    roots = {label: node for (_, label), node in canonical.items()}
+
+    emitted = tmp_path / "emitted.py"
+    emitted.write_text(emit_definition(roots, shared_nodes_for(roots)))
+    _, reloaded = analyse({str(emitted): load_definition(emitted)})
+    assert {label: node for (_, label), node in reloaded.items()} == roots
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import render_figures
+from disclosure import REDACT_AT
+from measures_cache import build_cache
+from render_figures import FIGURES, by_group, event_study_monthly, pfu_trend, render_all
+
+COUNT_PREPARES = (by_group, pfu_trend, event_study_monthly)
+MEASURES = ["count_all_opa", "count_rheum_opa", "count_nonrheum_opa", "patient_count",
+            "count_all_opa_pre_pifu", "count_all_opa_post_pifu"]
+
+
+def write_measures(path, seed=0):
+    rng = np.random.default_rng(seed)
+    periods = pd.date_range("2019-01-01", periods=12, freq="MS")
+    rows = []
+    for measure in MEASURES:
+        for start in periods:
+            rows.append({"measure": measure, "interval_start": start, "numerator": rng.integers(0, 40),
+                         "denominator": rng.integers(20, 60), "sex": None})
+    for sex in ("female", "male"):
+        for start in periods:
+            rows.append({"measure": "count_all_opa_by_sex", "interval_start": start,
+                         "numerator": rng.integers(0, 40), "denominator": 50, "sex": sex})
+    frame = pd.DataFrame(rows)
+    frame["interval_end"] = frame["interval_start"] + pd.offsets.MonthEnd(0)
+    frame["ratio"] = frame["numerator"] / frame["denominator"]
+    frame[["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator", "sex"]].to_csv(
+        path, index=False)
+
+
+def dataset(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    pfu = pd.to_datetime("2019-01-01") + pd.to_timedelta(rng.integers(0, 2000, n), unit="D")
+    pfu = pfu.where(rng.random(n) < 0.7)
+    opa = pd.to_datetime("2019-01-01") + pd.to_timedelta(rng.integers(0, 2000, n), unit="D")
+    return pd.DataFrame({"first_rheum_pfu_date": pfu, "first_opa_date": opa})
+
+
+@pytest.fixture
+def inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_measures(tmp_path / "measures.csv")
+    build_cache(tmp_path / "measures.csv", tmp_path / "cache")
+    return tmp_path
+
+
+def captured(monkeypatch):
+    frames = {}
+
+    def render(task):
+        figure, frame, _ = task
+        frames[figure] = frame
+        return figure.name
+
+    monkeypatch.setattr(render_figures, "render", render)
+    return frames
+
+
+def test_no_small_count_reaches_a_figure(inputs, monkeypatch):
+    frames = captured(monkeypatch)
+    render_all(inputs / "cache", dataset(), inputs / "out", force=True)
+    # every figure whose measures are in the cache (only by-sex of the strata)
+    assert {f.name for f in frames} == {f.name for f in FIGURES if set(f.measures) <= set(MEASURES + [
+        "count_all_opa_by_sex"])}
+    for figure, frame in frames.items():
+        values = frame.to_numpy(dtype=float)
+        prepare = getattr(figure.prepare, "func", figure.prepare)
+        if prepare in COUNT_PREPARES:
+            assert not ((values >= 1) & (values <= REDACT_AT)).any(), figure.name
+            assert (np.nan_to_num(values) % 5 == 0).all(), figure.name
+
+
+def test_rates_use_rounded_counts(inputs):
+    parts = render_figures.read_measures(MEASURES, inputs / "cache")
+    frame = render_figures.visits_per_patient(parts, None)
+    patients = render_figures.round_counts(parts["patient_count"].numerator[:, 0])
+    visits = render_figures.round_counts(parts["count_all_opa"].numerator[:, 0])
+    expected = np.where(patients > 0, visits / patients, np.nan)
+    np.testing.assert_allclose(frame["count_all_opa"].to_numpy(), expected, equal_nan=True)
+
+
+def test_event_study_counts_patients_by_month_of_first_opa():
+    df = dataset(n=50)
+    frame = event_study_monthly({}, df)
+    assert list(frame.columns) == ["patients"]
+    days = (df["first_opa_date"] - df["first_rheum_pfu_date"]).dt.days.dropna()
+    months = np.floor(days / 30).astype(int)
+    expected = months[(months >= -36) & (months <= 36)].value_counts()
+    for month, n in expected.items():
+        assert np.isnan(frame.loc[month, "patients"]) if n <= REDACT_AT else frame.loc[month, "patients"] % 5 == 0
+
+
+def test_unchanged_inputs_are_skipped_and_changed_ones_redrawn(inputs):
+    only = ["all_opa_by_sex", "pfu_trend_plot", "pifu_prepost_bar_per1000"]
+    drawn, skipped = render_all(inputs / "cache", dataset(), inputs / "out", only=only)
+    assert sorted(drawn) == sorted(only) and skipped == []
+    assert all((inputs / "out" / f.path).exists() for f in FIGURES if f.name in only)
+
+    drawn, skipped = render_all(inputs / "cache", dataset(), inputs / "out", only=only)
+    assert drawn == [] and sorted(skipped) == sorted(only)
+
+    drawn, skipped = render_all(inputs / "cache", dataset(seed=1), inputs / "out", only=only)
+    assert drawn == ["pfu_trend_plot"]
+
+    (inputs / "out" / "figures" / "all_opa_by_sex.png").unlink()
+    drawn, _ = render_all(inputs / "cache", dataset(seed=1), inputs / "out", only=only)
+    assert drawn == ["all_opa_by_sex"]
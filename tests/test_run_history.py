@@ -0,0 +1,50 @@
+import hashlib
+import os
+import sqlite3
+import subprocess
+
+import pytest
+
+from run_history import _definition, _git, open_history
+
+
+def commit(repo, text, when):
+    (repo / "analysis").mkdir(exist_ok=True)
+    (repo / "analysis" / "definition.py").write_text(text)
+    env = {**os.environ, "GIT_COMMITTER_DATE": f"@{when} +0000", "GIT_AUTHOR_DATE": f"@{when} +0000"}
+    for args in (["add", "-A"], ["-c", "user.name=t", "-c", "user.email=t@t", "commit", "-qm", text]):
+        subprocess.run(["git", *args], cwd=repo, env=env, check=True)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    commit(tmp_path, "v1", 1_600_000_000)
+    commit(tmp_path, "v2", 1_600_100_000)
+    monkeypatch.chdir(tmp_path)
+    _git.cache_clear()
+    yield tmp_path
+    _git.cache_clear()
+
+
+def sha(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def test_definition_is_hashed_as_committed_when_the_job_completed(repo):
+    (repo / "analysis" / "definition.py").write_text("uncommitted edit after the run")
+    path = "analysis/definition.py"
+    assert _definition(path, 1_600_050_000)[1] == sha("v1")
+    assert _definition(path, 1_600_200_000)[1] == sha("v2")
+    assert _definition(path, 1_500_000_000) == (path, None, None)
+    assert _definition(path, None) == (path, None, None)
+
+
+def test_old_history_store_gains_new_columns(tmp_path):
+    db = tmp_path / "history.sqlite"
+    with sqlite3.connect(db) as con:
+        con.execute("CREATE TABLE runs (job_id TEXT PRIMARY KEY, definition_changed_since INTEGER)")
+    con = open_history(db)
+    columns = {row[1] for row in con.execute("PRAGMA table_info(runs)")}
+    con.close()
+    assert {"definition_rev", "run_seconds", "log_seconds"} <= columns
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from disclosure import round_counts
+from sensitivity_sweep import SWITCHES, ensure_base, run_sweep, scenario_grid, scenario_id
+
+
+def extracts(directory, n=300, m=6000, seed=5):
+    rng = np.random.default_rng(seed)
+    pd.DataFrame({
+        "patient_id": np.arange(n) * 3 + 1,
+        "sex": rng.choice(["male", "female", "unknown"], n, p=[0.45, 0.45, 0.1]),
+    }).to_csv(directory / "dataset.csv.gz", index=False)
+    pd.DataFrame({
+        "patient_id": rng.integers(0, n, m) * 3 + 1,
+        "appointment_date": (pd.to_datetime("2018-01-01")
+                             + pd.to_timedelta(rng.integers(0, 7 * 365, m), "D")).strftime("%Y-%m-%d"),
+        "treatment_function_code": rng.choice(["410", "110"], m, p=[0.6, 0.4]),
+        "outcome_of_attendance": rng.choice(["1", "4", "5"], m, p=[0.8, 0.1, 0.1]),
+        "attendance_status": rng.choice(["5", "6", "7"], m),
+    }).to_csv(directory / "opa.csv.gz", index=False)
+
+
+def naive_scenario(cohort, events, scenario):
+    """The sweep metrics for one scenario, straight from the extracts."""
+    start = pd.Timestamp(scenario["study_start"])
+    end = start + pd.DateOffset(months=int(scenario["n_months"]))
+    e = events[(events["appointment_date"] >= start) & (events["appointment_date"] < end)]
+    if scenario["attended_only"]:
+        e = e[e["attendance_status"].isin(["5", "6"])]
+    if scenario["sex"] == "male_female":
+        e = e[e["patient_id"].isin(cohort.loc[cohort["sex"].isin(["male", "female"]), "patient_id"])]
+    rheum = e[e["treatment_function_code"] == "410"]
+    in_cohort = e[e["patient_id"].isin(rheum["patient_id"])]
+    pifu = rheum[rheum["outcome_of_attendance"].isin(["4", "5"])]
+    if scenario["pifu_from_2022"]:
+        pifu = pifu[pifu["appointment_date"] >= "2022-01-01"]
+    first_pifu = pifu.groupby("patient_id")["appointment_date"].min()
+
+    rel = (e["appointment_date"] - first_pifu.reindex(e["patient_id"]).to_numpy()).dt.days
+    n_cohort, n_pifu = rheum["patient_id"].nunique(), len(first_pifu)
+    r_cohort, r_pifu = round_counts([n_cohort, n_pifu])
+    values = {
+        ("cohort_patients", None): r_cohort,
+        ("pifu_patients", None): r_pifu,
+        ("pifu_share", None): r_pifu / r_cohort if r_cohort > 0 else np.nan,
+        ("opa_per_patient_12m_pre_pifu", None): ((rel >= -365) & (rel < 0)).sum() / n_pifu if n_pifu else np.nan,
+        ("opa_per_patient_12m_post_pifu", None): ((rel > 0) & (rel <= 365)).sum() / n_pifu if n_pifu else np.nan,
+    }
+    for period in pd.date_range(start, periods=int(scenario["n_months"]), freq="MS"):
+        month = lambda dates: (dates >= period) & (dates < period + pd.DateOffset(months=1))  # noqa: E731
+        label = period.strftime("%Y-%m-%d")
+        values["count_all_opa", label] = round_counts(month(in_cohort["appointment_date"]).sum())
+        values["count_rheum_opa", label] = round_counts(
+            month(in_cohort["appointment_date"][in_cohort["treatment_function_code"] == "410"]).sum())
+        values["new_pifu_patients", label] = round_counts(month(first_pifu).sum())
+    return values
+
+
+def test_sweep_matches_a_per_scenario_loop(tmp_path):
+    extracts(tmp_path)
+    events_path, cohort_path = tmp_path / "opa.csv.gz", tmp_path / "dataset.csv.gz"
+    ensure_base(events_path, cohort_path, tmp_path / "base")
+    scenarios = scenario_grid({**SWITCHES, "n_months": [24, 60]})
+    results = run_sweep(scenarios, tmp_path / "base", n_jobs=2)
+
+    cohort = pd.read_csv(cohort_path)
+    events = pd.read_csv(events_path, dtype=str, parse_dates=["appointment_date"])
+    events["patient_id"] = events["patient_id"].astype(int)
+    for scenario in scenarios:
+        got = results[results["scenario"] == scenario_id(scenario)]
+        want = naive_scenario(cohort, events, scenario)
+        assert len(got) == len(want)
+        for row in got.itertuples():
+            expected = want[row.metric, None if pd.isna(row.period) else row.period]
+            np.testing.assert_allclose(row.value, expected, rtol=1e-12, equal_nan=True,
+                                       err_msg=f"{row.scenario} {row.metric} {row.period}")
+        for switch, value in scenario.items():
+            assert (got[switch] == value).all()
@@ -0,0 +1,69 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+import sharded_extract
+from sharded_extract import SPLIT_DONE, prepare_shards, split_tables
+
+
+@pytest.fixture
+def tables(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tables = tmp_path / "tables"
+    tables.mkdir()
+    pd.DataFrame({"patient_id": range(1, 201), "sex": ["female", "male"] * 100}).to_csv(
+        tables / "patients.csv", index=False)
+    pd.DataFrame({"patient_id": [i % 200 + 1 for i in range(1000)], "code": "410"}).to_csv(
+        tables / "opa.csv", index=False)
+    return tables
+
+
+def read_shards(workdir, name):
+    return pd.concat(pd.read_csv(p, dtype=str) for p in sorted(workdir.glob(f"shard_*/tables/{name}")))
+
+
+def test_split_routes_every_patient_to_one_shard(tables, tmp_path):
+    workdir = tmp_path / "shards"
+    shard_dirs = split_tables(tables, workdir, 4, chunksize=64)
+    assert len(shard_dirs) == 4 and (workdir / SPLIT_DONE).exists()
+    opa = read_shards(workdir, "opa.csv")
+    assert len(opa) == 1000
+    owners = {p: {d.name for d in shard_dirs if p in set(pd.read_csv(d / "tables" / "opa.csv", dtype=str)["patient_id"])}
+              for p in opa["patient_id"].unique()}
+    assert all(len(o) == 1 for o in owners.values())
+
+
+def test_interrupted_split_is_not_resumed(tables, tmp_path):
+    workdir = tmp_path / "shards"
+    bad = pd.read_csv(tables / "opa.csv", dtype=str)
+    bad.loc[900, "patient_id"] = "not-a-number"
+    bad.to_csv(tables / "opa.csv", index=False)
+    with pytest.raises(ValueError):
+        split_tables(tables, workdir, 4, chunksize=64)
+    assert not (workdir / SPLIT_DONE).exists()
+    assert not list(workdir.glob("shard_*/tables/opa.csv"))
+    assert not list(workdir.rglob("*.tmp*"))
+
+    bad.loc[900, "patient_id"] = "1"
+    bad.to_csv(tables / "opa.csv", index=False)
+    prepare_shards(tables, workdir, 4)
+    assert len(read_shards(workdir, "opa.csv")) == 1000
+
+
+def test_complete_split_is_resumed(tables, tmp_path, monkeypatch):
+    workdir = tmp_path / "shards"
+    first = prepare_shards(tables, workdir, 4)
+    monkeypatch.setattr(sharded_extract, "split_tables", lambda *a, **k: pytest.fail("re-split"))
+    assert prepare_shards(tables, workdir, 4) == first
+    with pytest.raises(SystemExit):
+        prepare_shards(tables, workdir, 3)
+
+
+def test_scratch_shards_stay_out_of_the_manifest(tables, tmp_path):
+    from output_manager import read_manifest, verify
+
+    workdir = tmp_path / "output" / "shards"
+    split_tables(tables, workdir, 2)
+    shutil.rmtree(workdir)
+    assert read_manifest() == {} and verify() == []
@@ -0,0 +1,38 @@
+import numpy as np
+
+from specialty_profile import specialty_profile, summary
+
+NO_PIFU = np.iinfo(np.int64).min
+
+
+def test_profile_matches_naive_loop():
+    rng = np.random.default_rng(5)
+    n_patients, n_specialties, window = 30, 4, 100
+    patient = rng.integers(0, n_patients, 600)
+    specialty = rng.integers(0, n_specialties, 600)
+    day = rng.integers(18000, 18600, 600)
+    pifu_day = np.where(rng.random(n_patients) < 0.5, rng.integers(18100, 18500, n_patients), NO_PIFU)
+    profile = {name: m.toarray() for name, m in specialty_profile(
+        patient, day, specialty, pifu_day, n_patients, n_specialties, window).items()}
+
+    for p in range(n_patients):
+        for s in range(n_specialties):
+            days = day[(patient == p) & (specialty == s)]
+            assert profile["visits"][p, s] == len(days)
+            if len(days):
+                assert profile["first_day"][p, s] == days.min() and profile["last_day"][p, s] == days.max()
+            rel = days - pifu_day[p] if pifu_day[p] != NO_PIFU else np.array([], dtype=np.int64)
+            assert profile["pre_pifu"][p, s] == ((rel >= -window) & (rel < 0)).sum()
+            assert profile["post_pifu"][p, s] == ((rel > 0) & (rel <= window)).sum()
+
+
+def test_summary_counts_patients_once_per_specialty():
+    patient = np.array([0, 0, 0, 1, 2])
+    specialty = np.array([0, 0, 1, 0, 1])
+    day = np.array([10, 20, 30, 40, 50])
+    pifu_day = np.array([15, NO_PIFU, NO_PIFU])
+    profile = specialty_profile(patient, day, specialty, pifu_day, 3, 2)
+    report = summary(profile, np.array(["410", "110"]), pifu_day != NO_PIFU).set_index("treatment_function_code")
+    assert report.loc["410", "patients"] == 2 and report.loc["410", "visits"] == 3
+    assert report.loc["410", "pifu_patients_with_visit"] == 1
+    assert report.loc["410", "visits_pre_pifu"] == 1 and report.loc["410", "visits_post_pifu"] == 1
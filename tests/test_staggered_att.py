@@ -0,0 +1,61 @@
+import numpy as np
+
+from staggered_att import (
+    NEVER_TREATED, aggregate, cell_grid, disclose_att_gt, estimate_att_gt, releasable, write_panel,
+)
+
+
+def simulated_panel(seed=4, n_patients=300, n_months=14):
+    """Patient + month effects, cohort-specific effects that grow with exposure, no noise."""
+    rng = np.random.default_rng(seed)
+    cohort = rng.choice([3, 6, 9, NEVER_TREATED], n_patients)
+    alpha, gamma = rng.normal(size=(n_patients, 1)), rng.normal(size=n_months)
+    month = np.arange(n_months)
+    effect = np.where(cohort[:, None] == NEVER_TREATED, 0.0,
+                      np.maximum(month - cohort[:, None] + 1, 0) * (cohort[:, None] / 3.0))
+    return alpha + gamma + effect, cohort
+
+
+def test_att_gt_recovers_heterogeneous_effects(tmp_path):
+    y, cohort = simulated_panel()
+    write_panel(y, cohort, tmp_path)
+    cells = cell_grid(cohort, y.shape[1], pre=3, post=3)
+    att_gt = estimate_att_gt(tmp_path, cells)
+    truth = np.maximum(att_gt["period"] - att_gt["cohort"] + 1, 0) * att_gt["cohort"] / 3.0
+    np.testing.assert_allclose(att_gt["att"], truth, atol=1e-10)
+
+    # the control group is the not-yet-treated (and never-treated) at max(t, g - 1)
+    row = att_gt[(att_gt["cohort"] == 3) & (att_gt["period"] == 5)].iloc[0]
+    assert row["n_control"] == ((cohort > 5) & (cohort != 3)).sum()
+    assert row["n_treated"] == (cohort == 3).sum()
+
+    event_time = aggregate(att_gt, tmp_path, "event_time").set_index("event_time")
+    cells_at_0 = att_gt[att_gt["event_time"] == 0]
+    expected = np.average(cells_at_0["att"], weights=cells_at_0["n_treated"])
+    np.testing.assert_allclose(event_time.loc[0, "att"], expected, atol=1e-10)
+    np.testing.assert_allclose(event_time.loc[-2, "att"], 0.0, atol=1e-10)
+
+
+def test_small_cells_are_blanked_and_left_out_of_the_aggregates(tmp_path):
+    y, cohort = simulated_panel()
+    cohort[cohort == 9] = NEVER_TREATED
+    cohort[:5] = 9                                  # a cohort of 5 patients
+    write_panel(y, cohort, tmp_path)
+    att_gt = estimate_att_gt(tmp_path, cell_grid(cohort, y.shape[1], pre=3, post=3))
+    released = disclose_att_gt(att_gt)
+    small = released["cohort"] == 9
+    assert small.any() and released.loc[small, ["att", "se", "lci", "uci", "n_treated"]].isna().all().all()
+    assert released.loc[~small, ["att", "se"]].notna().all().all()
+
+    event_time = aggregate(att_gt[releasable(att_gt)], tmp_path, "event_time").set_index("event_time")
+    cells_at_0 = att_gt[(att_gt["event_time"] == 0) & ~small]
+    expected = np.average(cells_at_0["att"], weights=cells_at_0["n_treated"])
+    np.testing.assert_allclose(event_time.loc[0, "att"], expected, atol=1e-10)
+
+
+def test_no_cells_gives_an_empty_result(tmp_path):
+    y, cohort = simulated_panel()
+    write_panel(y, cohort, tmp_path)
+    att_gt = estimate_att_gt(tmp_path, [])
+    assert att_gt.empty and {"att", "event_time", "n_treated"} <= set(att_gt.columns)
+    assert aggregate(att_gt, tmp_path, "event_time").empty
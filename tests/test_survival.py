@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from disclosure import CUMULATIVE_STEP, REDACT_AT
+from survival import DEATH, NEXT_VISIT, curves, logrank, next_visit_days, release_curves, stack_strata
+
+
+def naive_curves(time, event):
+    """Per-time loop: KM for next visit (death censored) and Aalen-Johansen CIFs."""
+    km, overall, cif1, cif2, rows = 1.0, 1.0, 0.0, 0.0, []
+    for t in np.unique(time):
+        n = (time >= t).sum()
+        d1 = ((time == t) & (event == NEXT_VISIT)).sum()
+        d2 = ((time == t) & (event == DEATH)).sum()
+        cif1 += overall * d1 / n
+        cif2 += overall * d2 / n
+        km *= 1 - d1 / n
+        overall *= 1 - (d1 + d2) / n
+        rows.append((t, n, d1, d2, km, cif1, cif2))
+    return pd.DataFrame(rows, columns=["days", "n_risk", "n_next_visit", "n_death", "km", "cif1", "cif2"])
+
+
+def naive_logrank(group, time, event):
+    levels = np.unique(group)
+    o_e, v = np.zeros(len(levels)), np.zeros((len(levels), len(levels)))
+    for t in np.unique(time[event == NEXT_VISIT]):
+        at_risk = time >= t
+        n = np.array([(at_risk & (group == g)).sum() for g in levels], dtype=float)
+        d = np.array([((time == t) & (event == NEXT_VISIT) & (group == g)).sum() for g in levels])
+        N, D = n.sum(), d.sum()
+        if N < 2:
+            continue
+        o_e += d - n * D / N
+        v += D * (N - D) / (N**2 * (N - 1)) * (np.diag(n * N) - np.outer(n, n))
+    return float(o_e[:-1] @ np.linalg.inv(v[:-1, :-1]) @ o_e[:-1])
+
+
+def simulate(seed, n=300):
+    rng = np.random.default_rng(seed)
+    time = rng.integers(0, 60, n)
+    event = rng.choice([0, NEXT_VISIT, DEATH], n, p=[0.3, 0.5, 0.2])
+    group = rng.choice(["a", "b", "c"], n)
+    return time, event, group
+
+
+def test_stacked_curves_match_per_stratum_loop():
+    time, event, group = simulate(1)
+    df = pd.DataFrame({"g": group})
+    rows, stratum, labels = stack_strata(df, ["g"])
+    table = curves(stratum, time[rows], event[rows], labels)
+    for level, mask in [("all", np.ones(len(group), bool))] + [(g, group == g) for g in "abc"]:
+        got = table[table["level"] == level].reset_index(drop=True)
+        want = naive_curves(time[mask], event[mask])
+        np.testing.assert_array_equal(got["days"], want["days"])
+        np.testing.assert_array_equal(got["n_risk"], want["n_risk"])
+        np.testing.assert_array_equal(got["n_next_visit"], want["n_next_visit"])
+        np.testing.assert_allclose(got["km_no_visit"], want["km"], atol=1e-12)
+        np.testing.assert_allclose(got["cif_next_visit"], want["cif1"], atol=1e-12)
+        np.testing.assert_allclose(got["cif_death"], want["cif2"], atol=1e-12)
+
+
+def test_logrank_matches_loop():
+    time, event, group = simulate(2)
+    code = pd.factorize(group, sort=True)[0]
+    chi2, df, p = logrank(code, time, event, 3)
+    assert df == 2 and 0 <= p <= 1
+    np.testing.assert_allclose(chi2, naive_logrank(group, time, event), rtol=1e-9)
+
+
+def test_next_visit_is_first_strictly_after_start():
+    events = pd.DataFrame({
+        "patient_id": [1, 1, 1, 2, 3],
+        "appointment_date": ["2020-01-01", "2020-01-10", "2020-03-01", "2019-12-01", "2020-02-01"],
+    })
+    start = pd.to_datetime(pd.Series(["2020-01-01", "2020-01-01", "2020-01-01"])).to_numpy("datetime64[D]")
+    np.testing.assert_array_equal(next_visit_days(np.array([1, 2, 3]), start, events), [9, np.nan, 31])
+
+
+def test_released_curves_are_recomputed_from_cumulatively_rounded_counts():
+    time, event, group = simulate(3, n=600)
+    group[:5] = "tiny"
+    rows, stratum, labels = stack_strata(pd.DataFrame({"g": group}), ["g"])
+    exact = curves(stratum, time[rows], event[rows], labels)
+    released = release_curves(exact)
+    assert "tiny" not in set(released["level"])
+
+    counts = released[["n_next_visit", "n_death", "n_censored"]].to_numpy()
+    assert ((counts == 0) | (counts >= CUMULATIVE_STEP)).all()
+    assert (released["n_risk"] % 5 == 0).all() and (released["n_risk"] > REDACT_AT).all()
+    for level, got in released.groupby("level", sort=False):
+        # the released curve is the product-limit of the released counts alone
+        km = np.cumprod(1 - got["n_next_visit"] / got["n_risk"])
+        np.testing.assert_allclose(got["km_no_visit"], km, atol=1e-12)
+        # cumulative counts are the exact ones rounded up to the next step
+        want = exact[exact["level"] == level].set_index("days")["n_next_visit"].cumsum()
+        gap = got["n_next_visit"].cumsum().to_numpy() - want.loc[got["days"]].to_numpy()
+        assert ((gap >= 0) & (gap < CUMULATIVE_STEP)).all()
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from treatment_episodes import build_episodes, exposure_at, monthly_exposure
+
+NAT = np.iinfo(np.int64).min
+
+
+def naive_episodes(patient, day, category, supply, gap):
+    rows = []
+    for p in np.unique(patient):
+        for c in np.unique(category):
+            days = np.sort(day[(patient == p) & (category == c)])
+            start = prev = None
+            count = 0
+            for d in days:
+                if start is None or d - prev > supply + gap:
+                    if start is not None:
+                        rows.append((p, c, start, prev + supply, count))
+                    start, count = d, 0
+                prev, count = d, count + 1
+            if start is not None:
+                rows.append((p, c, start, prev + supply, count))
+    return pd.DataFrame(rows, columns=["patient", "category", "start", "end", "n_prescriptions"])
+
+
+def prescriptions(seed=12, n=500):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 30, n), rng.integers(17500, 18500, n), rng.integers(0, 2, n)
+
+
+def test_episodes_match_naive_gap_loop():
+    patient, day, category = prescriptions()
+    got = build_episodes(patient, day, category, supply_days=28, gap_days=30)
+    want = naive_episodes(patient, day, category, 28, 30)
+    pd.testing.assert_frame_equal(got.reset_index(drop=True), want, check_dtype=False)
+
+
+def test_exposure_and_monthly_counts_match_episode_scan():
+    patient, day, category = prescriptions()
+    episodes = build_episodes(patient, day, category)
+    anchors = np.r_[np.random.default_rng(1).integers(17500, 18600, 29), NAT]
+    exposed = exposure_at(episodes, np.arange(30), anchors, 2)
+    for p in range(30):
+        for c in range(2):
+            mine = episodes[(episodes["patient"] == p) & (episodes["category"] == c)]
+            want = anchors[p] != NAT and ((mine["start"] <= anchors[p]) & (mine["end"] > anchors[p])).any()
+            assert exposed[p, c] == want
+
+    months = pd.date_range("2017-11-01", "2020-12-01", freq="MS")
+    counts = monthly_exposure(episodes, 2, months)
+    month_days = months.to_numpy("datetime64[D]").astype(np.int64)
+    for m, d in enumerate(month_days):
+        for c in range(2):
+            on = episodes[(episodes["category"] == c) & (episodes["start"] <= d) & (episodes["end"] > d)]
+            assert counts[m, c] == len(on)
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from validate_dataset import disclose_report, parse_dictionary, pick_schema, validate
+
+
+def test_rheum_dictionary_allows_negative_follow_up_and_pre_2018_non_rheum_visits(tmp_path):
+    path = tmp_path / "dataset.csv"
+    pd.DataFrame({
+        "patient_id": [1, 2, 3],
+        "fu_days": [-40, 0, 900],                 # 1 deregistered before their first PIFU
+        "count_all_opa": [2, 5, 1],               # since 2018
+        "non_rheum_opa_count": [4, 1, 0],         # any date
+    }).to_csv(path, index=False)
+    columns = ["patient_id", "fu_days", "count_all_opa", "non_rheum_opa_count"]
+    schema = pick_schema(parse_dictionary(), columns)
+    report, _ = validate(path, schema)
+    checked = report[report["kind"].isin(["range", "rule"]) & report["checked"].gt(0)]
+    assert "fu_days in [-3286.0, 3286.0]" in set(checked["check"])
+    assert checked["violations"].sum() == 0
+
+
+def test_release_rounds_patient_counts_but_not_schema_checks(tmp_path):
+    path = tmp_path / "dataset.csv"
+    pd.DataFrame({"patient_id": range(1, 41), "fu_days": [-4000] * 3 + [10] * 37, "extra": 1}).to_csv(
+        path, index=False)
+    schema = pick_schema(parse_dictionary(), ["patient_id", "fu_days"])
+    report, _ = validate(path, schema)
+    released = disclose_report(report).set_index("check")
+    assert released.loc["extra documented", ["checked", "violations"]].tolist() == [1, 1]
+    range_check = released.loc["fu_days in [-3286.0, 3286.0]"]
+    assert range_check["checked"] == 40 and pd.isna(range_check["violations"])
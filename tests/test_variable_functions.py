@@ -0,0 +1,70 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from variable_functions import (
+    AGE_BANDS, COVID_PHASES, IMD_QUINTILES, MEASURES_AGE_BANDS, N_LSOA, Bins, bin_codes, bin_labels,
+)
+
+
+def case(value, branches, otherwise):
+    """The first matching when(...).then(...) branch, as ehrQL's case() picks it."""
+    if value is None:
+        return otherwise
+    return next((label for condition, label in branches if condition(value)), otherwise)
+
+
+# the case/when chains the specs replaced (features/demographics.py, measures.py,
+# features/deprivation.py, dataset_definition_rheum.py before the binning specs)
+OLD_AGE = [(lambda a, hi=hi: a < hi, label) for hi, label in zip(
+    (18, 30, 40, 50, 60, 70, 80, 90), ("0-17", "18-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80-89"))
+] + [(lambda a: a >= 90, "90+")]
+OLD_MEASURES_AGE = (
+    [(lambda a: 18 <= a <= 29, "age_18_29")]
+    + [(lambda a, lo=lo: lo <= a <= lo + 9, f"age_{lo}_{lo + 9}") for lo in (30, 40, 50, 60, 70, 80)]
+    + [(lambda a: a >= 90, "age_90+")]
+)
+OLD_IMD = [(lambda i: 0 <= i <= int(N_LSOA * 1 / 5), "1 (most deprived)")] + [
+    (lambda i, k=k: i <= int(N_LSOA * k / 5), label) for k, label in zip((2, 3, 4, 5), ("2", "3", "4", "5 (least deprived)"))
+]
+OLD_COVID = [
+    (lambda d: d <= datetime.date(2019, 12, 31), "pre"),
+    (lambda d: datetime.date(2020, 1, 1) <= d <= datetime.date(2021, 12, 31), "peri"),
+    (lambda d: d >= datetime.date(2022, 1, 1), "post"),
+]
+
+
+@pytest.mark.parametrize("bins, old, otherwise", [
+    (AGE_BANDS, OLD_AGE, "missing"),
+    (MEASURES_AGE_BANDS, OLD_MEASURES_AGE, "missing"),
+])
+def test_age_specs_match_old_chains(bins, old, otherwise):
+    ages = list(range(-2, 121)) + [None]
+    got = bin_labels(bins, [np.nan if a is None else a for a in ages])
+    assert list(got) == [case(a, old, otherwise) for a in ages]
+
+
+def test_imd_spec_matches_old_chain_on_the_rounded_rank_domain():
+    # imd_rounded is a non-negative multiple of 100; every cut point +-1 is covered too
+    cuts = [int(N_LSOA * k / 5) for k in range(6)]
+    ranks = sorted(set(range(0, N_LSOA + 200, 100)) | {c + d for c in cuts for d in (-1, 0, 1) if c + d >= 0})
+    got = bin_labels(IMD_QUINTILES, ranks + [np.nan])
+    assert list(got) == [case(r, OLD_IMD, "unknown") for r in ranks] + ["unknown"]
+
+
+def test_covid_spec_matches_old_chain():
+    days = np.arange(np.datetime64("2019-12-25"), np.datetime64("2022-01-08"))
+    days = np.r_[days, np.datetime64("1990-01-01"), np.datetime64("2030-01-01"), np.datetime64("NaT")]
+    got = bin_labels(COVID_PHASES, days)
+    want = [case(None if np.isnat(d) else d.astype(datetime.date), OLD_COVID, None) for d in days]
+    assert list(got) == want
+
+
+def test_bins_validate_and_code_out_of_range():
+    with pytest.raises(ValueError):
+        Bins((0, 1, 2), ("a",))
+    with pytest.raises(ValueError):
+        Bins((0, 1), ("a",), closed="both")
+    np.testing.assert_array_equal(bin_codes(Bins((0, 10, 20), ("a", "b")), [-1, 0, 10, 19.5, 20, np.nan]),
+                                  [-1, 0, 1, 1, -1, -1])